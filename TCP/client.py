@@ -4,211 +4,764 @@ import time
 import json
 import threading
 import signal
+import sys
+import random
+import argparse
+import math
+import protocol
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.journal import RangeJournal
+from common.scheduler import RangeScheduler
+from common.pipeline import DownloadPipeline, FileDownload
+from common.inputwatch import InputWatcher
+from common import integrity
+from common import delta
+from common.fileio import read_at, write_at
+from common.metrics import Registry
+from common.progress import ProgressView
+from common.sources import Source, parse_servers, share
 
 SERVER_PORT = 65432
 CHUNK_SIZE = 1024 * 1024 
+RANGE_SIZE = 8 * CHUNK_SIZE
+PIPELINE_DEPTH = 4
+# Smallest request to a slow server
+MIN_CLAIM = 64 * 1024
+NUM_CONNECTIONS = 4
+MAX_QUEUED_FILES = 64
+RETRY_BASE = 0.5
+RETRY_MAX = 15
+# A block that fails its digest this many times fails its file
+MAX_REFETCHES = 3
+CATALOG_PAGE = 500
+CATALOG_REFRESH = 5
+# A download connection that receives nothing for this long gives its ranges to the others;
+# sooner when other servers can take over
+STALL_TIMEOUT = 10
+MIRROR_STALL_TIMEOUT = 3
 FORMAT = 'utf8'
 INPUT_FILE = 'TCP/input.txt'
 OUTPUT_FOLDER = 'TCP/downloads'
+O_BINARY = getattr(os, 'O_BINARY', 0)
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# name -> size, of every file any server has
 files = {}
-download_status = {}
+# Every server downloaded from, each with its own catalog and control connection
+sources = []
+# Lock-free counters of every download; read by the progress view and the --metrics-port exporter
+metrics = Registry()
 stop_flag = False
 lock = threading.Lock()
+pipeline = None
+# Names in input.txt the catalog doesn't have (yet)
+input_waiting = 0
+
+def backoff_delay(attempt):
+    # Exponential backoff with jitter, so connections that failed together don't retry together
+    delay = min(RETRY_MAX, RETRY_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def pause(seconds):
+    # Sleeps, but wakes up when the client is closing, so a server that is down doesn't hold up the exit
+    deadline = time.monotonic() + seconds
+    while not stop_flag and time.monotonic() < deadline:
+        time.sleep(min(0.1, deadline - time.monotonic()))
 
-def connect_to_server(server_host):
-    max_retries = 3
+def connect_to_server(source):
+    max_retries = 6
     for attempt in range(max_retries):
         try:
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((server_host, SERVER_PORT))
-            print(f"Connected to server at {server_host}")
+            connect_start = time.monotonic()
+            client_socket.connect((source.host, source.port))
+            # The handshake takes one round trip
+            metrics.gauge('rtt_seconds').set(round(time.monotonic() - connect_start, 6))
+            print(f"Connected to server at {source.host if len(sources) < 2 else source.label}")
             return client_socket
         except Exception as e:
-            print(f"Attempt {attempt + 1}/{max_retries}: Error connecting to server: {e}")
-            if attempt < max_retries - 1:
-                print("Retrying in 5 seconds...")
-                time.sleep(5)
+            client_socket.close()
+            print(f"Attempt {attempt + 1}/{max_retries}: Error connecting to server {source.label}: {e}")
+            metrics.counter('retries_total', kind='connect').add()
+            if attempt < max_retries - 1 and not stop_flag:
+                delay = backoff_delay(attempt)
+                print(f"Retrying in {delay:.1f} seconds...")
+                pause(delay)
     print("Failed to connect after multiple attempts. Please check the server address and your internet connection.")
     return None
 
-def get_file_list(client_socket):
+def negotiate(client_socket):
+    # Returns the binary protocol version the server agreed to (None for a text-only
+    # server) and whatever a text-only server sent instead of the HELLO reply
+    client_socket.settimeout(5)
+    reader = protocol.FrameReader(client_socket)
+    reply = b""
+    try:
+        client_socket.sendall(protocol.pack_hello())
+        reply = reader.read_exact(protocol.HELLO.size)
+        return protocol.unpack_hello(reply), b""
+    except (protocol.ProtocolError, socket.timeout, ConnectionError):
+        return None, reply + bytes(reader.pending)
+    finally:
+        client_socket.settimeout(None)
+
+def open_connection(source):
+    client_socket = connect_to_server(source)
+    if client_socket and source.binary and negotiate(client_socket)[0] is None:
+        print(f"Server {source.label} refused the binary protocol or didn't answer")
+        client_socket.close()
+        return None
+    return client_socket
+
+def read_reply(client_socket):
+    reader = protocol.FrameReader(client_socket)
+    _, status, _, _, length = reader.read_response()
+    return status, reader.read_exact(length).decode(FORMAT)
+
+def request_catalog(client_socket, since=0):
+    # Every page of what changed after generation since (0: the whole catalog)
+    entries = []
+    cursor = ''
+    while True:
+        client_socket.sendall(protocol.pack_request(protocol.CATALOG, 0, cursor, since, CATALOG_PAGE))
+        status, data = read_reply(client_socket)
+        if status != protocol.OK:
+            return None
+        page = json.loads(data)
+        if cursor == '':
+            first = page
+        entries += page['entries']
+        cursor = page['next']
+        if cursor is None:
+            first['entries'] = entries
+            return first
+
+def apply_catalog(source, listing):
+    updated = {} if listing['full'] else dict(source.files)
+    for name in listing['removed']:
+        updated.pop(name, None)
+    for entry in listing['entries']:
+        updated[entry['name']] = {'size': entry['size'], 'digest': entry.get('digest')}
+    source.files = updated
+    source.generation = max(source.generation, listing['generation'])
+    merge_catalogs()
+
+def apply_file_list(source, listing):
+    # The plain name -> size list of older servers
+    source.files = {name: {'size': size, 'digest': None} for name, size in listing.items()}
+    merge_catalogs()
+
+def merge_catalogs():
+    # A name listed with different sizes shows the size of the first server that has it
+    global files
+    merged = {}
+    for source in sources:
+        for name, entry in source.files.items():
+            merged.setdefault(name, entry['size'])
+    files = merged
+
+def get_file_list(source, client_socket, pushed=b""):
     try:
-        data = client_socket.recv(4096).decode(FORMAT)
-        global files
-        files = json.loads(data)
-        print("Available files:")
-        for filename, size in files.items():
-            print(f"{filename}: {size / (1024 * 1024)} MB")
+        if source.binary:
+            listing = request_catalog(client_socket)
+            if listing is not None:
+                apply_catalog(source, listing)
+            else:
+                # A server without the catalog request still has the plain list
+                client_socket.sendall(protocol.pack_request(protocol.LIST, 0))
+                status, data = read_reply(client_socket)
+                if status != protocol.OK:
+                    raise protocol.ProtocolError(data)
+                apply_file_list(source, json.loads(data))
+        else:
+            if pushed:
+                # Old servers push the catalog on their first connection, before reading anything
+                client_socket.settimeout(1)
+                try:
+                    pushed += client_socket.recv(4096)
+                except socket.timeout:
+                    pass
+                # A text-only server also answers our HELLO with an error string after the catalog
+                data = pushed.decode(FORMAT, 'replace')
+                data = data[:json.JSONDecoder().raw_decode(data)[1]]
+            else:
+                data = client_socket.recv(4096).decode(FORMAT)
+            apply_file_list(source, json.loads(data))
     except Exception as e:
-        print(f"Error getting file list: {e}")
+        print(f"Error getting file list from {source.label}: {e}")
 
-def check_input_file(server_host):
-    last_motified = 0
-    while not stop_flag:
-        try:
-            mtime = os.path.getmtime(INPUT_FILE)
-            if mtime - last_motified >= 5:
-                last_motified = mtime
-                with open(INPUT_FILE, "r") as file:
-                    lines = file.readlines()
-                with lock:
-                    for filename in lines:
-                        filename = filename.strip()
-                        if filename in files and filename not in download_status:
-                            download_status[filename] = 0
-                            threading.Thread(target=download_file, args=(server_host, filename)).start()
-
-        except FileNotFoundError:
-            pass
-        time.sleep(1)
-
-def download_file(server_host, filename):
-    file_size = os.path.getsize(os.path.join('server_files', filename))
-    num_chunks = 4
-    chunk_size = file_size // num_chunks
-    threads = []
-
-    for i in range(num_chunks):
-        start_byte = i * chunk_size
-        end_byte = ((i + 1) * chunk_size) if i < num_chunks - 1 else file_size
-        thread = threading.Thread(target=download_chunk, args=(server_host, filename, start_byte, end_byte, i))
-        threads.append(thread)
-        thread.start()
-    
-    for thread in threads:
-        thread.join()
+def print_file_list():
+    print("Available files:")
+    for filename, size in files.items():
+        line = f"{filename}: {size / (1024 * 1024)} MB"
+        if len(sources) > 1:
+            line += f" on {sum(1 for source in sources if filename in source.files)} of {len(sources)} servers"
+        print(line)
 
-    combine_file_parts(filename, num_chunks)
+def request_manifest(client_socket, filename):
+    client_socket.sendall(protocol.pack_request(protocol.MANIFEST, 0, filename))
+    status, data = read_reply(client_socket)
+    if status != protocol.OK:
+        print(f"No manifest for {filename}: {protocol.STATUS_NAMES.get(status, status)} {data}")
+        return None
+    manifest = json.loads(data)
+    if not integrity.check_manifest(manifest):
+        print(f"Manifest of {filename} doesn't match its own digest, ignoring it")
+        return None
+    return manifest
 
-def download_chunk(server_host, filename, start_byte, end_byte, chunk_index):
-    client_socket = connect_to_server(server_host)
-    if not client_socket:
-        print(f"Failed to connect to server for downloading {filename}")
-        return
-    with open(os.path.join(OUTPUT_FOLDER, f"{filename}_part_{chunk_index}"), "wb") as file:
-        bytes_received = start_byte
-        while bytes_received < end_byte and not stop_flag:
-            remaining = end_byte - bytes_received
-            chunk_size = min(CHUNK_SIZE, remaining)
-            request = f"{filename} {bytes_received} {chunk_size}"
+def control_request(source, request, *args):
+    # Catalog and manifest requests go over the control connection kept from the first list
+    if not source.binary:
+        return None
+    with source.control_lock:
+        for attempt in range(2):
+            if source.control_socket is None:
+                source.control_socket = open_connection(source)
+                if source.control_socket is None:
+                    return None
             try:
-                client_socket.sendall(request.encode(FORMAT))
-            except socket.error as e:
-                print(f"Error sending request to server: {e}")
-                break
+                return request(source.control_socket, *args)
+            except (socket.error, ConnectionError, protocol.ProtocolError, ValueError) as e:
+                print(f"Error on the control connection to {source.label}: {e}")
+                source.control_socket.close()
+                source.control_socket = None
+    return None
 
-            chunk = b""
-            while len(chunk) < chunk_size:
-                try:
-                    part = client_socket.recv(chunk_size - len(chunk))
-                    if not part:
-                        print("Connection lost while downloading.")
-                        break
-                    chunk += part
-                except socket.error as e:
-                    print(f"Error receiving data: {e}")
-                    break
+def fetch_manifest(filename):
+    # From the first server that has the file, those that have been failing last
+    for source in sorted(sources, key=lambda source: (source.failures > 0, source.index)):
+        if filename in source.files:
+            manifest = control_request(source, request_manifest, filename)
+            if manifest is not None:
+                return manifest
+    return None
 
-            if not chunk:
-                print(f"Error downloading {filename}")
+def refresh_catalog():
+    # Only what changed since the generation we already have, from every server
+    changed = False
+    for source in sources:
+        if not source.binary or time.monotonic() - source.last_refresh < CATALOG_REFRESH:
+            continue
+        source.last_refresh = time.monotonic()
+        listing = control_request(source, request_catalog, source.generation)
+        if listing is None:
+            continue
+        with lock:
+            apply_catalog(source, listing)
+        changed = changed or bool(listing['entries'] or listing['removed'])
+    return changed
+
+def check_input_file(exit_when_done=False):
+    # Only the names appended to input.txt are read; each one is queued once
+    global input_waiting
+    watcher = InputWatcher(INPUT_FILE)
+    waiting = []
+    try:
+        while not stop_flag:
+            new_names = watcher.new_names()
+            waiting += new_names
+            input_waiting = len(waiting)
+            changed = bool(new_names)
+            if any(name not in files for name in waiting):
+                # Maybe added on the server since we got the catalog
+                changed = refresh_catalog() or changed
+            ready = [name for name in waiting if name in files] if changed else []
+            if ready:
+                for filename in ready:
+                    metrics.transfer(filename, files[filename])
+                waiting = [name for name in waiting if name not in files]
+                input_waiting = len(waiting)
+                # Waits while the download queue is full, input.txt order is kept
+                for filename in ready:
+                    while not stop_flag and not pipeline.put(filename, timeout=1):
+                        pass
+            if exit_when_done and waiting:
+                # A scripted run doesn't wait for the server to publish a name it doesn't have
+                for filename in waiting:
+                    print(f"{filename} is not on the server, skipping it")
+                    metrics.transfer(filename).finish(False)
+                waiting = []
+                input_waiting = 0
+            if exit_when_done and downloads_finished():
                 break
-            
-            file.write(chunk)
-            bytes_received += len(chunk)
-            
-            file_size = int(files[filename])
-            progress = int(bytes_received / file_size * 100)
-            with lock:
-                download_status[filename] = progress
-    
-    print(f"Downloaded part {chunk_index} of {filename}")
+            # Scripted runs look more often so they end soon after the last download
+            watcher.wait(0.1 if exit_when_done else None)
+    finally:
+        watcher.close()
 
-    request = f"{'DISCONNECT'} {0} {0}"
-    client_socket.sendall(request.encode(FORMAT))
-    client_socket.close()
+def temp_path_for(filename):
+    return os.path.join(OUTPUT_FOLDER, f"{filename}.download")
 
-def combine_file_parts(filename, num_chunks):
-    missing_parts = []
-    for i in range(num_chunks):
-        part_file_path = os.path.join(OUTPUT_FOLDER, f"{filename}_part_{i}")
-        if not os.path.exists(part_file_path):
-            missing_parts.append(i)
-    
-    if missing_parts:
-        print(f"Error: Missing parts for {filename}: {missing_parts}")
-        return
+def preallocate(path, size):
+    # Only called without a valid journal: whatever an earlier run left there is dropped,
+    # fallocate never shrinks a longer leftover file
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def verify_blocks(download, indices, data=None, data_offset=0):
+    # Checks blocks against the manifest; bad ones are dropped from the journal and returned
+    manifest = download.manifest
+    bad = []
+    for index in indices:
+        with download.verify_lock:
+            if index in download.verified:
+                continue
+            start, end = integrity.block_range(manifest, index)
+            if data is not None and data_offset == start and len(data) == end - start:
+                # The block arrived as one piece, no need to read it back
+                block = data
+            elif download.journal.covers(start, end):
+                block = read_at(download.fd, start, end - start)
+            else:
+                continue
+            if integrity.verify_block(manifest, index, block):
+                download.verified.add(index)
+            else:
+                download.journal.discard(start, end)
+                bad.append((start, end))
+    return bad
+
+def journal_path_for(filename):
+    return os.path.join(OUTPUT_FOLDER, f"{filename}.journal")
+
+def prepare_download(filename):
+    file_size = files.get(filename)
+    if file_size is None:
+        print(f"{filename} is no longer on the server")
+        metrics.transfer(filename).finish(False)
+        return None
+    manifest = fetch_manifest(filename)
+    if manifest is not None:
+        file_size = manifest['size']
+    temp_path = temp_path_for(filename)
+    journal_path = journal_path_for(filename)
 
-    with open(os.path.join(OUTPUT_FOLDER, filename), "wb") as file:
-        for i in range(num_chunks):
-            part_file_path = os.path.join(OUTPUT_FOLDER, f"{filename}_part_{i}")
-            with open(part_file_path, "rb") as part_file:
-                file.write(part_file.read())
+    journal = RangeJournal.load(journal_path, temp_path, file_size)
+    reused = {}
+    if journal is None:
+        final_path = os.path.join(OUTPUT_FOLDER, filename)
+        if os.path.exists(final_path) and not os.path.exists(journal_path):
+            if manifest is None:
+                print(f"{filename} is already downloaded")
+                metrics.transfer(filename).finish()
+                return None
+            # An older copy: only the blocks it doesn't have are fetched
+            reused = delta.find_matches(final_path, manifest)
+            if len(reused) == integrity.block_count(manifest) and os.path.getsize(final_path) == file_size \
+                    and all(reused[index] == integrity.block_range(manifest, index)[0] for index in reused):
+                print(f"{filename} is up to date")
+                metrics.transfer(filename).finish()
+                return None
+        preallocate(temp_path, file_size)
+        journal = RangeJournal(journal_path, temp_path, file_size)
+        if reused:
+            fd = os.open(temp_path, os.O_RDWR | O_BINARY)
             try:
-                os.remove(part_file_path)
-            except PermissionError as e:
-                print(f"Could not remove {part_file_path}: {e}")
-    with lock:
-        download_status[filename] = 100
-    print(f"File {filename} has been successfully downloaded and combined.")
+                delta.copy_blocks(final_path, fd, manifest, reused)
+            finally:
+                os.close(fd)
+            for index in reused:
+                journal.add(*integrity.block_range(manifest, index))
+            journal.save()
+            print(f"Updating {filename}: {len(reused)} of {integrity.block_count(manifest)} blocks "
+                  f"({journal.completed_bytes()} bytes) reused from the local copy")
+        metrics.transfer(filename).start(file_size, journal.completed_bytes())
+    else:
+        print(f"Resuming {filename}: {journal.completed_bytes()} of {file_size} bytes already on disk")
+        metrics.transfer(filename).start(file_size, journal.completed_bytes())
+
+    fd = os.open(temp_path, os.O_RDWR | O_BINARY)
+    download = FileDownload(filename, file_size, journal, None, fd)
+    download.manifest = manifest
+    download.sources = sources_for(filename, file_size, manifest)
+    # Reused blocks were matched by their digests already
+    download.verified.update(reused)
+    if manifest is not None and journal.completed_bytes():
+        # Whatever a previous run left on disk is checked before it is trusted
+        bad = verify_blocks(download, range(integrity.block_count(manifest)))
+        if bad:
+            print(f"{len(bad)} blocks of {filename} on disk are corrupted, fetching them again")
+            metrics.counter('corrupt_blocks_total').add(len(bad))
+            update_progress(filename, journal.completed_bytes())
+
+    # Small pieces from a shared queue; a free connection takes over half of a straggler's piece.
+    # A small file gets a piece per connection, and requests small enough to pipeline within it
+    piece = piece_size(file_size, len(download.sources))
+    download.scheduler = RangeScheduler(journal.missing(), piece, CHUNK_SIZE,
+                                        max(MIN_CLAIM, piece // PIPELINE_DEPTH // MIN_CLAIM * MIN_CLAIM))
+    return download
+
+def piece_size(file_size, server_count):
+    # RANGE_SIZE at most, file_size over the connections downloading it at least
+    piece = -(-file_size // (NUM_CONNECTIONS * max(1, server_count)))
+    return max(MIN_CLAIM, min(RANGE_SIZE, -(-piece // MIN_CLAIM) * MIN_CLAIM))
+
+def sources_for(filename, file_size, manifest):
+    # Indices of the servers that have this very file: same size, and same digest where their catalog has it
+    digest = manifest['digest'] if manifest is not None else None
+    matching = {source.index for source in sources if source.has(filename, file_size, digest)}
+    if len(sources) > 1:
+        for source in sources:
+            if filename in source.files and source.index not in matching:
+                print(f"{source.label} has a different {filename}, not downloading it from there")
+        if len(matching) > 1:
+            print(f"Downloading {filename} from {len(matching)} servers")
+    # The catalogs may be behind the manifest; then whoever lists the name is tried
+    return matching or {source.index for source in sources if filename in source.files}
+
+def worker_source(worker):
+    return sources[worker // NUM_CONNECTIONS]
 
+def finish_download(download):
+    os.close(download.fd)
+    throughput = sorted(download.scheduler.throughput().items())
+    if len(sources) > 1:
+        # One line per server, its connections added up
+        for source in sources:
+            parts = [(received, rate) for i, (received, rate) in throughput if worker_source(i) is source]
+            if parts:
+                print(f"{download.name} from {source.label}: {sum(received for received, _ in parts) / (1024 * 1024):.1f} MB "
+                      f"at {sum(rate for _, rate in parts) / (1024 * 1024):.1f} MB/s")
+    else:
+        for i, (received, rate) in throughput:
+            print(f"Part {i + 1} of {download.name}: {received / (1024 * 1024):.1f} MB at {rate / (1024 * 1024):.1f} MB/s")
+    download.journal.save()
+    manifest = download.manifest
+    if manifest is not None and len(download.verified) < integrity.block_count(manifest):
+        print(f"Error: {download.name} has {integrity.block_count(manifest) - len(download.verified)} unverified blocks")
+        metrics.transfer(download.name).finish(False)
+        return
+    if finalize_download(download.name, download.size):
+        download.journal.remove()
+
+def suspend_download(download):
+    # Keep what landed so the next run resumes from the journal; the other connections
+    # may still be writing their ranges of it, the fd is closed once they are done
+    pipeline.settle(download)
+    download.journal.save()
+    os.close(download.fd)
 
-def display_progress():
+def connection_worker(source, worker):
+    # One long-lived connection of the pool, reused across files
+    failures = 0
     while not stop_flag:
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print("Available file: ")
-        print("__________________")
-        for filename, size in files.items():
-            print(f"{filename}: {size / (1024 * 1024):.2f} MB")
-        print("__________________")
-        print("\nDownload Status: ")
-        with lock:
-            for filename, progress in download_status.items():
-                if progress < 100:
-                    print(f"Downloading {filename} .... {progress}%")
-                else:
-                    print(f"Downloaded {filename}")
+        client_socket = open_connection(source)
+        if not client_socket:
+            source.failed()
+            pause(backoff_delay(failures))
+            failures += 1
+            continue
+        # A server that stops sending is given up on, what it was sending goes to the other connections
+        client_socket.settimeout(STALL_TIMEOUT if len(sources) == 1 else MIRROR_STALL_TIMEOUT)
+        if source.binary:
+            healthy = download_ranges_binary(client_socket, source, worker)
+        else:
+            healthy = download_ranges_text(client_socket, source, worker)
+        close_connection(client_socket, source)
+        if healthy:
+            failures = 0
+        elif not stop_flag:
+            source.failed()
+            metrics.counter('retries_total', kind='connection').add()
+            pause(backoff_delay(failures))
+            failures += 1
+
+def claim_sizes(source):
+    # Request size, lease size and requests in flight for a connection to source, smaller for slower servers
+    part = share(source, sources)
+    size = max(MIN_CLAIM, int(CHUNK_SIZE * part) // MIN_CLAIM * MIN_CLAIM)
+    lease_size = max(size, int(RANGE_SIZE * part) // size * size)
+    return size, lease_size, max(1, math.ceil(PIPELINE_DEPTH * part))
+
+def source_workers(source):
+    return range(source.index * NUM_CONNECTIONS, (source.index + 1) * NUM_CONNECTIONS)
+
+def close_connection(client_socket, source):
+    try:
+        if source.binary:
+            client_socket.sendall(protocol.pack_request(protocol.BYE, 0))
+        else:
+            request = f"{'DISCONNECT'} {0} {0}"
+            client_socket.sendall(request.encode(FORMAT))
+    except socket.error:
+        pass
+    client_socket.close()
+
+def update_progress(filename, completed_bytes):
+    # A plain attribute store, never waits on the progress view
+    metrics.transfer(filename).completed = completed_bytes
+
+def land_data(download, source, worker, data, offset):
+    write_at(download.fd, data, offset)
+    download.journal.add(offset, offset + len(data))
+    download.scheduler.record(worker, len(data))
+    source.record(len(data))
+    metrics.transfer(download.name).part(worker).add(len(data))
+    if download.manifest is not None:
+        indices = integrity.blocks_covering(download.manifest, offset, offset + len(data))
+        bad = verify_blocks(download, indices, data, offset)
+        if bad:
+            metrics.counter('corrupt_blocks_total').add(len(bad))
+            with download.verify_lock:
+                for start, _ in bad:
+                    download.refetches[start] = download.refetches.get(start, 0) + 1
+                exhausted = max(download.refetches[start] for start, _ in bad) > MAX_REFETCHES
+            if exhausted:
+                print(f"Error: {download.name} still arrives corrupted after {MAX_REFETCHES} refetches, giving up on it")
+                if pipeline.abandon(download):
+                    # The range being landed is settled by the caller, the fd is closed once it is
+                    threading.Thread(target=suspend_download, args=(download,)).start()
+                    metrics.transfer(download.name).finish(False)
+                return
+            print(f"{len(bad)} corrupted blocks in {download.name}, fetching them again")
+            pipeline.requeue(download, bad)
+            # Whoever completed a bad block is blamed; a mirror with other data leaves the file to the others
+            if pipeline.exclude(download, source.index, source_workers(source)):
+                print(f"{source.label} sent corrupted blocks of {download.name}, using the other servers for it")
+    update_progress(download.name, download.journal.completed_bytes())
+
+def download_ranges_text(client_socket, source, worker):
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    while not stop_flag:
+        size, lease_size, _ = claim_sizes(source)
+        claimed = pipeline.claim(worker, size, timeout=1, source=source.index, lease_size=lease_size)
+        if claimed is None:
+            continue
+        download, start_byte, end_byte = claimed
+        chunk_size = end_byte - start_byte
+        request = f"{download.name} {start_byte} {chunk_size}"
+        try:
+            client_socket.sendall(request.encode(FORMAT))
+        except socket.error as e:
+            print(f"Error sending request to server: {e}")
+            pipeline.give_back(worker, download, [(start_byte, end_byte)])
+            return False
+
+        received = 0
+        while received < chunk_size:
+            try:
+                n = client_socket.recv_into(view[received:chunk_size])
+                if not n:
+                    print("Connection lost while downloading.")
+                    break
+                received += n
+            except socket.error as e:
+                print(f"Error receiving data: {e}")
+                break
+
+        if received < chunk_size:
+            print(f"Error downloading {download.name}")
+            pipeline.give_back(worker, download, [(start_byte, end_byte)])
+            return False
+        
+        land_data(download, source, worker, view[:received], start_byte)
+        pipeline.complete(download)
+    return True
+
+def download_ranges_binary(client_socket, source, worker):
+    # Keeps PIPELINE_DEPTH range requests in flight so the link never idles between replies,
+    # fewer and smaller ones to a server slower than the others
+    reader = protocol.FrameReader(client_socket)
+    buffer = bytearray(protocol.FRAME_SIZE)
+    view = memoryview(buffer)
+    in_flight = {}
+    request_id = 0
+    try:
+        while not stop_flag:
+            size, lease_size, depth = claim_sizes(source)
+            while len(in_flight) < depth:
+                claimed = pipeline.claim(worker, size, timeout=0 if in_flight else 1,
+                                         source=source.index, lease_size=lease_size)
+                if claimed is None:
+                    break
+                download, start_byte, end_byte = claimed
+                request_id += 1
+                client_socket.sendall(protocol.pack_request(protocol.GET, request_id, download.name, start_byte, end_byte - start_byte))
+                in_flight[request_id] = (download, [start_byte, end_byte])
+            if not in_flight:
+                continue
+
+            response_id, status, flags, offset, length = reader.read_response()
+            download, remaining = in_flight[response_id]
+            if status != protocol.OK:
+                message = reader.read_exact(length).decode(FORMAT, 'replace')
+                print(f"Error downloading {download.name}: {protocol.STATUS_NAMES.get(status, status)} {message}")
+                del in_flight[response_id]
+                if pipeline.exclude(download, source.index, source_workers(source), [tuple(remaining)]):
+                    print(f"Downloading {download.name} from the other servers")
+                    continue
+                # Settled like a landed range, or suspend_download would wait for it forever
+                pipeline.give_back(worker, download, [tuple(remaining)])
+                if pipeline.abandon(download):
+                    # This connection may hold more ranges of it, don't wait for them here
+                    threading.Thread(target=suspend_download, args=(download,)).start()
+                    metrics.transfer(download.name).finish(False)
+                continue
+            if length > len(buffer):
+                raise protocol.ProtocolError(f"Frame of {length} bytes is larger than {len(buffer)}")
+            reader.read_into(view[:length])
+
+            if not download.abandoned:
+                land_data(download, source, worker, view[:length], offset)
+            if flags & protocol.FLAG_LAST:
+                del in_flight[response_id]
+                pipeline.complete(download)
+            else:
+                remaining[0] = offset + length
+        healthy = True
+    except (socket.error, ConnectionError, protocol.ProtocolError) as e:
+        print(f"Error receiving data from {source.label}: {e}")
+        healthy = False
+    # Whatever this connection claimed but didn't receive goes back to the others
+    for download, remaining in in_flight.values():
+        pipeline.give_back(worker, download, [tuple(remaining)])
+    return healthy
+
+def finalize_download(filename, file_size):
+    temp_path = temp_path_for(filename)
+    if os.path.getsize(temp_path) != file_size:
+        print(f"Error: {filename} has the wrong size")
+        return False
+    fd = os.open(temp_path, os.O_RDWR | O_BINARY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(temp_path, os.path.join(OUTPUT_FOLDER, filename))
+    metrics.transfer(filename).finish()
+    print(f"File {filename} has been successfully downloaded.")
+    return True
 
-        time.sleep(1)
 
 def signal_handler(signum, frame):
     global stop_flag
     stop_flag = True
     print("\nClosing client...")
 
-def start_client():
-    global stop_flag
+def downloads_finished():
+    # Everything input.txt named so far has been downloaded or given up on
+    transfers = list(metrics.transfers.values())
+    return input_waiting == 0 and transfers and all(transfer.state in ('done', 'failed') for transfer in transfers)
+
+def parse_args():
+    global SERVER_PORT
+    parser = argparse.ArgumentParser(description="TCP file client")
+    parser.add_argument('--server', default=None,
+                        help="server address, or several as HOST[:PORT],HOST[:PORT] to download from all of them; "
+                             "asked for on stdin if missing")
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help="port of the servers given without one")
+    parser.add_argument('--exit-when-done', action='store_true',
+                        help="exit once every file in input.txt is downloaded, for scripted runs")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve /metrics (Prometheus text) and /metrics.json on this local port")
+    args = parser.parse_args()
+    SERVER_PORT = args.port
+    return args
+
+def connect_source(source):
+    # First connection to a server: protocol, catalog, and the control connection for later requests
+    initial_client_socket = connect_to_server(source)
+    if not initial_client_socket:
+        return False
+
+    version, pushed = negotiate(initial_client_socket)
+    source.binary = version is not None
+    if not source.binary and not pushed.startswith(b"{"):
+        # Text-only server: start over on a clean connection with the old protocol
+        initial_client_socket.close()
+        initial_client_socket = connect_to_server(source)
+        if not initial_client_socket:
+            return False
+        pushed = b""
+
+    get_file_list(source, initial_client_socket, pushed)
+    if source.binary:
+        source.control_socket = initial_client_socket
+    else:
+        initial_client_socket.close()
+    return True
+
+def start_client(server_host=None, exit_when_done=False, metrics_port=None):
+    global stop_flag, pipeline, sources
     
     signal.signal(signal.SIGINT, signal_handler)
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+        print(f"Metrics on http://127.0.0.1:{metrics_port}/metrics")
     
-    server_host = input("INPUT SERVER_IP: ").strip()
-    
-    initial_client_socket = connect_to_server(server_host)
-    
-    if not initial_client_socket:
+    if server_host is None:
+        server_host = input("INPUT SERVER_IP: ").strip()
+    sources = [Source(i, host, port) for i, (host, port) in enumerate(parse_servers(server_host, SERVER_PORT))]
+
+    # All servers at once, one that is down doesn't hold up the others
+    connected = [False] * len(sources)
+
+    def connect(i):
+        connected[i] = connect_source(sources[i])
+    threads = [threading.Thread(target=connect, args=(i,)) for i in range(len(sources))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for source, ok in zip(sources, connected):
+        if not ok and len(sources) > 1:
+            print(f"Not downloading from {source.label}, it can't be reached")
+    sources = [source for source, ok in zip(sources, connected) if ok]
+    if not sources:
         print("Failed to connect to server. Exiting...")
         return
+    for i, source in enumerate(sources):
+        source.index = i
+    merge_catalogs()
+    print_file_list()
 
-    get_file_list(initial_client_socket)
-    initial_client_socket.close()
+    pipeline = DownloadPipeline(prepare_download, finish_download, MAX_QUEUED_FILES)
+    workers = []
+    for source in sources:
+        for i in source_workers(source):
+            worker = threading.Thread(target=connection_worker, args=(source, i))
+            worker.start()
+            workers.append(worker)
     
-    input_thread = threading.Thread(target=check_input_file, args=(server_host,))
+    input_thread = threading.Thread(target=check_input_file, args=(exit_when_done,))
     input_thread.start()
     
-    progress_thread = threading.Thread(target=display_progress)
-    progress_thread.start()
+    progress = ProgressView(metrics, lambda: files)
+    progress.start()
     
     try:
         while not stop_flag:
-            time.sleep(1)
+            time.sleep(0.1 if exit_when_done else 1)
+            if exit_when_done and downloads_finished():
+                break
     except KeyboardInterrupt:
         pass
     finally:
         stop_flag = True
+        pipeline.close()
+        for worker in workers:
+            worker.join()
+        for download in pipeline.pending():
+            suspend_download(download)
+        for source in sources:
+            if source.control_socket is not None:
+                close_connection(source.control_socket, source)
         input_thread.join()
-        progress_thread.join()
+        progress.stop()
 
 if __name__ == "__main__":
-    start_client()
\ No newline at end of file
+    args = parse_args()
+    start_client(args.server, args.exit_when_done, args.metrics_port)
\ No newline at end of file
@@ -0,0 +1,125 @@
+import struct
+
+# Binary range protocol, version 1
+#
+# The client opens with HELLO (magic + highest version it speaks) and the server
+# answers with the version both sides will use. Anything else on the wire keeps
+# using the old "name offset size" text protocol.
+#
+# Request frame:  type, request id, offset, length, name length, then the name
+# Response frame: request id, status, flags, offset, payload length, then payload
+#
+# A GET for a large range is answered by several DATA frames of at most
+# FRAME_SIZE bytes; the last one carries FLAG_LAST. Error replies carry a UTF-8
+# message as payload and are always the last frame of their request.
+#
+# MANIFEST returns the file's integrity manifest (block digests and whole-file
+# digest, see common/integrity.py) as one JSON payload.
+#
+# CATALOG returns one page of the file catalog as JSON. The request reuses the
+# GET fields: name is the last name of the previous page (empty for the first),
+# offset the generation the client already has (0 for everything) and length
+# the page size. The reply's "next" is the cursor for the following page.
+
+MAGIC = b'SKTP'
+VERSION = 1
+FORMAT = 'utf8'
+FRAME_SIZE = 1024 * 1024
+
+HELLO = struct.Struct("!4sB")
+REQUEST = struct.Struct("!BIQQH")
+RESPONSE = struct.Struct("!IBBQI")
+
+GET = 1
+LIST = 2
+BYE = 3
+MANIFEST = 4
+CATALOG = 5
+
+OK = 0
+NOT_FOUND = 1
+BAD_REQUEST = 2
+SERVER_ERROR = 3
+
+FLAG_LAST = 1
+
+STATUS_NAMES = {
+    OK: "OK",
+    NOT_FOUND: "NOT_FOUND",
+    BAD_REQUEST: "BAD_REQUEST",
+    SERVER_ERROR: "SERVER_ERROR",
+}
+
+class ProtocolError(Exception):
+    pass
+
+def pack_hello(version=VERSION):
+    return HELLO.pack(MAGIC, version)
+
+def unpack_hello(data):
+    magic, version = HELLO.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Peer does not speak the binary protocol")
+    return version
+
+def is_hello_prefix(data):
+    # True when data could be the start of a HELLO frame
+    prefix = data[:len(MAGIC)]
+    return len(prefix) > 0 and MAGIC.startswith(prefix)
+
+def pack_request(kind, request_id, name='', offset=0, length=0):
+    name = name.encode(FORMAT)
+    return REQUEST.pack(kind, request_id, offset, length, len(name)) + name
+
+def pack_response(request_id, status, offset=0, length=0, last=False):
+    return RESPONSE.pack(request_id, status, FLAG_LAST if last else 0, offset, length)
+
+def pack_error(request_id, status, message):
+    message = message.encode(FORMAT)
+    return pack_response(request_id, status, 0, len(message), last=True) + message
+
+class FrameReader:
+    # Buffered reads of exact sizes from a blocking socket
+
+    def __init__(self, sock, pending=b''):
+        self.sock = sock
+        self.pending = bytearray(pending)
+
+    def fill(self, size):
+        # Buffers at least size bytes; a timeout keeps what arrived for the next call
+        while len(self.pending) < size:
+            data = self.sock.recv(max(size - len(self.pending), 65536))
+            if not data:
+                raise ConnectionError("Connection closed by peer")
+            self.pending += data
+
+    def read_exact(self, size):
+        self.fill(size)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def read_into(self, view):
+        # Fill a memoryview completely, draining buffered bytes first
+        filled = min(len(self.pending), len(view))
+        if filled:
+            view[:filled] = self.pending[:filled]
+            del self.pending[:filled]
+        while filled < len(view):
+            n = self.sock.recv_into(view[filled:])
+            if not n:
+                raise ConnectionError("Connection closed by peer")
+            filled += n
+        return filled
+
+    def read_request(self):
+        # Nothing is consumed until the whole request is buffered, pending then holds exactly a partial frame
+        self.fill(REQUEST.size)
+        kind, request_id, offset, length, name_length = REQUEST.unpack_from(self.pending)
+        self.fill(REQUEST.size + name_length)
+        name = self.pending[REQUEST.size:REQUEST.size + name_length].decode(FORMAT)
+        del self.pending[:REQUEST.size + name_length]
+        return kind, request_id, name, offset, length
+
+    def read_response(self):
+        return RESPONSE.unpack(self.read_exact(RESPONSE.size))
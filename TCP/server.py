@@ -3,20 +3,52 @@ import os
 import json
 import threading
 import signal
+import asyncio
+import argparse
+import sys
+import time
 import psutil
+import protocol
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.integrity import ManifestCache
+from common.workers import run_workers, can_fork
+from common.blockcache import BlockCache
+from common.catalog import open_server_catalog, catalog_changed
+from common.serverstats import ServerStats
+from common.ratelimit import RateLimiter, parse_weights, SLICE, MB
 
 # Cấu hình server
 PORT = 65432
+# None: the Wi-Fi address if there is one, loopback otherwise
+HOST = None
 FILE_LIST = 'files.txt'
 FORMAT = 'utf8'
 SERVER_FILES = 'server_files'
 CHUNK_SIZE = 1024 * 1024 
-lock = threading.Lock()
+USE_SENDFILE = hasattr(os, 'sendfile')
+MAX_CONNECTIONS = 2048
+HIGH_WATER = 4 * CHUNK_SIZE
+LOW_WATER = CHUNK_SIZE
+DRAIN_TIMEOUT = 30
+LIST_GRACE = 0.5
+CACHE_BUDGET = 256 * 1024 * 1024
+CATALOG_INTERVAL = 5
+CATALOG_PAGE = 100
+MAX_CATALOG_PAGE = 1000
+STATS_PORT = None
+STATS_SOCKET = None
+STATS_INTERVAL = 10
 stop_flag = True
-
-os.makedirs(SERVER_FILES, exist_ok=True)
+# Per process; with --workers the parent adds up what each worker reports at exit
+stats = ServerStats()
+# Egress caps and the fair split between clients; with --workers each worker enforces its part of them
+limiter = RateLimiter()
 
 files = {}
+manifests = ManifestCache(SERVER_FILES)
+block_cache = None
+catalog = None
 
 def get_wireless_ip():
     wireless_ip = None
@@ -28,18 +60,14 @@ def get_wireless_ip():
                     break
     return wireless_ip
     
-def load_file_list():
+def open_catalog():
+    global catalog, files
+    catalog = open_server_catalog(SERVER_FILES, FILE_LIST, manifests)
+    files = catalog.sizes()
+
+def on_catalog_change():
     global files
-    with open(FILE_LIST, "r") as f:
-        for line in f:
-            name, size = line.strip().split()
-            if size.endswith("GB"):
-                size_in_bytes = int(size.replace("GB", "")) * 1024 * 1024 * 1024
-            elif size.endswith("MB"):
-                size_in_bytes = int(size.replace("MB", "")) * 1024 * 1024
-            else:
-                size_in_bytes = int(size)
-            files[name] = size_in_bytes
+    files = catalog_changed(catalog, manifests)
 
 def send_file_list(client_socket):
     try:
@@ -48,16 +76,29 @@ def send_file_list(client_socket):
     except Exception as e:
         print(f"Error sending file list: {e}")
 
-def send_file_chunk(client_socket, filename, chunk_index, chunk_size):
-    file_path = os.path.join(SERVER_FILES, filename)
+def open_served_file(open_files, filename):
+    # Each connection keeps its file descriptors open between chunk requests
+    file = open_files.get(filename)
+    if file is None:
+        file = open(os.path.join(SERVER_FILES, filename), 'rb')
+        open_files[filename] = file
+    return file
+
+def close_served_files(open_files):
+    for file in open_files.values():
+        try:
+            file.close()
+        except OSError:
+            pass
+    open_files.clear()
+
+def send_file_chunk(client_socket, filename, chunk_index, chunk_size, open_files=None, flow=None):
     try:
-        with open(file_path, 'rb') as file:
-            file.seek(chunk_index)
-            data = file.read(chunk_size)
-            if not data:
-                return 0
-            client_socket.sendall(data)
-        return len(data)
+        if open_files is None:
+            with open(os.path.join(SERVER_FILES, filename), 'rb') as file:
+                return send_range(client_socket, file, chunk_index, chunk_size, filename, flow=flow)
+        file = open_served_file(open_files, filename)
+        return send_range(client_socket, file, chunk_index, chunk_size, filename, flow=flow)
     except FileNotFoundError:
         print(f"File not found: {filename}")
         client_socket.sendall(b"File not found")
@@ -70,26 +111,114 @@ def send_file_chunk(client_socket, filename, chunk_index, chunk_size):
         print(f"Error sending file chunk: {e}")
         client_socket.sendall(f"Error: {str(e)}".encode(FORMAT))
         return 0
-        
+
+def send_range(client_socket, file, offset, size, filename=None, timed=False, flow=None):
+    # timed: split the time between getting the bytes and sending them, for sampled requests
+    if flow is not None:
+        # Rate limited: slice by slice, each after the wait the connection's flow asks for
+        sent = 0
+        while sent < size:
+            piece = min(SLICE, size - sent)
+            delay = flow.reserve(piece)
+            if delay:
+                time.sleep(delay)
+            piece_sent = send_range(client_socket, file, offset + sent, piece, filename, timed)
+            sent += piece_sent
+            if piece_sent < piece:
+                break
+        return sent
+    start = time.perf_counter() if timed else 0
+    disk = 0
+    if USE_SENDFILE:
+        # Zero-copy: the kernel moves the bytes from the page cache to the socket,
+        # reading the file happens inside sendfile and counts as sending
+        sent = client_socket.sendfile(file, offset, size)
+    elif block_cache is not None and filename is not None:
+        # Hot blocks are shared by every connection sending the same file
+        sent = 0
+        pieces = block_cache.pieces(filename, offset, size)
+        while True:
+            before = time.perf_counter() if timed else 0
+            piece = next(pieces, None)
+            if timed:
+                disk += time.perf_counter() - before
+            if piece is None:
+                break
+            client_socket.sendall(piece)
+            sent += len(piece)
+    else:
+        file.seek(offset)
+        data = file.read(size)
+        if timed:
+            disk = time.perf_counter() - start
+        if not data:
+            return 0
+        client_socket.sendall(data)
+        sent = len(data)
+    if timed:
+        stats.disk_time.add(disk)
+        stats.send_time.add(time.perf_counter() - start - disk)
+    return sent
+
+def parse_request(request):
+    parts = request.split()
+    if len(parts) != 3:
+        return None
+    file_name, chunk_index, chunk_size = parts
+    try:
+        return file_name, int(chunk_index), min(int(chunk_size), CHUNK_SIZE)
+    except ValueError:
+        return None
+
+def read_first_request(client_socket):
+    # Old clients open one connection and wait for the catalog without sending anything
+    client_socket.settimeout(LIST_GRACE)
+    try:
+        return client_socket.recv(1024)
+    except socket.timeout:
+        send_file_list(client_socket)
+        return b""
+    finally:
+        client_socket.settimeout(60)
+
 def handle_client(client_socket, address):
-    global stop_flag
     print(f"CONNECTED BY CLIENT ON {address}")
-    # send_file_list(client_socket)
-    client_socket.settimeout(60)
+    stats.connections.add()
+    stats.active.add()
+    open_files = {}
+    flow = limiter.flow(address[0])
+    try:
+        first_request = read_first_request(client_socket)
+        if protocol.is_hello_prefix(first_request):
+            handle_binary_client(client_socket, address, first_request, open_files, flow)
+        else:
+            handle_text_client(client_socket, address, first_request, open_files, flow)
+    except Exception as e:
+        print(f"Error handling request from {address}: {e}")
+
+    print("Client disconnected")
+    stats.active.add(-1)
+    if flow is not None:
+        flow.close()
+    close_served_files(open_files)
+    client_socket.close()
+
+def handle_text_client(client_socket, address, first_request, open_files, flow=None):
+    request = first_request.decode(FORMAT)
     while stop_flag:
         try:
-            request = client_socket.recv(1024).decode(FORMAT)
+            if request is None:
+                request = client_socket.recv(1024).decode(FORMAT)
             if not request:
                 break
 
-            parts = request.split()
-            if len(parts) != 3:
+            parsed = parse_request(request)
+            request = None
+            if parsed is None:
                 client_socket.sendall(b"Invalid request format !")
                 continue
 
-            file_name, chunk_index, chunk_size = parts
-            chunk_index = int(chunk_index)
-            chunk_size = min(int(chunk_size), CHUNK_SIZE)
+            file_name, chunk_index, chunk_size = parsed
 
             if file_name == 'DISCONNECT':
                 break
@@ -97,27 +226,327 @@ def handle_client(client_socket, address):
                 client_socket.sendall(b"Invalid file")
                 continue
 
-            print(f"Sending {file_name}")
-            total_size = os.path.getsize(os.path.join(SERVER_FILES, file_name))
-            bytes_sent = send_file_chunk(client_socket, file_name, chunk_index, chunk_size)
-
-            with lock:
-                if bytes_sent > 0:
-                    percentage = min((chunk_index + bytes_sent) / total_size * 100, 100)
-                    print(f"Sent {file_name} ... {percentage:.1f}%", end = '\r')
+            stats.requests.add()
+            try:
+                total_size = os.fstat(open_served_file(open_files, file_name).fileno()).st_size
+            except FileNotFoundError:
+                print(f"File not found: {file_name}")
+                client_socket.sendall(b"File not found")
+                continue
+            bytes_sent = send_file_chunk(client_socket, file_name, chunk_index, chunk_size, open_files, flow)
+            stats.sent(address[0], file_name, bytes_sent)
 
-                if chunk_index + bytes_sent >= total_size:
-                    print(f"\nFile sent: {file_name}")
-                    print("_______________________________")
-                    break
+            if chunk_index + bytes_sent >= total_size:
+                print(f"File sent: {file_name}")
+                break
         except socket.timeout:
             print(f"Connection with {address} timed out")
+            request = None
         except Exception as e:
             print(f"Error handling request from {address}: {e}")
             break
 
-    print(f"Client disconnected")
-    client_socket.close()
+def handle_binary_client(client_socket, address, first_request, open_files, flow=None):
+    reader = protocol.FrameReader(client_socket, first_request)
+    version = protocol.unpack_hello(reader.read_exact(protocol.HELLO.size))
+    client_socket.sendall(protocol.pack_hello(min(version, protocol.VERSION)))
+    while stop_flag:
+        try:
+            kind, request_id, name, offset, length = reader.read_request()
+        except socket.timeout:
+            if reader.pending:
+                # Stalled in the middle of a request
+                print(f"Connection with {address} timed out in the middle of a request")
+                break
+            continue
+
+        if kind == protocol.BYE:
+            break
+        elif kind == protocol.LIST:
+            data = json.dumps(files).encode()
+            client_socket.sendall(protocol.pack_response(request_id, protocol.OK, 0, len(data), last=True) + data)
+        elif kind == protocol.GET:
+            stats.requests.add()
+            stream_file_range(client_socket, address[0], request_id, name, offset, length, open_files, flow)
+        elif kind == protocol.MANIFEST:
+            client_socket.sendall(manifest_frame(request_id, name))
+        elif kind == protocol.CATALOG:
+            client_socket.sendall(catalog_frame(request_id, offset, name, length))
+        else:
+            client_socket.sendall(protocol.pack_error(request_id, protocol.BAD_REQUEST, f"Unknown request type {kind}"))
+
+def manifest_frame(request_id, filename):
+    if filename not in files:
+        return protocol.pack_error(request_id, protocol.NOT_FOUND, "Invalid file")
+    try:
+        manifest = manifests.get(filename)
+    except FileNotFoundError:
+        manifest = None
+    except OSError as e:
+        return protocol.pack_error(request_id, protocol.SERVER_ERROR, str(e))
+    if manifest is None:
+        print(f"File not found: {filename}")
+        return protocol.pack_error(request_id, protocol.NOT_FOUND, "File not found")
+    data = json.dumps(manifest).encode()
+    return protocol.pack_response(request_id, protocol.OK, 0, len(data), last=True) + data
+
+def catalog_frame(request_id, since, cursor, limit):
+    # A page of the catalog: cursor is the last name of the previous page, since the client's generation
+    limit = min(limit or CATALOG_PAGE, MAX_CATALOG_PAGE)
+    data = json.dumps(catalog.listing(since, cursor, limit)).encode()
+    return protocol.pack_response(request_id, protocol.OK, 0, len(data), last=True) + data
+
+def check_range(request_id, filename, offset, length, open_files):
+    # Returns (file, end, total_size) or an error frame for the client
+    if filename not in files:
+        return None, protocol.pack_error(request_id, protocol.NOT_FOUND, "Invalid file")
+    try:
+        file = open_served_file(open_files, filename)
+    except FileNotFoundError:
+        print(f"File not found: {filename}")
+        return None, protocol.pack_error(request_id, protocol.NOT_FOUND, "File not found")
+    total_size = os.fstat(file.fileno()).st_size
+    return (file, min(offset + length, total_size), total_size), None
+
+def stream_file_range(client_socket, host, request_id, filename, offset, length, open_files, flow=None):
+    timed = stats.sampled()
+    request_start = time.perf_counter() if timed else 0
+    checked, error = check_range(request_id, filename, offset, length, open_files)
+    if error:
+        client_socket.sendall(error)
+        return 0
+    file, end, total_size = checked
+    if offset >= end:
+        client_socket.sendall(protocol.pack_response(request_id, protocol.OK, offset, 0, last=True))
+        return 0
+
+    start = offset
+    while offset < end:
+        size = min(protocol.FRAME_SIZE, end - offset)
+        client_socket.sendall(protocol.pack_response(request_id, protocol.OK, offset, size, last=offset + size >= end))
+        if send_range(client_socket, file, offset, size, filename, timed, flow) != size:
+            # The frame header already promised size bytes, the stream can't be resynced
+            raise ConnectionError(f"{filename} changed while it was being sent")
+        if timed and offset == start:
+            stats.first_byte.observe(time.perf_counter() - request_start)
+        offset += size
+    stats.sent(host, filename, offset - start)
+    if timed:
+        stats.request_time.observe(time.perf_counter() - request_start)
+    if end >= total_size:
+        print(f"File sent: {filename}")
+    return offset - start
+
+async def send_file_chunk_async(writer, filename, chunk_index, chunk_size, open_files, timed=False, flow=None):
+    # Sending includes waiting for the client to drain the write buffer
+    if flow is not None:
+        # Rate limited: slice by slice, each after the wait the connection's flow asks for
+        sent = 0
+        while sent < chunk_size:
+            piece = min(SLICE, chunk_size - sent)
+            delay = flow.reserve(piece)
+            if delay:
+                await asyncio.sleep(delay)
+            piece_sent = await send_file_chunk_async(writer, filename, chunk_index + sent, piece, open_files, timed)
+            sent += piece_sent
+            if piece_sent < piece:
+                break
+        return sent
+    file = open_served_file(open_files, filename)
+    start = time.perf_counter() if timed else 0
+    disk = 0
+    if USE_SENDFILE:
+        # loop.sendfile waits for the write buffer to empty, then hands the range to the kernel
+        sent = await asyncio.get_running_loop().sendfile(writer.transport, file, chunk_index, chunk_size)
+    elif block_cache is not None:
+        sent = 0
+        pieces = block_cache.pieces(filename, chunk_index, chunk_size)
+        while True:
+            before = time.perf_counter() if timed else 0
+            piece = next(pieces, None)
+            if timed:
+                disk += time.perf_counter() - before
+            if piece is None:
+                break
+            writer.write(piece)
+            await writer.drain()
+            sent += len(piece)
+    else:
+        file.seek(chunk_index)
+        data = file.read(chunk_size)
+        if timed:
+            disk = time.perf_counter() - start
+        writer.write(data)
+        await writer.drain()
+        sent = len(data)
+    if timed:
+        stats.disk_time.add(disk)
+        stats.send_time.add(time.perf_counter() - start - disk)
+    return sent
+
+async def read_exact_async(reader, pending, size):
+    if len(pending) < size:
+        pending += await reader.readexactly(size - len(pending))
+    data = bytes(pending[:size])
+    del pending[:size]
+    return data
+
+async def handle_client_async(reader, writer, state):
+    address = writer.get_extra_info('peername')
+    # Connections past the cap wait here; their requests stay in the kernel buffers
+    async with state['slots']:
+        print(f"CONNECTED BY CLIENT ON {address}")
+        stats.connections.add()
+        stats.active.add()
+        writer.transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        open_files = {}
+        flow = limiter.flow(address[0])
+        try:
+            try:
+                first_request = await asyncio.wait_for(reader.read(1024), timeout=LIST_GRACE)
+            except asyncio.TimeoutError:
+                writer.write(json.dumps(files).encode())
+                first_request = b""
+            if protocol.is_hello_prefix(first_request):
+                await handle_binary_client_async(reader, writer, address, bytearray(first_request), open_files, flow)
+            else:
+                await handle_text_client_async(reader, writer, address, first_request, open_files, flow)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            print(f"Error handling request from {address}: {e}")
+        finally:
+            stats.active.add(-1)
+            if flow is not None:
+                flow.close()
+            close_served_files(open_files)
+            writer.close()
+            print("Client disconnected")
+
+async def handle_text_client_async(reader, writer, address, request, open_files, flow=None):
+    while True:
+        if request is None:
+            try:
+                request = await asyncio.wait_for(reader.read(1024), timeout=60)
+            except asyncio.TimeoutError:
+                print(f"Connection with {address} timed out")
+                break
+        if not request:
+            break
+
+        parsed = parse_request(request.decode(FORMAT))
+        request = None
+        if parsed is None:
+            writer.write(b"Invalid request format !")
+            await writer.drain()
+            continue
+
+        file_name, chunk_index, chunk_size = parsed
+        if file_name == 'DISCONNECT':
+            break
+        if file_name not in files:
+            writer.write(b"Invalid file")
+            await writer.drain()
+            continue
+
+        stats.requests.add()
+        try:
+            total_size = os.fstat(open_served_file(open_files, file_name).fileno()).st_size
+            bytes_sent = await send_file_chunk_async(writer, file_name, chunk_index, chunk_size, open_files, flow=flow)
+            stats.sent(address[0], file_name, bytes_sent)
+        except FileNotFoundError:
+            print(f"File not found: {file_name}")
+            writer.write(b"File not found")
+            await writer.drain()
+            continue
+
+        if chunk_index + bytes_sent >= total_size:
+            print(f"File sent: {file_name}")
+            break
+
+async def handle_binary_client_async(reader, writer, address, pending, open_files, flow=None):
+    version = protocol.unpack_hello(await read_exact_async(reader, pending, protocol.HELLO.size))
+    writer.write(protocol.pack_hello(min(version, protocol.VERSION)))
+    while True:
+        header = await read_exact_async(reader, pending, protocol.REQUEST.size)
+        kind, request_id, offset, length, name_length = protocol.REQUEST.unpack(header)
+        name = (await read_exact_async(reader, pending, name_length)).decode(FORMAT)
+
+        if kind == protocol.BYE:
+            break
+        elif kind == protocol.LIST:
+            data = json.dumps(files).encode()
+            writer.write(protocol.pack_response(request_id, protocol.OK, 0, len(data), last=True) + data)
+        elif kind == protocol.GET:
+            stats.requests.add()
+            await stream_file_range_async(writer, address[0], request_id, name, offset, length, open_files, flow)
+        elif kind == protocol.MANIFEST:
+            # Hashing a large file the first time must not stall the other connections
+            frame = await asyncio.get_running_loop().run_in_executor(None, manifest_frame, request_id, name)
+            writer.write(frame)
+        elif kind == protocol.CATALOG:
+            writer.write(catalog_frame(request_id, offset, name, length))
+        else:
+            writer.write(protocol.pack_error(request_id, protocol.BAD_REQUEST, f"Unknown request type {kind}"))
+        await writer.drain()
+
+async def stream_file_range_async(writer, host, request_id, filename, offset, length, open_files, flow=None):
+    timed = stats.sampled()
+    request_start = time.perf_counter() if timed else 0
+    checked, error = check_range(request_id, filename, offset, length, open_files)
+    if error:
+        writer.write(error)
+        return 0
+    file, end, total_size = checked
+    if offset >= end:
+        writer.write(protocol.pack_response(request_id, protocol.OK, offset, 0, last=True))
+        return 0
+
+    start = offset
+    while offset < end:
+        size = min(protocol.FRAME_SIZE, end - offset)
+        writer.write(protocol.pack_response(request_id, protocol.OK, offset, size, last=offset + size >= end))
+        if await send_file_chunk_async(writer, filename, offset, size, open_files, timed, flow) != size:
+            raise ConnectionError(f"{filename} changed while it was being sent")
+        if timed and offset == start:
+            stats.first_byte.observe(time.perf_counter() - request_start)
+        offset += size
+    stats.sent(host, filename, offset - start)
+    if timed:
+        stats.request_time.observe(time.perf_counter() - request_start)
+    if end >= total_size:
+        print(f"File sent: {filename}")
+    return offset - start
+
+async def serve_async(host, reuse_port=False):
+    state = {'slots': asyncio.Semaphore(MAX_CONNECTIONS)}
+    tasks = set()
+    draining = asyncio.Event()
+
+    def on_connect(reader, writer):
+        task = asyncio.ensure_future(handle_client_async(reader, writer, state))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    server = await asyncio.start_server(on_connect, host, PORT, reuse_address=True, reuse_port=reuse_port or None, backlog=1024)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, draining.set)
+        except NotImplementedError:
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(draining.set))
+
+    print(f"Server is ready for connecting on {host}:{PORT} (async, max {MAX_CONNECTIONS} connections)")
+    await draining.wait()
+
+    # Stop accepting, let the open range streams finish, then cut off whatever is left
+    print(f"\nDraining {len(tasks)} connections...")
+    server.close()
+    await server.wait_closed()
+    if tasks:
+        done, pending = await asyncio.wait(set(tasks), timeout=DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    print("Shutting down server...")
 
 def signal_handler(sig, frame):
     global stop_flag
@@ -125,31 +554,80 @@ def signal_handler(sig, frame):
     stop_flag = False
     exit(0)
 
-def start_server():
-    global stop_flag
-    SERVER_IP = get_wireless_ip() or '127.0.0.1'
+def start_server(mode='thread', workers=1):
+    global block_cache
+    SERVER_IP = HOST or get_wireless_ip() or '127.0.0.1'
+    os.makedirs(SERVER_FILES, exist_ok=True)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-        
-    load_file_list()
+    # Loaded once; forked workers inherit the catalog and the manifests
+    open_catalog()
+    precompute = manifests.precompute(list(files))
+    if workers > 1:
+        # No thread may be holding a lock when the workers fork
+        precompute.join()
+
+    if CACHE_BUDGET > 0 and not USE_SENDFILE:
+        # With sendfile the kernel already serves from the page cache without a copy
+        block_cache = BlockCache(SERVER_FILES, CACHE_BUDGET)
+
+    reuse_port = workers > 1 and can_fork()
+    if reuse_port:
+        # Every worker keeps buckets of its own
+        limiter.split(workers)
 
     print(f"Server IP address: {SERVER_IP}")
     print(f"Server port: {PORT}")
+    if limiter.enabled() and limiter.path is None:
+        # Limits from a file are printed as they are read
+        print(f"Rate limits: {limiter.describe()}")
+
+    totals = run_workers(workers, lambda worker: serve(SERVER_IP, mode, worker, reuse_port), collect_stats)
+    if workers > 1:
+        print(f"{workers} workers served {totals.get('connections', 0)} connections, "
+              f"{totals.get('requests', 0)} requests, {totals.get('bytes_sent', 0) / (1024 * 1024):.1f} MB")
+    if block_cache is not None:
+        print(f"Block cache: {totals.get('cache_hits', 0)} hits, {totals.get('cache_misses', 0)} misses, "
+              f"{totals.get('cache_coalesced', 0)} coalesced, {totals.get('cache_evictions', 0)} evictions")
+
+def collect_stats():
+    collected = stats.counts()
+    if block_cache is not None:
+        for key, value in block_cache.snapshot().items():
+            collected['cache_' + key] = value
+    return collected
+
+def serve(host, mode, worker, reuse_port):
+    label = ''
+    stats_port = STATS_PORT
+    stats_socket = STATS_SOCKET
+    if reuse_port:
+        print(f"Worker {worker} started (pid {os.getpid()})")
+        # Every worker has its own stats, on its own endpoint
+        label = f"[worker {worker}] "
+        stats_port = STATS_PORT + worker if STATS_PORT is not None else None
+        stats_socket = f"{STATS_SOCKET}.{worker}" if STATS_SOCKET is not None else None
+    catalog.watch(CATALOG_INTERVAL, on_catalog_change)
+    stats.start(STATS_INTERVAL, stats_port, stats_socket, label)
+    limiter.watch(label=label)
+    if mode == 'async':
+        asyncio.run(serve_async(host, reuse_port))
+        return
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Every worker listens on the same port, the kernel balances new connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.settimeout(1)
-        server_socket.bind((SERVER_IP, PORT))
+        server_socket.bind((host, PORT))
         server_socket.listen()
-        print(f"Server is ready for connecting on {SERVER_IP}:{PORT}")
-        # send_file_list(server_socket)
-        sentFileList = True
+        print(f"Server is ready for connecting on {host}:{PORT}")
         while stop_flag:
             try:
                 client_socket, addr = server_socket.accept()
-                if sentFileList:
-                    send_file_list(client_socket)
-                    sentFileList = False
                 client_thread = threading.Thread(target=handle_client, args=(client_socket, addr))
                 client_thread.start()
             except socket.timeout:
@@ -157,6 +635,57 @@ def start_server():
             except Exception as e:
                 print(f"Error accepting connection: {e}")
 
+def parse_args():
+    global HOST, PORT, MAX_CONNECTIONS, HIGH_WATER, LOW_WATER, CACHE_BUDGET, USE_SENDFILE, STATS_PORT, STATS_SOCKET, STATS_INTERVAL
+    parser = argparse.ArgumentParser(description="TCP file server")
+    parser.add_argument('--host', default=HOST, help="address to listen on, the Wi-Fi address by default")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                        help="thread-per-connection or single-threaded asyncio event loop")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="async mode: connections served at once, the rest wait in line")
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER,
+                        help="async mode: write buffer size that pauses a stream")
+    parser.add_argument('--low-water', type=int, default=LOW_WATER,
+                        help="async mode: write buffer size that resumes a stream")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes sharing the port through SO_REUSEPORT, each running --mode")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BUDGET // (1024 * 1024),
+                        help="memory for hot file blocks when sendfile isn't used, 0 turns the cache off")
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help="send from user space (through the block cache) instead of sendfile")
+    parser.add_argument('--max-rate', type=float, default=0, help="MB/s the server sends at most, shared fairly between clients")
+    parser.add_argument('--client-rate', type=float, default=0, help="MB/s at most to one client address")
+    parser.add_argument('--connection-rate', type=float, default=0, help="MB/s at most on one connection")
+    parser.add_argument('--client-weight', action='append', default=[], metavar='HOST=WEIGHT',
+                        help="share of the --max-rate a client gets next to the others (1 by default), repeatable")
+    parser.add_argument('--limits', default=None,
+                        help="JSON file with the limits, followed while the server runs: "
+                             "{\"total\": MB/s, \"client\": MB/s, \"connection\": MB/s, \"weights\": {host: weight}}")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="serve /metrics and /metrics.json on this local port (plus the worker number with --workers)")
+    parser.add_argument('--stats-socket', default=None,
+                        help="serve the same on this Unix socket path (plus .worker with --workers)")
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help="seconds between summary lines, 0 prints none")
+    parser.add_argument('--stats-sample', type=float, default=stats.sample_rate,
+                        help="fraction of requests timed for the latency and disk/send figures")
+    args = parser.parse_args()
+    HOST = args.host
+    PORT = args.port
+    STATS_PORT = args.stats_port
+    STATS_SOCKET = args.stats_socket
+    STATS_INTERVAL = args.stats_interval
+    stats.sample_rate = args.stats_sample
+    CACHE_BUDGET = args.cache_mb * 1024 * 1024
+    USE_SENDFILE = USE_SENDFILE and not args.no_sendfile
+    MAX_CONNECTIONS = args.max_connections
+    HIGH_WATER = args.high_water
+    LOW_WATER = args.low_water
+    limiter.path = args.limits
+    limiter.configure(args.max_rate * MB, args.client_rate * MB, args.connection_rate * MB, parse_weights(args.client_weight))
+    return args
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    args = parse_args()
+    start_server(args.mode, args.workers)
\ No newline at end of file
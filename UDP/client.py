@@ -1,127 +1,687 @@
 import socket
 import os
+import json
 import struct
 import signal
 import time
+import random
+import argparse
+import sys
 import threading
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.congestion import RttEstimator
+from common import integrity
+from common import delta
+from common.fileio import read_at, write_at
+from common.inputwatch import InputWatcher
+from common.metrics import Registry
+from common.progress import ProgressView
+
 SERVER_PORT = 65432
 CHUNK_SIZE = 60 * 1024
 FORMAT = 'utf-8'
 OUTPUT_FOLDER = 'UDP/downloads'
 INPUT_FILE = 'UDP/input.txt'
-FILE_LIST = 'files.txt'
 TIMEOUT = 2
-last_display_time = 0
+MIN_TIMEOUT = 0.2
+MAX_TIMEOUTS = 10
+WINDOW_SIZE = 32
+RECV_BUFFER = 4 * 1024 * 1024
+SEND_BUFFER = 256 * 1024
+REQUEST = struct.Struct("!I256sQQH")
+SACK = struct.Struct("!IIQ")
+HEADER = struct.Struct("!III")
+FEC_REQUEST = struct.Struct("!I256sQQHH")
+PARITY = struct.Struct("!IIIH")
+PARITY_FLAG = 0x80000000
+# REQX: REQW plus the chunk size and the parity group size (NO_PARITY: none); only to servers that answer PMTU
+SIZED_REQUEST = struct.Struct("!I256sQQHHH")
+NO_PARITY = 0xFFFF
+PROBE = struct.Struct("!H")
+# Datagram sizes probed: the largest the server sends, jumbo frames, Ethernet, the IPv6 minimum MTU
+PROBE_SIZES = (CHUNK_SIZE + PARITY.size, 8972, 1472, 1232)
+# What is trusted without a way to keep probes from being fragmented
+SAFE_DATAGRAM = 1232
+# Linux / Windows values, not every Python names them
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_DONTFRAGMENT = getattr(socket, 'IP_DONTFRAGMENT', 14)
+# UDP GRO (Linux): one read returns a run of datagrams from the same sender, up to 64 KB
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+USE_GRO = sys.platform.startswith('linux') and hasattr(socket.socket, 'recvmsg_into')
+SACK_BITS = 64
+# Longest bitmap a SACK carries, bits past SACK_BITS in bytes after the fixed part
+MAX_SACK_BITS = 8192
+# received[] as the digits of the bitmap
+BITS = bytes.maketrans(b'\x00\x01', b'01')
+MANIFEST_REQUEST = struct.Struct("!I256s")
+CATALOG_REQUEST = struct.Struct("!QH256s")
+# Appended to MANF and CATL: the largest reply we take, so no reply is fragmented
+REPLY_SIZE = struct.Struct("!H")
+CATALOG_PAGE = 100
+CATALOG_REFRESH = 5
+MAX_REFETCHES = 3
+# Like the TCP client: up to 4 sessions per file, each on a socket of its own with a disjoint range
+NUM_STREAMS = 4
+MIN_STREAM_SIZE = 1024 * 1024
+O_BINARY = getattr(os, 'O_BINARY', 0)
+# Parity group size asked of the server: None for no parity, 0 to let it follow the loss
+FEC = None
+# Chunk size to ask for instead of probing (--payload), and the one settled on: None for servers without REQX
+PAYLOAD = None
+chunk_size = None
+catalog_generation = 0
+last_catalog_refresh = 0
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 files = {}
-download_status = {}
+# Lock-free counters of every download; read by the progress view and the --metrics-port exporter
+metrics = Registry()
 stop_flag = False
-lock = threading.Lock()
+# RTO of the path as last measured: later requests are retried after about a round trip instead of TIMEOUT
+path_rto = TIMEOUT
+# Catalog and manifest requests; the data of every download comes in on sockets of its own
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-def calculate_checksum(data):
-    return sum(data) % (2**32)
+def learn_rtt(seconds):
+    # A request answered on the first try times the path for the requests after it
+    global path_rto
+    rtt = RttEstimator(min_rto=MIN_TIMEOUT)
+    rtt.sample(seconds)
+    path_rto = rtt.rto
 
-def load_file_list():
-    global files
-    with open(FILE_LIST, "r") as f:
-        for line in f:
-            name, size = line.strip().split()
-            if size.endswith("GB"):
-                size_in_bytes = int(size.replace("GB", "")) * 1024 * 1024 * 1024
-            elif size.endswith("MB"):
-                size_in_bytes = int(size.replace("MB", "")) * 1024 * 1024
-            else:
-                size_in_bytes = int(size)
-            files[name] = size_in_bytes
-
-def display_progress():
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("Available file: ")
-    print("__________________")
-    for filename, size in files.items():
-        print(f"{filename}: {size / (1024 * 1024):.2f} MB")
-    print("__________________")
-    print("\nDownload Status: ")
-    for filename, progress in download_status.items():
-        if progress < 100:
-            print(f"Downloading {filename} .... {progress}%")
+def set_buffer_sizes(recv_buffer, send_buffer):
+    # A whole window can arrive back to back, give the kernel room to queue it
+    global RECV_BUFFER, SEND_BUFFER
+    RECV_BUFFER, SEND_BUFFER = recv_buffer, send_buffer
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+
+set_buffer_sizes(RECV_BUFFER, SEND_BUFFER)
+
+def open_stream_socket():
+    # A new local port: the server keeps a separate session, with its own window, per address
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+    enable_gro(sock)
+    return sock
+
+def enable_gro(sock):
+    # Small chunks arrive a batch per read instead of one per call
+    global USE_GRO
+    if USE_GRO:
+        try:
+            sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            USE_GRO = False
+
+def set_dont_fragment(sock):
+    # Probes that may be fragmented on the way would make every size look like it fits
+    try:
+        if sys.platform.startswith('linux'):
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        elif sys.platform == 'win32':
+            sock.setsockopt(socket.IPPROTO_IP, IP_DONTFRAGMENT, 1)
         else:
-            print(f"Downloaded {filename}")
+            return False
+        return True
+    except OSError:
+        return False
 
-def check_input_file(server_host):
-    last_motified = 0
-    while not stop_flag:
+def negotiate_payload(server_ip):
+    # Largest chunk whose datagrams reach the server without being fragmented, from probes sent with
+    # fragmentation off; the path back is taken to be the same. Servers that don't answer probes
+    # get the fixed CHUNK_SIZE, asked for the old way
+    global chunk_size
+    server_address = (server_ip, SERVER_PORT)
+    dont_fragment = set_dont_fragment(client_socket)
+    if PAYLOAD is not None:
+        sizes = [PAYLOAD + PARITY.size]
+    elif dont_fragment or server_ip.startswith('127.') or server_ip == 'localhost':
+        sizes = list(PROBE_SIZES)
+    else:
+        sizes = [size for size in PROBE_SIZES if size <= SAFE_DATAGRAM]
+    best = 0
+    for attempt in range(2):
+        pending = []
+        for size in sizes:
+            if size <= best:
+                continue
+            probe = bytearray(size)
+            probe[:4] = b'PMTU'
+            PROBE.pack_into(probe, 4, size)
+            try:
+                client_socket.sendto(probe, server_address)
+                pending.append(size)
+            except OSError:
+                # Bigger than the link we are on already (EMSGSIZE)
+                continue
+        if not pending:
+            break
+        deadline = time.monotonic() + min(TIMEOUT, 2 * path_rto)
+        while best < max(pending):
+            try:
+                reply = receive_control(server_address, deadline - time.monotonic(), replies=(b'PMTU',))
+                best = max(best, PROBE.unpack_from(reply, 4)[0])
+            except socket.timeout:
+                break
+            except struct.error:
+                continue
+    if best:
+        chunk_size = min(best - PARITY.size, CHUNK_SIZE)
+        print(f"Datagrams of {best} bytes reach the server, asking for {chunk_size} byte chunks")
+    else:
+        chunk_size = None
+        print(f"Server doesn't answer payload probes, using {CHUNK_SIZE} byte chunks")
+
+def reply_size():
+    # A chunk once the path is probed, before that what every path carries
+    return chunk_size or SAFE_DATAGRAM - HEADER.size
+
+def request_catalog(server_address, since=0):
+    # Every CATL page of what changed after generation since (0: the whole catalog); None if the server has no catalog
+    entries = []
+    cursor = ''
+    attempts = 0
+    while True:
+        if stop_flag or attempts > 2:
+            return None
+        request = CATALOG_REQUEST.pack(since, CATALOG_PAGE, cursor.encode(FORMAT)) + REPLY_SIZE.pack(reply_size())
+        client_socket.sendto(b'CATL' + request, server_address)
+        sent = time.monotonic()
         try:
-            mtime = os.path.getmtime(INPUT_FILE)
-            if mtime - last_motified >= 5:
-                last_motified = mtime
-                with open(INPUT_FILE, "r") as file:
-                    lines = file.readlines()
-                with lock:
-                    for filename in lines:
-                        filename = filename.strip()
-                        if filename not in download_status:
-                            download_status[filename] = 0
-                            download_file(server_host, filename)
-        except FileNotFoundError:
-            pass
-        time.sleep(1)
+            reply = receive_control(server_address, TIMEOUT)
+        except socket.timeout:
+            attempts += 1
+            continue
+        if attempts == 0:
+            learn_rtt(time.monotonic() - sent)
+        if not reply.startswith(b'CATL'):
+            return None
+        page = json.loads(reply[4:].decode(FORMAT))
+        if cursor == '':
+            first = page
+            if page['full']:
+                # Also the answer to a delta too long for one page; the pages after it follow suit
+                since = 0
+        entries += page['entries']
+        cursor = page['next']
+        attempts = 0
+        if cursor is None:
+            first['entries'] = entries
+            return first
 
-def download_file(server_ip, filename):
-    client_socket.sendto(b'LIST', (server_ip, SERVER_PORT))
-    bytes_received = 0
-    chunk_index = 0
-
-    file_path = os.path.join('server_files', filename)
-    file_size = os.path.getsize(os.path.join(file_path))
-    # file_size = int(files[filename])
-    with open(os.path.join(OUTPUT_FOLDER, filename), 'wb') as file:
+def apply_catalog(listing):
+    global files, catalog_generation
+    updated = {} if listing['full'] else dict(files)
+    for name in listing['removed']:
+        updated.pop(name, None)
+    for entry in listing['entries']:
+        updated[entry['name']] = entry['size']
+    files = updated
+    catalog_generation = max(catalog_generation, listing['generation'])
+
+def get_file_list(server_ip):
+    global files
+    server_address = (server_ip, SERVER_PORT)
+    listing = request_catalog(server_address)
+    if listing is not None:
+        apply_catalog(listing)
+        return
+    # A server without the catalog request still answers LIST with the whole list
+    for _ in range(MAX_TIMEOUTS):
+        client_socket.sendto(b'LIST', server_address)
+        try:
+            reply = receive_control(server_address, TIMEOUT)
+        except socket.timeout:
+            continue
+        if reply.startswith(b'{'):
+            files = json.loads(reply.decode(FORMAT))
+            return
+    print("Could not get the file list from the server")
+
+def refresh_catalog(server_ip):
+    # Only what changed since the generation we already have
+    global last_catalog_refresh
+    if time.monotonic() - last_catalog_refresh < CATALOG_REFRESH:
+        return False
+    last_catalog_refresh = time.monotonic()
+    listing = request_catalog((server_ip, SERVER_PORT), catalog_generation)
+    if listing is None:
+        return False
+    apply_catalog(listing)
+    return bool(listing['entries'] or listing['removed'])
+
+def check_input_file(server_host, exit_when_done=False):
+    # Only the names appended to input.txt are read; each one is downloaded once, in order
+    watcher = InputWatcher(INPUT_FILE)
+    waiting = []
+    try:
         while not stop_flag:
-            request = b'REQF' + struct.pack("!256sI", filename.encode(FORMAT), bytes_received)
-            client_socket.sendto(request, (server_ip, SERVER_PORT))
+            new_names = watcher.new_names()
+            waiting += new_names
+            changed = bool(new_names)
+            if any(name not in files for name in waiting):
+                # Maybe added on the server since we got the catalog
+                changed = refresh_catalog(server_host) or changed
+            ready = [name for name in waiting if name in files] if changed else []
+            if ready:
+                waiting = [name for name in waiting if name not in files]
+                for filename in ready:
+                    metrics.transfer(filename, files[filename])
+                for filename in ready:
+                    if stop_flag:
+                        break
+                    download_file(server_host, filename)
+            if exit_when_done and waiting:
+                # A scripted run doesn't wait for the server to publish a name it doesn't have
+                for filename in waiting:
+                    print(f"{filename} is not on the server, skipping it")
+                    metrics.transfer(filename).finish(False)
+                waiting = []
+            if exit_when_done and not waiting and metrics.transfers:
+                # Downloads run one at a time here, so every one named so far is over
+                break
+            watcher.wait()
+    finally:
+        watcher.close()
 
-            try:
-                packet, _ = client_socket.recvfrom(CHUNK_SIZE + 8)
-                if len(packet) < 8:
-                    print("Received incomplete packet. Retrying...")
-                    continue
-                sequence_number, checksum = struct.unpack("!II", packet[:8])
-                data = packet[8:]
-                
-                if checksum != calculate_checksum(data):
-                    print(f"Checksum mismatch for chunk {sequence_number}. Retrying...")
-                    continue
-                
-                if sequence_number == chunk_index:
-                    file.write(data)
-                    bytes_received += len(data)
-                    # print(f"Received chunk {sequence_number}, size: {len(data)} bytes")
-                    chunk_index += 1
-
-                    progress = int(bytes_received / file_size * 100)
-                    download_status[filename] = progress
-
-                    global last_display_time
-                    current_time = time.time()
-                    if current_time - last_display_time >= 0.8:
-                        last_display_time = current_time
-                        display_progress()
-
-                ack = struct.pack("!I", sequence_number)
-                client_socket.sendto(ack, (server_ip, SERVER_PORT))
-
-                if len(data) < CHUNK_SIZE:
-                    print(f"Download {filename} complete!")
-                    download_status[filename] = 100
-                    display_progress()
-                    break
-            except Exception as e:
-                print(f"Error downloading file: {e}")
+def make_sack(sack, transfer_id, received, cumulative):
+    # Packs into the caller's buffer, one SACK goes out per read of data packets.
+    # Only as long as the last chunk received after cumulative needs it to be
+    last = received.rfind(1, cumulative + 1, cumulative + 1 + MAX_SACK_BITS)
+    bitmap = int(received[cumulative + 1:last + 1][::-1].translate(BITS), 2) if last > cumulative else 0
+    SACK.pack_into(sack, 4, transfer_id, cumulative, bitmap & (1 << SACK_BITS) - 1)
+    extra = max(0, bitmap.bit_length() - SACK_BITS + 7) // 8
+    end = 4 + SACK.size + extra
+    sack[4 + SACK.size:end] = (bitmap >> SACK_BITS).to_bytes(extra, 'little')
+    return memoryview(sack)[:end]
+
+def new_sack_buffer():
+    sack = bytearray(4 + SACK.size + (MAX_SACK_BITS - SACK_BITS) // 8)
+    sack[:4] = b'SACK'
+    return sack
+
+def fetch_manifest(server_address, filename):
+    # Block digests of the file, one MANF reply per page; None if the server has none
+    blocks = []
+    weak = []
+    manifest = None
+    page = 0
+    attempts = 0
+    while manifest is None or page < manifest['pages']:
+        if stop_flag or attempts > MAX_TIMEOUTS:
+            return None
+        request = MANIFEST_REQUEST.pack(page, filename.encode(FORMAT)) + REPLY_SIZE.pack(reply_size())
+        client_socket.sendto(b'MANF' + request, server_address)
+        try:
+            reply = receive_control(server_address, min(TIMEOUT, path_rto * 2 ** attempts))
+        except socket.timeout:
+            attempts += 1
+            continue
+        if reply.startswith(b'BUSY'):
+            # The server is still hashing the file
+            attempts += 1
+            time.sleep(0.5)
+            continue
+        if not reply.startswith(b'MANF'):
+            print(f"No manifest for {filename}: {reply.decode(FORMAT, 'replace')}")
+            return None
+        data = json.loads(reply[4:].decode(FORMAT))
+        if data['page'] != page:
+            continue
+        manifest = data
+        blocks += data['blocks']
+        weak += data.get('weak', [])
+        page += 1
+        attempts = 0
+    manifest['blocks'] = blocks
+    manifest['weak'] = weak
+    if not integrity.check_manifest(manifest):
+        print(f"Manifest of {filename} doesn't match its own digest, ignoring it")
+        return None
+    return manifest
+
+def receive_control(server_address, timeout, sock=None, replies=(b'MANF', b'CATL', b'BUSY', b'ERRO', b'{')):
+    # Next reply that isn't a stray data packet of an earlier transfer; LIST replies are bare JSON
+    sock = sock or client_socket
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout()
+        sock.settimeout(remaining)
+        packet, address = sock.recvfrom(65536)
+        if address == server_address and packet.startswith(replies):
+            return packet
+
+def verify_block(fd, manifest, index):
+    start, end = integrity.block_range(manifest, index)
+    return integrity.verify_block(manifest, index, read_at(fd, start, end - start))
+
+def split_ranges(file_size, manifest=None):
+    # Disjoint ranges for the streams, cut on block boundaries so every block is checked by one stream
+    unit = manifest['block_size'] if manifest is not None else CHUNK_SIZE
+    streams = max(1, min(NUM_STREAMS, file_size // MIN_STREAM_SIZE))
+    if file_size == 0:
+        return [(0, 0)]
+    units = -(-file_size // unit)
+    streams = min(streams, units)
+    cuts = [min(i * units // streams * unit, file_size) for i in range(streams + 1)]
+    return list(zip(cuts, cuts[1:]))
+
+def plan_streams(ranges, manifest):
+    # The missing ranges of a delta download spread over the streams, as lists of block-aligned pieces
+    total = sum(end - start for start, end in ranges)
+    if not total:
+        return []
+    unit = manifest['block_size']
+    streams = max(1, min(NUM_STREAMS, total // MIN_STREAM_SIZE))
+    units = -(-total // unit)
+    piece_size = -(-units // streams) * unit
+    pieces = [(position, min(position + piece_size, end)) for start, end in ranges
+              for position in range(start, end, piece_size)]
+    plans = [[] for _ in range(streams)]
+    loads = [0] * streams
+    for start, end in sorted(pieces, key=lambda piece: piece[0] - piece[1]):
+        i = loads.index(min(loads))
+        plans[i].append((start, end))
+        loads[i] += end - start
+    return [sorted(plan) for plan in plans if plan]
+
+def receive_range(sock, server_address, filename, fd, start, end, part_number=0, manifest=None,
+                  verified=None, bad=None, contiguous=None, fec=None, slot=None):
+    # One selective-repeat transfer of [start, end); blocks of the manifest are checked as they fill up.
+    # contiguous[slot] (part_number by default) follows how much of the range is complete from its start,
+    # for the progress.
+    # With fec the server adds a parity packet per group of chunks and one loss per group is rebuilt here
+    # The transfer id lets the server tell this download apart from any other on the same address
+    transfer_id = random.getrandbits(32)
+    transfer = metrics.transfer(filename)
+    part = transfer.part(part_number)
+    rebuilt = metrics.counter('fec_rebuilt_chunks_total')
+    # Learned from how long the first packet takes to show up, backed off while nothing arrives
+    rtt = RttEstimator(initial_rto=path_rto, min_rto=MIN_TIMEOUT)
+    if slot is None:
+        slot = part_number
+
+    chunk = chunk_size or CHUNK_SIZE
+    total = max(1, -(-(end - start) // chunk))
+    received = bytearray(total)
+    # Every packet is received into the same buffer and written out from a view of it;
+    # with GRO a read can return 64 KB of datagrams
+    buffer = bytearray(max(chunk + PARITY.size, 65536 if USE_GRO else 0))
+    view = memoryview(buffer)
+    sack = new_sack_buffer()
+    received_count = 0
+    cumulative = 0
+    timeouts = 0
+    # first chunk of a group -> (chunks in it, parity), until the group is complete
+    parities = {}
+
+    def land(sequence_number, data):
+        # Out-of-order chunks go straight to their offset, the holes get filled later
+        nonlocal received_count, cumulative
+        offset = start + sequence_number * chunk
+        write_at(fd, data, offset)
+        received[sequence_number] = 1
+        received_count += 1
+        while cumulative < total and received[cumulative]:
+            cumulative += 1
+
+        if manifest is not None:
+            for index in integrity.blocks_covering(manifest, offset, offset + len(data)):
+                block_start, block_end = integrity.block_range(manifest, index)
+                first = (max(block_start, start) - start) // chunk
+                last = (min(block_end, end) - 1 - start) // chunk
+                if index not in verified and all(received[first:last + 1]):
+                    if verify_block(fd, manifest, index):
+                        verified.add(index)
+                    else:
+                        bad.add(index)
+
+        part.add(len(data))
+        if contiguous is not None:
+            contiguous[slot] = min(cumulative * chunk, end - start)
+            transfer.completed = sum(contiguous)
+        for first in [first for first, (count, _) in parities.items() if first <= sequence_number < first + count]:
+            repair(first)
+
+    def repair(first):
+        # One chunk of the group missing: it is the parity XOR every other chunk of the group
+        count, parity = parities[first]
+        missing = [sequence_number for sequence_number in range(first, first + count) if not received[sequence_number]]
+        if len(missing) > 1:
+            return
+        del parities[first]
+        if not missing:
+            return
+        value = int.from_bytes(parity, 'little')
+        for sequence_number in range(first, first + count):
+            if sequence_number != missing[0]:
+                offset = start + sequence_number * chunk
+                value ^= int.from_bytes(read_at(fd, offset, min(chunk, end - offset)), 'little')
+        offset = start + missing[0] * chunk
+        rebuilt.add()
+        land(missing[0], value.to_bytes(len(parity), 'little')[:min(chunk, end - offset)])
+
+    def receive(packet):
+        # One datagram: a chunk, a parity packet, or something stale to skip
+        nonlocal timeouts
+        global path_rto
+        if len(packet) < HEADER.size:
+            print("Received incomplete packet. Retrying...")
+            return
+        packet_transfer_id, sequence_number, checksum = HEADER.unpack_from(packet)
+        parity = sequence_number & PARITY_FLAG
+        sequence_number &= ~PARITY_FLAG
+        if packet_transfer_id != transfer_id or sequence_number >= total or (parity and len(packet) < PARITY.size):
+            return
+        if rtt.samples == 0 and timeouts == 0:
+            rtt.sample(time.monotonic() - request_time)
+            metrics.gauge('rtt_seconds').set(round(rtt.srtt, 6))
+            path_rto = rtt.rto
+        elif timeouts:
+            rtt.settle()
+        timeouts = 0
+        data = packet[PARITY.size if parity else HEADER.size:]
+
+        if checksum != integrity.packet_checksum(data):
+            print(f"Checksum mismatch for {'parity of ' if parity else ''}chunk {sequence_number}. Retrying...")
+            metrics.counter('retries_total', kind='checksum').add()
+            return
+
+        if parity:
+            count = min(PARITY.unpack_from(packet)[3], total - sequence_number)
+            if not all(received[sequence_number:sequence_number + count]):
+                parities[sequence_number] = (count, bytes(data))
+                repair(sequence_number)
+        elif not received[sequence_number]:
+            land(sequence_number, data)
+
+    fec_group = NO_PARITY if fec is None else fec
+    if chunk_size is not None:
+        # More, smaller chunks in flight for the same bytes, no more than a SACK describes
+        window = min(WINDOW_SIZE * CHUNK_SIZE // chunk, MAX_SACK_BITS + 1)
+        request = b'REQX' + SIZED_REQUEST.pack(transfer_id, filename.encode(FORMAT), start, end, window, chunk, fec_group)
+    elif fec is None:
+        request = b'REQW' + REQUEST.pack(transfer_id, filename.encode(FORMAT), start, end, WINDOW_SIZE)
+    else:
+        request = b'REQF' + FEC_REQUEST.pack(transfer_id, filename.encode(FORMAT), start, end, WINDOW_SIZE, fec)
+    sock.sendto(request, server_address)
+    request_time = time.monotonic()
+    gro_space = socket.CMSG_SPACE(4) if USE_GRO else 0
+    while received_count < total and not stop_flag:
+        try:
+            sock.settimeout(rtt.rto)
+            if USE_GRO:
+                n, ancillary, _, _ = sock.recvmsg_into([buffer], gro_space)
+                # Without the segment size the read is one datagram
+                segment = n
+                for level, kind, value in ancillary:
+                    if level == SOL_UDP and kind == UDP_GRO:
+                        segment = int.from_bytes(value[:4], sys.byteorder)
+            else:
+                n, _ = sock.recvfrom_into(buffer)
+                segment = n
+        except socket.timeout:
+            rtt.backoff()
+            timeouts += 1
+            metrics.counter('retries_total', kind='timeout').add()
+            if timeouts > MAX_TIMEOUTS:
+                print(f"Server stopped answering, giving up on {filename}")
                 break
+            # Either the request or our last SACK got lost
+            if received_count == 0:
+                if request.startswith(b'REQF') and timeouts == 2:
+                    # Servers without parity ignore REQF, ask the plain way
+                    request = b'REQW' + request[4:4 + REQUEST.size]
+                sock.sendto(request, server_address)
+            else:
+                sock.sendto(make_sack(sack, transfer_id, received, cumulative), server_address)
+            continue
+        except Exception as e:
+            print(f"Error downloading file: {e}")
+            break
+
+        if buffer.startswith(b'ERROR', 0, n):
+            print(bytes(view[:n]).decode(FORMAT, 'replace'))
+            break
+        # A GRO read holds datagrams of segment bytes each, the last one possibly shorter
+        for offset in range(0, n, max(segment, 1)):
+            receive(view[offset:min(offset + segment, n)])
+        if n:
+            sock.sendto(make_sack(sack, transfer_id, received, cumulative), server_address)
+
+    if received_count == total:
+        # The last SACK may get lost, repeat it so the server can close the session
+        for _ in range(2):
+            sock.sendto(make_sack(sack, transfer_id, received, cumulative), server_address)
+        return True
+    return False
+
+def download_file(server_ip, filename):
+    server_address = (server_ip, SERVER_PORT)
+    manifest = fetch_manifest(server_address, filename)
+    # The manifest is exact as of now, the catalog may be a few seconds old
+    file_size = manifest['size'] if manifest is not None else files.get(filename)
+    if file_size is None:
+        print(f"{filename} is no longer on the server")
+        metrics.transfer(filename).finish(False)
+        return
+    verified = set()
+    bad = set()
+    transfer = metrics.transfer(filename)
+    final_path = os.path.join(OUTPUT_FOLDER, filename)
+    reused = {}
+    if manifest is not None and os.path.exists(final_path):
+        # An older copy: only the blocks it doesn't have are fetched
+        reused = delta.find_matches(final_path, manifest)
+        if len(reused) == integrity.block_count(manifest) and os.path.getsize(final_path) == file_size \
+                and all(reused[index] == integrity.block_range(manifest, index)[0] for index in reused):
+            print(f"{filename} is up to date")
+            transfer.finish()
+            return
+    rebuilt = metrics.counter('fec_rebuilt_chunks_total').value
+    # Built next to the final name, which only ever holds a complete and verified file
+    path = final_path + '.download'
+    if reused:
+        plans = plan_streams(delta.missing_ranges(manifest, reused), manifest)
+    else:
+        plans = [[piece] for piece in split_ranges(file_size, manifest)]
+    pieces = [piece for plan in plans for piece in plan]
+    reused_bytes = sum(end - start for start, end in (integrity.block_range(manifest, index) for index in reused))
+    # One entry per piece, plus what was reused
+    contiguous = [0] * len(pieces) + [reused_bytes]
+    transfer.start(file_size, reused_bytes)
+    results = [False] * len(plans)
+    sockets = [open_stream_socket() for _ in plans]
+
+    def stream(i):
+        for start, end in plans[i]:
+            if not receive_range(sockets[i], server_address, filename, fd, start, end, i, manifest, verified, bad,
+                                 contiguous, FEC, pieces.index((start, end))):
+                return
+        results[i] = True
+
+    # Every stream writes its chunks straight to their offset in the one descriptor
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+    threads = []
+    try:
+        os.ftruncate(fd, file_size)
+        if reused:
+            delta.copy_blocks(final_path, fd, manifest, reused)
+            # Matched by their digests already
+            verified.update(reused)
+            print(f"Updating {filename}: {len(reused)} of {integrity.block_count(manifest)} blocks "
+                  f"({reused_bytes} bytes) reused from the local copy")
+        for i in range(len(plans)):
+            thread = threading.Thread(target=stream, args=(i,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        complete = all(results)
+        # Blocks that failed their digest are fetched again on their own, on the stream they belong to
+        for attempt in range(MAX_REFETCHES):
+            if not complete or not bad:
+                break
+            print(f"{len(bad)} corrupted blocks in {filename}, fetching them again")
+            metrics.counter('corrupt_blocks_total').add(len(bad))
+            retry, bad = sorted(bad), set()
+            for index in retry:
+                block_start, block_end = integrity.block_range(manifest, index)
+                i = next(i for i, plan in enumerate(plans) if any(start <= block_start < end for start, end in plan))
+                if not receive_range(sockets[i], server_address, filename, fd, block_start, block_end, i, manifest, verified, bad):
+                    complete = False
+                    break
+    finally:
+        # Ctrl+C exits from the join above: the streams see stop_flag within an RTO and have
+        # to be done writing before the descriptor goes
+        for thread in threads:
+            thread.join()
+        os.close(fd)
+
+    if complete and manifest is not None and len(verified) < integrity.block_count(manifest):
+        print(f"Error: {filename} still has {integrity.block_count(manifest) - len(verified)} unverified blocks")
+        complete = False
+    if complete:
+        os.replace(path, final_path)
+    else:
+        os.remove(path)
+    if complete:
+        print(f"Download {filename} complete!")
+        rebuilt = metrics.counter('fec_rebuilt_chunks_total').value - rebuilt
+        if rebuilt:
+            print(f"{rebuilt} lost chunks of {filename} rebuilt from parity")
+        transfer.finish()
+        print_session_stats(server_address, sockets)
+    else:
+        transfer.finish(False)
+    for sock in sockets:
+        sock.close()
+
+def print_session_stats(server_address, sockets):
+    # Ask the server how our transfers look from its side: cwnd, RTT and retransmissions, per stream.
+    # Only informative: all asked at once, and what doesn't come back within a few round trips is skipped
+    for sock in sockets:
+        sock.sendto(b'STAT', server_address)
+    deadline = time.monotonic() + min(TIMEOUT, 2 * path_rto)
+    for sock in sockets:
+        try:
+            data = receive_control(server_address, max(0.001, deadline - time.monotonic()), sock, (b'[',))
+            for stats in json.loads(data.decode(FORMAT)):
+                line = (f"{stats['file']} [{stats['client']}]: cwnd {stats['cwnd']}, srtt {stats['srtt_ms']} ms, "
+                        f"rto {stats['rto_ms']} ms, {stats['retransmissions']} retransmissions")
+                if stats.get('parity_sent'):
+                    line += f", {stats['parity_sent']} parity packets (groups of {stats['fec_group']})"
+                print(line)
+        except (socket.timeout, OSError, ValueError, KeyError):
+            pass
 
 def signal_handler(signum, frame):
     global stop_flag
@@ -130,8 +690,38 @@ def signal_handler(signum, frame):
     client_socket.close()
     exit(0)
 
+def parse_args():
+    global SERVER_PORT, FEC, PAYLOAD
+    parser = argparse.ArgumentParser(description="UDP file client")
+    parser.add_argument('--server', default=None, help="server address, asked for on stdin if missing")
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--exit-when-done', action='store_true',
+                        help="exit once every file in input.txt is downloaded, for scripted runs")
+    parser.add_argument('--rcvbuf', type=int, default=RECV_BUFFER, help="SO_RCVBUF in bytes")
+    parser.add_argument('--sndbuf', type=int, default=SEND_BUFFER, help="SO_SNDBUF in bytes")
+    parser.add_argument('--fec', default=None,
+                        help="ask for parity packets on lossy links: a group size in chunks, or 'auto' to follow the loss")
+    parser.add_argument('--payload', default='auto',
+                        help="chunk size in bytes, or 'auto' to probe for the largest that isn't fragmented on the way")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve /metrics (Prometheus text) and /metrics.json on this local port")
+    args = parser.parse_args()
+    set_buffer_sizes(args.rcvbuf, args.sndbuf)
+    SERVER_PORT = args.port
+    if args.fec is not None:
+        FEC = 0 if args.fec == 'auto' else int(args.fec)
+    if args.payload != 'auto':
+        PAYLOAD = max(512, min(int(args.payload), CHUNK_SIZE))
+    return args
+
 if __name__ == "__main__":
+    args = parse_args()
     signal.signal(signal.SIGINT, signal_handler)
-    server_ip = input("INPUT SERVER_IP: ").strip()
-    load_file_list()
-    check_input_file(server_ip)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    server_ip = args.server if args.server is not None else input("INPUT SERVER_IP: ").strip()
+    get_file_list(server_ip)
+    negotiate_payload(server_ip)
+    ProgressView(metrics, lambda: files).start()
+    check_input_file(server_ip, args.exit_when_done)
@@ -1,25 +1,109 @@
 import socket
 import os
+import errno
 import struct
 import threading
 import signal
 import sys
 import json
+import collections
+import time
+import select
+import argparse
 import psutil
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.congestion import RttEstimator, CongestionWindow
+from common.integrity import ManifestCache, packet_checksum
+from common.workers import run_workers, can_fork
+from common.blockcache import BlockCache
+from common.fileio import read_into_at
+from common.catalog import open_server_catalog, catalog_changed
+from common.serverstats import ServerStats
+from common.ratelimit import RateLimiter, parse_weights, MB
+
 PORT = 65432
+# None: every interface, announced with the Wi-Fi address if there is one
+HOST = None
 SERVER_FILES = 'server_files'
 CHUNK_SIZE = 60 * 1024
 TIMEOUT = 5
+MIN_RTO = 0.02
+INITIAL_CWND = 4
+SESSION_TIMEOUT = 60
+MAX_RETRIES = 10
+MAX_WINDOW = 256
+CACHE_BUDGET = 256 * 1024 * 1024
+MIN_CHUNK_SIZE = 512
+DUP_THRESHOLD = 3
+TIMER_INTERVAL = 0.01
+REPORT_INTERVAL = 0.5
+RECV_BATCH = 64
+SEND_BUFFER = 4 * 1024 * 1024
+RECV_BUFFER = 1024 * 1024
+USE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+# UDP GSO (Linux): one sendmsg hands the kernel a run of equal datagrams, up to 64 KB
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+USE_GSO = USE_SENDMSG and sys.platform.startswith('linux')
+GSO_SEGMENTS = 64
+GSO_BYTES = 65000
+GSO_SIZE = struct.Struct("=H")
 FORMAT = 'utf-8'
 FILE_LIST = 'files.txt'
+# REQW: transfer id, file name, first byte, end byte, window asked for
+REQUEST = struct.Struct("!I256sQQH")
+# REQF: REQW plus the parity group size wanted, 0 lets the server fit it to the loss it sees
+FEC_REQUEST = struct.Struct("!I256sQQHH")
+# REQX: REQW plus the chunk size and the parity group size (NO_PARITY: none, 0: fitted to the loss)
+SIZED_REQUEST = struct.Struct("!I256sQQHHH")
+NO_PARITY = 0xFFFF
+# PMTU: datagram size of the probe, padded to that size; echoed back when it arrives whole
+PROBE = struct.Struct("!H")
+# SACK: transfer id, next chunk expected, bitmap of the 64 chunks after it; a longer
+# bitmap goes on in the bytes that follow, least significant first
+SACK = struct.Struct("!IIQ")
+HEADER = struct.Struct("!III")
+# Parity: transfer id, first chunk of the group with PARITY_FLAG set, checksum, chunks in the group
+PARITY = struct.Struct("!IIIH")
+PARITY_FLAG = 0x80000000
+FEC_GROUP = 16
+MIN_FEC_GROUP = 4
+MAX_FEC_GROUP = 32
+# Chunks sent before the loss seen is trusted to size the groups
+FEC_ADAPT_AFTER = 64
+SACK_BITS = 64
+# Longest bitmap a SACK may carry, keeps it well inside one datagram
+MAX_SACK_BITS = 8192
+# Smaller chunks get a window of as many bytes, up to what a SACK can acknowledge:
+# the chunk it expects next and the MAX_SACK_BITS after it
+MAX_WINDOW_CHUNKS = MAX_SACK_BITS + 1
+# MANF: page of block digests wanted, file name
+MANIFEST_REQUEST = struct.Struct("!I256s")
+# Block digests per MANF reply at most
+MANIFEST_PAGE = 1024
+# CATL: generation the client already has, entries wanted, last name of the previous page
+CATALOG_REQUEST = struct.Struct("!QH256s")
+# Entries per CATL reply at most
+CATALOG_PAGE = 100
+# After a MANF or CATL request: the largest reply the client takes, its chunk size. Replies are cut
+# into pages that fit, never fragmented; clients that don't say get CHUNK_SIZE, as their data does
+REPLY_SIZE = struct.Struct("!H")
+CATALOG_INTERVAL = 5
+STATS_PORT = None
+STATS_SOCKET = None
+STATS_INTERVAL = 10
 lock = threading.Lock()
 stop_flag = False
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-os.makedirs(SERVER_FILES, exist_ok=True)
-
 files = {}
+catalog = None
+manifests = ManifestCache(SERVER_FILES)
+# Shared descriptors, and the hot blocks of the files in memory; with no budget every chunk
+# is read straight into its session's buffer
+served_files = BlockCache(SERVER_FILES, CACHE_BUDGET)
 
 def get_wireless_ip():
     wireless_ip = None
@@ -31,18 +115,14 @@ def get_wireless_ip():
                     break
     return wireless_ip
 
-def load_file_list():
+def open_catalog():
+    global catalog, files
+    catalog = open_server_catalog(SERVER_FILES, FILE_LIST, manifests)
+    files = catalog.sizes()
+
+def on_catalog_change():
     global files
-    with open(FILE_LIST, "r") as f:
-        for line in f:
-            name, size = line.strip().split()
-            if size.endswith("GB"):
-                size_in_bytes = int(size.replace("GB", "")) * 1024 * 1024 * 1024
-            elif size.endswith("MB"):
-                size_in_bytes = int(size.replace("MB", "")) * 1024 * 1024
-            else:
-                size_in_bytes = int(size)
-            files[name] = size_in_bytes
+    files = catalog_changed(catalog, manifests)
 
 def send_file_list(server_socket, client_address):
     try:
@@ -51,39 +131,511 @@ def send_file_list(server_socket, client_address):
     except Exception as e:
         print(f"Error sending file list: {e}")
 
-def calculate_checksum(data):
-    return sum(data) % (2**32)
+def reply_size(request, size):
+    # Largest reply the client takes in one datagram, from the REPLY_SIZE after a request of size bytes
+    if len(request) < 4 + size + REPLY_SIZE.size:
+        return CHUNK_SIZE
+    return max(MIN_CHUNK_SIZE, min(REPLY_SIZE.unpack_from(request, 4 + size)[0], CHUNK_SIZE))
 
-def send_file_chunk(server_socket, client_address, filename, chunk_index):
-    file_path = os.path.join(SERVER_FILES, filename)
-    file_size = os.path.getsize(os.path.join(file_path))
-    bytes_sent = 0
+def send_catalog(server_socket, request, client_address):
     try:
-        with open(file_path, 'rb') as file:
-            file.seek(chunk_index)
-            data = file.read(min(CHUNK_SIZE, file_size - bytes_sent))
-            sequence_number = chunk_index // CHUNK_SIZE
-            checksum = calculate_checksum(data)
-            packet = struct.pack("!II", sequence_number, checksum) + data
-            bytes_sent += CHUNK_SIZE
-            while not stop_flag:
-                server_socket.sendto(packet, client_address)
-                # print(f"Sent chunk {sequence_number} to {client_address}")
-                try:
-                    server_socket.settimeout(TIMEOUT)
-                    ack, _ = server_socket.recvfrom(8)
-                    ack_number, = struct.unpack("!I", ack)
-                    if ack_number == sequence_number:
-                        # print(f"ACK received for chunk {sequence_number}")
-                        break
-                except socket.timeout:
-                    print(f"Timeout! Resending chunk {sequence_number}")
-                    continue
+        since, limit, cursor = CATALOG_REQUEST.unpack_from(request, 4)
+    except struct.error:
+        server_socket.sendto(b"ERROR: Invalid request", client_address)
+        return
+    cursor = cursor.decode(FORMAT).strip('\x00')
+    budget = reply_size(request, CATALOG_REQUEST.size) - 4
+    listing = catalog.listing(since, cursor, max(1, min(limit, CATALOG_PAGE)))
+    reply = json.dumps(listing).encode(FORMAT)
+    while len(reply) > budget and len(listing['entries']) > 1:
+        # Fewer entries, in proportion to how much too long the page is
+        limit = max(1, min(len(listing['entries']) - 1, len(listing['entries']) * budget // len(reply)))
+        listing = catalog.listing(since, cursor, limit)
+        reply = json.dumps(listing).encode(FORMAT)
+    if len(reply) > budget and listing['removed']:
+        # More removed names than a page holds: the whole catalog instead, which lists none
+        listing = catalog.listing(0, cursor, 1)
+        reply = json.dumps(listing).encode(FORMAT)
+    server_socket.sendto(b'CATL' + reply, client_address)
+
+class Session:
+    # One transfer of a byte range of one file to one client, keyed by (client address, transfer id)
+    def __init__(self, address, transfer_id, filename, file, start, end, window, fec=None, chunk_size=CHUNK_SIZE):
+        self.address = address
+        self.transfer_id = transfer_id
+        self.filename = filename
+        # Read with pread, which only comes back short if the file shrinks meanwhile; a map would SIGBUS
+        self.file = file
+        self.header = bytearray(HEADER.size)
+        self.start = start
+        self.end = end
+        self.window = window
+        self.chunk_size = chunk_size
+        # An empty range still gets one empty packet so the client sees the end
+        self.total = max(1, -(-(end - start) // chunk_size))
+        # Chunks small enough to batch are queued here as header, payload pairs until the batch goes out
+        self.gso_segments = min(GSO_SEGMENTS, GSO_BYTES // (HEADER.size + chunk_size))
+        self.gso = USE_GSO and self.gso_segments > 1
+        self.batch = []
+        # Chunks are read into a slot each of this buffer, as many as a batch holds
+        self.buffer = memoryview(bytearray(chunk_size * (self.gso_segments if self.gso else 1)))
+        # The cached block the last chunk came from, the next ones mostly do too
+        self.block_index = None
+        self.block = None
+        self.base = 0
+        self.next_seq = 0
+        # sequence number -> [retransmit deadline, time sent, times sent]
+        self.in_flight = {}
+        self.lost = set()
+        self.acked = set()
+        self.fast_retransmitted = set()
+        self.recovery_point = 0
+        self.rtt = RttEstimator(initial_rto=TIMEOUT, min_rto=MIN_RTO)
+        self.congestion = CongestionWindow(INITIAL_CWND, ssthresh=window)
+        self.retransmissions = 0
+        self.retries = 0
+        self.last_seen = time.monotonic()
+        self.created = self.last_seen
+        # Sent since the last report to the stats, reported twice a second instead of per packet
+        self.unreported_bytes = 0
+        self.unreported_packets = 0
+        self.client_bytes, self.file_bytes = stats.sent_to(address[0], filename)
+        # Rate limits: nothing leaves before paced_until, fill_window is called again then
+        self.flow = limiter.flow(address[0])
+        self.paced_until = 0
+        # FEC (fec not None): one parity packet per group of chunks, groups no longer than what
+        # the window lets the client acknowledge past, so a hole parity can't fill is still detected
+        self.max_group = max(1, min(MAX_FEC_GROUP, window - DUP_THRESHOLD - 1))
+        self.fec_adaptive = fec == 0
+        self.fec_group = 0 if fec is None else max(1, min(max(fec or FEC_GROUP, MIN_FEC_GROUP), self.max_group))
+        self.parity = 0
+        self.parity_first = 0
+        self.parity_last = -1
+        self.parity_header = bytearray(PARITY.size)
+        self.parity_sent = 0
+        # Chunks the client was seen missing, repaired or not; their share is the loss rate
+        self.holes = set()
+        # Holes whose group parity may still fill them: out of the network, not yet lost
+        self.awaiting = set()
+
+    def flight(self):
+        return len(self.in_flight) - len(self.lost) - len(self.awaiting)
+
+    def stats(self):
+        return {
+            'file': self.filename,
+            'client': f"{self.address[0]}:{self.address[1]}",
+            'transfer': self.transfer_id,
+            'chunk_size': self.chunk_size,
+            'acked': self.base,
+            'total': self.total,
+            'cwnd': round(self.congestion.cwnd, 2),
+            'ssthresh': round(min(self.congestion.ssthresh, self.window), 2),
+            'srtt_ms': round(self.rtt.srtt * 1000, 3) if self.rtt.srtt is not None else None,
+            'rto_ms': round(self.rtt.rto * 1000, 3),
+            'retransmissions': self.retransmissions,
+            'fast_retransmits': self.congestion.losses,
+            'timeouts': self.congestion.timeouts,
+            'fec_group': self.fec_group,
+            'parity_sent': self.parity_sent,
+        }
+
+    def read_chunk(self, data, offset):
+        # Fills data from offset on; returns the bytes read, short only past the end of the file
+        if not served_files.budget:
+            return read_into_at(self.file.fileno(), data, offset)
+        got = 0
+        while got < len(data):
+            index = (offset + got) // served_files.block_size
+            if index != self.block_index:
+                self.block = memoryview(served_files.block(self.filename, index))
+                self.block_index = index
+            start = offset + got - index * served_files.block_size
+            piece = self.block[start:start + len(data) - got]
+            if not piece:
+                break
+            data[got:got + len(piece)] = piece
+            got += len(piece)
+        return got
+
+    def close(self):
+        self.buffer.release()
+        self.block = None
+        if self.flow is not None:
+            self.flow.close()
+
+sessions = {}
+# Stats of recently finished sessions, so clients can still ask about them
+finished_stats = collections.deque(maxlen=256)
+# Per process; with --workers the parent adds up what each worker reports at exit
+stats = ServerStats()
+# Egress caps and the fair split between clients; with --workers each worker enforces its part of them
+limiter = RateLimiter()
+packets_sent = stats.counter('packets_sent_total')
+parity_packets = stats.counter('parity_packets_total')
+
+def send_file_chunk(server_socket, session, sequence_number, timed=False):
+    # timed: split the time between reading the chunk and sending it
+    start = time.perf_counter() if timed else 0
+    offset = session.start + sequence_number * session.chunk_size
+    size = max(0, min(session.chunk_size, session.end - offset))
+    slot = len(session.batch) // 2 * session.chunk_size if session.gso and USE_GSO else 0
+    data = session.buffer[slot:slot + size]
+    if size and session.read_chunk(data, offset) < size:
+        # Truncated since the session started: what the client has so far may not even be this file
+        server_socket.sendto(f"ERROR: {session.filename} changed while it was being sent".encode(FORMAT), session.address)
+        end_session(session)
+        raise ConnectionError(f"{session.filename} changed while it was being sent to {session.address}")
+    if session.gso and USE_GSO:
+        # Goes out with the rest of the batch (timed there); only a short last chunk may end a GSO batch
+        session.batch += (HEADER.pack(session.transfer_id, sequence_number, packet_checksum(data)), data)
+        if len(data) < session.chunk_size or len(session.batch) >= 2 * session.gso_segments:
+            flush_batch(server_socket, session)
+    else:
+        HEADER.pack_into(session.header, 0, session.transfer_id, sequence_number, packet_checksum(data))
+        read = time.perf_counter() if timed else 0
+        if USE_SENDMSG:
+            # Header and payload leave in one datagram without being joined first
+            server_socket.sendmsg([session.header, data], [], 0, session.address)
+        else:
+            server_socket.sendto(bytes(session.header) + data, session.address)
+        if timed:
+            stats.disk_time.add(read - start)
+            stats.send_time.add(time.perf_counter() - read)
+    session.unreported_packets += 1
+    session.unreported_bytes += len(data)
+    if session.flow is not None:
+        session.flow.charge(len(data))
+    now = time.monotonic()
+    entry = session.in_flight.get(sequence_number)
+    if entry is None:
+        # The last entry is the chunk after which the loss of this one shows: the end of its parity group
+        session.in_flight[sequence_number] = [now + session.rtt.rto, now, 1,
+                                              session.parity_last if session.fec_group else sequence_number]
+        if session.fec_group:
+            session.parity ^= int.from_bytes(data, 'little')
+            if sequence_number == session.parity_last:
+                send_parity(server_socket, session)
+    else:
+        session.retransmissions += 1
+        stats.retransmissions.add()
+        entry[0] = now + session.rtt.rto
+        entry[1] = now
+        entry[2] += 1
+
+def flush_batch(server_socket, session):
+    # The batched chunks leave in one call, the kernel cuts them into datagrams of one chunk each
+    global USE_GSO
+    pieces = session.batch
+    if not pieces:
+        return
+    session.batch = []
+    start = time.perf_counter() if stats.sampled() else 0
+    if USE_GSO and len(pieces) > 2:
+        try:
+            server_socket.sendmsg(pieces, [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(HEADER.size + session.chunk_size))],
+                                  0, session.address)
+            pieces = []
+        except OSError as e:
+            # No GSO in this kernel, or not for this route; one datagram per call from now on
+            if e.errno not in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                raise
+            USE_GSO = False
+            print(f"UDP GSO unavailable ({e}), sending one datagram per call")
+    for i in range(0, len(pieces), 2):
+        server_socket.sendmsg(pieces[i:i + 2], [], 0, session.address)
+    if start:
+        stats.send_time.add(time.perf_counter() - start)
+
+def send_parity(server_socket, session):
+    # XOR of the group's chunks, a short last chunk padded with zeros: the client rebuilds any one of them
+    flush_batch(server_socket, session)
+    first = session.parity_first
+    length = min(session.chunk_size, session.end - (session.start + first * session.chunk_size))
+    payload = session.parity.to_bytes(length, 'little')
+    PARITY.pack_into(session.parity_header, 0, session.transfer_id, PARITY_FLAG | first,
+                     packet_checksum(payload), session.parity_last - first + 1)
+    if USE_SENDMSG:
+        server_socket.sendmsg([session.parity_header, payload], [], 0, session.address)
+    else:
+        server_socket.sendto(bytes(session.parity_header) + payload, session.address)
+    session.parity_sent += 1
+    session.unreported_packets += 1
+    session.unreported_bytes += len(payload)
+    if session.flow is not None:
+        session.flow.charge(len(payload))
+    parity_packets.add()
+
+def start_group(session):
+    # Group sizes only change between groups; adaptive ones aim at one loss every four groups,
+    # rarely two in one group, which a single parity can't repair
+    if session.fec_adaptive and session.next_seq >= FEC_ADAPT_AFTER:
+        loss = len(session.holes) / session.next_seq
+        group = int(1 / (4 * loss)) if loss else MAX_FEC_GROUP
+        session.fec_group = max(1, min(max(group, MIN_FEC_GROUP), session.max_group))
+    session.parity = 0
+    session.parity_first = session.next_seq
+    session.parity_last = min(session.next_seq + session.fec_group, session.total) - 1
+
+def fill_window(server_socket, session):
+    # Lost chunks go out first; nothing leaves while cwnd packets are already in flight
+    while session.flight() < min(session.congestion.window(), session.window):
+        if not session.lost and not (session.next_seq < session.total and session.next_seq < session.base + session.window):
+            break
+        if session.flow is not None:
+            # Over a rate limit: the timers pick the session up again once the next chunk may go
+            delay = session.flow.wait(session.chunk_size)
+            if delay > 0:
+                session.paced_until = time.monotonic() + delay
+                break
+        if session.lost:
+            sequence_number = min(session.lost)
+            session.lost.discard(sequence_number)
+            send_file_chunk(server_socket, session, sequence_number, stats.sampled())
+        else:
+            if session.fec_group and session.next_seq > session.parity_last:
+                start_group(session)
+            send_file_chunk(server_socket, session, session.next_seq, stats.sampled())
+            session.next_seq += 1
+    flush_batch(server_socket, session)
+
+def send_manifest(server_socket, request, client_address):
+    try:
+        page, filename = MANIFEST_REQUEST.unpack_from(request, 4)
+    except struct.error:
+        server_socket.sendto(b"ERROR: Invalid request", client_address)
+        return
+    filename = filename.decode(FORMAT).strip('\x00')
+    if filename not in files:
+        server_socket.sendto(f"ERROR: File {filename} not found".encode(FORMAT), client_address)
+        return
+    if not os.path.exists(os.path.join(SERVER_FILES, filename)):
+        server_socket.sendto(b"ERROR: File not found", client_address)
+        return
+    # Never hash inside the loop that serves every session, the client asks again later
+    manifest = manifests.get(filename, wait=False)
+    if manifest is None:
+        server_socket.sendto(b"BUSY", client_address)
+        return
+    blocks = manifest['blocks']
+    weak = manifest.get('weak', [])
+    reply = {
+        'size': manifest['size'],
+        'block_size': manifest['block_size'],
+        'digest': manifest['digest'],
+        'page': page,
+        'pages': 0,
+        'blocks': [],
+        'weak': [],
+    }
+    # Every page as long as the client's datagrams allow: the digests are all as long as the first,
+    # a weak checksum is at most 10 digits, and page numbers may grow by as many
+    room = reply_size(request, MANIFEST_REQUEST.size) - 4 - len(json.dumps(reply)) - 20
+    each = (len(json.dumps(blocks[0])) + 2 if blocks else 1) + (12 if weak else 0)
+    per_page = max(1, min(MANIFEST_PAGE, room // each))
+    reply['pages'] = max(1, -(-len(blocks) // per_page))
+    reply['blocks'] = blocks[page * per_page:(page + 1) * per_page]
+    reply['weak'] = weak[page * per_page:(page + 1) * per_page]
+    server_socket.sendto(b'MANF' + json.dumps(reply).encode(FORMAT), client_address)
+
+def handle_request(server_socket, request, client_address):
+    timed = stats.sampled()
+    request_start = time.perf_counter() if timed else 0
+    fec = None
+    chunk_size = CHUNK_SIZE
+    try:
+        if request[:4] == b'REQX':
+            transfer_id, filename, start, end, window, chunk_size, fec = SIZED_REQUEST.unpack(request[4:])
+            fec = None if fec == NO_PARITY else fec
+            chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, CHUNK_SIZE))
+        elif request[:4] == b'REQF':
+            transfer_id, filename, start, end, window, fec = FEC_REQUEST.unpack(request[4:])
+        else:
+            transfer_id, filename, start, end, window = REQUEST.unpack(request[4:])
+    except struct.error:
+        server_socket.sendto(b"ERROR: Invalid request", client_address)
+        return
+    filename = filename.decode(FORMAT).strip('\x00')
+    key = (client_address, transfer_id)
+    session = sessions.get(key)
+    if session is not None:
+        # The client didn't hear anything yet and asked again
+        session.last_seen = time.monotonic()
+        session.lost.update(session.in_flight)
+        session.awaiting.clear()
+        fill_window(server_socket, session)
+        return
+    if filename not in files:
+        error_msg = f"ERROR: File {filename} not found"
+        server_socket.sendto(error_msg.encode(FORMAT), client_address)
+        return
+    try:
+        file, (size, _) = served_files.open_file(filename)
     except FileNotFoundError:
         print(f"File not found: {filename}")
         server_socket.sendto(b"ERROR: File not found", client_address)
-    except Exception as e:
-        print(f"Error sending file chunk: {e}")
+        return
+    except (OSError, ValueError) as e:
+        server_socket.sendto(f"ERROR: {e}".encode(FORMAT), client_address)
+        return
+    end = min(end, size)
+    window = max(1, min(window, MAX_WINDOW * CHUNK_SIZE // chunk_size, MAX_WINDOW_CHUNKS))
+    session = sessions[key] = Session(client_address, transfer_id, filename, file, min(start, end), end, window,
+                                      fec, chunk_size)
+    stats.requests.add()
+    stats.connections.add()
+    stats.active.add()
+    print(f"Sending {filename} [{start}, {end}) to {client_address} (transfer {transfer_id}, window {window}"
+          + (f", {chunk_size} byte chunks" if chunk_size != CHUNK_SIZE else "")
+          + (f", parity every {session.fec_group} chunks{' to start' if session.fec_adaptive else ''})" if session.fec_group else ")"))
+    fill_window(server_socket, session)
+    if timed:
+        stats.first_byte.observe(time.perf_counter() - request_start)
+
+def acknowledge(session, sequence_number, now):
+    entry = session.in_flight.pop(sequence_number, None)
+    session.lost.discard(sequence_number)
+    session.awaiting.discard(sequence_number)
+    if entry is None:
+        return 0
+    # Neither resent chunks nor ones the client rebuilt from parity time the path (Karn)
+    if entry[2] == 1 and sequence_number not in session.holes:
+        session.rtt.sample(now - entry[1])
+        if session.rtt.samples == 1:
+            # Chunks sent before the path was timed wait out the real RTO, not the initial guess
+            for other in session.in_flight.values():
+                other[0] = min(other[0], other[1] + session.rtt.rto)
+    return 1
+
+def handle_ack(server_socket, request, client_address):
+    try:
+        transfer_id, cumulative, bitmap = SACK.unpack_from(request, 4)
+    except struct.error:
+        return
+    extra = request[4 + SACK.size:4 + SACK.size + (MAX_SACK_BITS - SACK_BITS) // 8]
+    if extra:
+        bitmap |= int.from_bytes(extra, 'little') << SACK_BITS
+    session = sessions.get((client_address, transfer_id))
+    if session is None:
+        return
+    now = time.monotonic()
+    session.last_seen = now
+
+    newly_acked = 0
+    for sequence_number in range(session.base, min(cumulative, session.next_seq)):
+        newly_acked += acknowledge(session, sequence_number, now)
+        session.acked.discard(sequence_number)
+    session.base = max(session.base, min(cumulative, session.next_seq))
+    highest = session.base - 1
+    while bitmap:
+        # Lowest bit set first
+        bit = (bitmap & -bitmap).bit_length() - 1
+        bitmap &= bitmap - 1
+        sequence_number = cumulative + 1 + bit
+        if sequence_number < session.next_seq and sequence_number not in session.acked:
+            newly_acked += acknowledge(session, sequence_number, now)
+            session.acked.add(sequence_number)
+        highest = max(highest, sequence_number)
+    if newly_acked:
+        session.retries = 0
+        session.congestion.on_ack(newly_acked)
+
+    if session.base >= session.total:
+        print(f"File sent: {session.filename} to {session.address} {session.stats()}")
+        print("_______________________________")
+        end_session(session)
+        return
+
+    # Selective repeat: a hole with enough chunks acknowledged after it is resent right away,
+    # and the first loss of a window halves cwnd
+    for sequence_number in sorted(session.in_flight):
+        if sequence_number + DUP_THRESHOLD > highest:
+            break
+        if session.fec_group:
+            session.holes.add(sequence_number)
+            if session.in_flight[sequence_number][3] + DUP_THRESHOLD > highest:
+                # Its group's parity may still fill it, which costs no retransmission and no cwnd
+                session.awaiting.add(sequence_number)
+                continue
+            session.awaiting.discard(sequence_number)
+        if sequence_number not in session.fast_retransmitted and sequence_number not in session.lost:
+            session.fast_retransmitted.add(sequence_number)
+            session.lost.add(sequence_number)
+            if sequence_number >= session.recovery_point:
+                session.congestion.on_loss()
+                session.recovery_point = session.next_seq
+    fill_window(server_socket, session)
+
+def report_sent(session):
+    if session.unreported_packets:
+        session.client_bytes.add(session.unreported_bytes)
+        session.file_bytes.add(session.unreported_bytes)
+        stats.bytes_sent.add(session.unreported_bytes)
+        packets_sent.add(session.unreported_packets)
+        session.unreported_bytes = 0
+        session.unreported_packets = 0
+
+def end_session(session):
+    sessions.pop((session.address, session.transfer_id), None)
+    finished_stats.append(session.stats())
+    report_sent(session)
+    stats.active.add(-1)
+    stats.request_time.observe(time.monotonic() - session.created)
+    session.close()
+
+def service_timers(server_socket):
+    # Retransmission timeouts back the RTO off and restart slow start; idle sessions are dropped
+    now = time.monotonic()
+    for session in list(sessions.values()):
+        expired = [seq for seq, entry in session.in_flight.items() if now >= entry[0] and seq not in session.lost]
+        if expired:
+            session.retries += 1
+            if session.retries > MAX_RETRIES:
+                print(f"Giving up on {session.filename} for {session.address}")
+                end_session(session)
+                continue
+            session.rtt.backoff()
+            session.congestion.on_timeout()
+            session.lost.update(expired)
+            session.awaiting.difference_update(expired)
+            session.recovery_point = session.next_seq
+            fill_window(server_socket, session)
+        elif now - session.last_seen > SESSION_TIMEOUT:
+            end_session(session)
+
+def resume_paced(server_socket, now):
+    # Sessions held back by a rate limit send again once their wait is over
+    for session in sessions.values():
+        if session.paced_until and now >= session.paced_until:
+            session.paced_until = 0
+            fill_window(server_socket, session)
+
+def next_timeout():
+    now = time.monotonic()
+    deadline = now + 1.0
+    for session in sessions.values():
+        if session.paced_until:
+            deadline = min(deadline, session.paced_until)
+        for sequence_number, entry in session.in_flight.items():
+            if entry[0] < deadline and sequence_number not in session.lost:
+                deadline = entry[0]
+    return max(0.0, deadline - now)
+
+def answer_probe(server_socket, request, client_address):
+    # Only a probe that arrived as big as it was sent is echoed; the client settles on the largest echoed
+    try:
+        size, = PROBE.unpack_from(request, 4)
+    except struct.error:
+        return
+    if size == len(request):
+        server_socket.sendto(b'PMTU' + PROBE.pack(size), client_address)
+
+def send_session_stats(server_socket, client_address):
+    client = f"{client_address[0]}:{client_address[1]}"
+    data = [stats for stats in finished_stats if stats['client'] == client]
+    data += [session.stats() for session in sessions.values() if session.address == client_address]
+    # Keep the reply inside one datagram
+    server_socket.sendto(json.dumps(data[-32:]).encode(FORMAT), client_address)
 
 def signal_handler(sig, frame):
     global stop_flag
@@ -92,54 +644,167 @@ def signal_handler(sig, frame):
     server_socket.close()
     sys.exit(0)
 
-def start_server():
-    SERVER_IP = get_wireless_ip() or '127.0.0.1'
-    
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+def set_buffer_sizes(sock, send_buffer, recv_buffer):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+    # The kernel may clamp (and on Linux doubles) what was asked for
+    print(f"Socket buffers: send {sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)} bytes, "
+          f"receive {sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
+
+def start_server(workers=1):
+    SERVER_IP = HOST or get_wireless_ip() or '127.0.0.1'
+    os.makedirs(SERVER_FILES, exist_ok=True)
+
+    # Opened once; forked workers inherit the catalog and the manifests
+    open_catalog()
+    precompute = manifests.precompute(list(files))
+    if workers > 1:
+        # No thread may be holding a lock when the workers fork
+        precompute.join()
 
-    load_file_list()
+    reuse_port = workers > 1 and can_fork()
+    if reuse_port:
+        # Every worker keeps buckets of its own
+        limiter.split(workers)
 
     print(f"Server IP address: {SERVER_IP}")
     print(f"Server port: {PORT}")
+    if limiter.enabled() and limiter.path is None:
+        # Limits from a file are printed as they are read
+        print(f"Rate limits: {limiter.describe()}")
+
+    merged = run_workers(workers, lambda worker: serve(SERVER_IP, worker, reuse_port), collect_stats)
+    if workers > 1:
+        print(f"{workers} workers served {merged.get('sessions', 0)} sessions, {merged.get('packets_sent', 0)} packets, "
+              f"{merged.get('bytes_sent', 0) / (1024 * 1024):.1f} MB, {merged.get('retransmissions', 0)} retransmissions")
+    if served_files.budget:
+        print(f"Block cache: {merged.get('cache_hits', 0)} hits, {merged.get('cache_misses', 0)} misses, "
+              f"{merged.get('cache_evictions', 0)} evictions")
+
+def collect_stats():
+    for session in list(sessions.values()):
+        report_sent(session)
+    collected = stats.counts()
+    collected['sessions'] = collected.pop('connections')
+    collected['packets_sent'] = packets_sent.value
+    if served_files.budget:
+        for key, value in served_files.snapshot().items():
+            collected['cache_' + key] = value
+    return collected
+
+def serve(host, worker, reuse_port):
+    global server_socket
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    catalog.watch(CATALOG_INTERVAL, on_catalog_change)
+    label = ''
+    stats_port = STATS_PORT
+    stats_socket = STATS_SOCKET
+    if reuse_port:
+        # Every worker has its own stats, on its own endpoint
+        label = f"[worker {worker}] "
+        stats_port = STATS_PORT + worker if STATS_PORT is not None else None
+        stats_socket = f"{STATS_SOCKET}.{worker}" if STATS_SOCKET is not None else None
+    stats.start(STATS_INTERVAL, stats_port, stats_socket, label)
+    limiter.watch(label=label)
+
+    if reuse_port:
+        # Each worker binds its own socket to the port; the kernel keeps every client
+        # address on one worker, so its sessions never move between processes
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        print(f"Worker {worker} started (pid {os.getpid()})")
+    set_buffer_sizes(server_socket, SEND_BUFFER, RECV_BUFFER)
+    server_socket.bind((HOST or '', PORT))
+    print(f"Server is ready for connecting on {host}:{PORT}")
 
-    server_socket.bind(('', PORT))
-    print(f"Server is ready for connecting on {SERVER_IP}:{PORT}")
-    
+    # Every request lands in the same buffer; handlers get a view of it, not a copy.
+    # Big enough for the largest payload probe
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+    # One loop serves every client: requests and ACKs are routed to their session by address and transfer id
+    timers_due = 0
+    reports_due = 0
     while not stop_flag:
         try:
-            request, client_address = server_socket.recvfrom(1024)
-            header = request[:4].decode(FORMAT)
-            if header == 'LIST':
-                send_file_list(server_socket, client_address)
-                print(f"Sent file list to {client_address}")
-            elif header == 'REQF':
-                while not stop_flag:
-                    try:
-                        request, _ = server_socket.recvfrom(1024)
-                        filename, chunk_index = struct.unpack("!256sI", request[4:])
-                        filename = filename.decode(FORMAT).strip('\x00')
-                        # print(f"Client requested file: {filename}, chunk_index: {chunk_index}")
-                        if filename not in files:
-                            error_msg = f"ERROR: File {filename} not found"
-                            server_socket.sendto(error_msg.encode(FORMAT), client_address)
-                            continue
-                        send_file_chunk(server_socket, client_address, filename, chunk_index)
-                        if chunk_index > 0:
-                            percentage = min((chunk_index) / int(files[filename]) * 100, 100)
-                            print(f"Sent {filename} ... {percentage:.1f}%", end = '\r')
-
-                        file_size = os.path.getsize(os.path.join(SERVER_FILES, filename))
-                        if chunk_index + CHUNK_SIZE >= file_size:
-                            print(f"Sent {filename} ... 100 %", end = '\r')
-                            print(f"\nFile sent: {filename}")
-                            print("_______________________________")
-                            break
-                    except Exception as e:
-                        print(f"Error handling client {client_address}: {e}")
-                        # break
+            readable, _, _ = select.select([server_socket], [], [], next_timeout())
+            # Drain what queued up since the last select, ACKs come in bursts
+            batch = RECV_BATCH if MSG_DONTWAIT else 1
+            for i in range(batch if readable else 0):
+                try:
+                    n, client_address = server_socket.recvfrom_into(buffer, 0, MSG_DONTWAIT if i else 0)
+                except BlockingIOError:
+                    break
+                request = view[:n]
+                header = bytes(view[:4])
+                if header == b'SACK':
+                    handle_ack(server_socket, request, client_address)
+                elif header in (b'REQW', b'REQF', b'REQX'):
+                    handle_request(server_socket, request, client_address)
+                elif header == b'LIST':
+                    send_file_list(server_socket, client_address)
+                    print(f"Sent file list to {client_address}")
+                elif header == b'CATL':
+                    send_catalog(server_socket, request, client_address)
+                elif header == b'MANF':
+                    send_manifest(server_socket, request, client_address)
+                elif header == b'PMTU':
+                    answer_probe(server_socket, request, client_address)
+                elif header == b'STAT':
+                    send_session_stats(server_socket, client_address)
+            now = time.monotonic()
+            if limiter.enabled():
+                resume_paced(server_socket, now)
+            if now >= timers_due:
+                service_timers(server_socket)
+                timers_due = now + TIMER_INTERVAL
+            if now >= reports_due:
+                for session in sessions.values():
+                    report_sent(session)
+                reports_due = now + REPORT_INTERVAL
         except Exception as e:
             print(f"Server error: {e}")
 
+def parse_args():
+    global HOST, PORT, SEND_BUFFER, RECV_BUFFER, STATS_PORT, STATS_SOCKET, STATS_INTERVAL
+    parser = argparse.ArgumentParser(description="UDP file server")
+    parser.add_argument('--host', default=HOST, help="address to bind, every interface by default")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--sndbuf', type=int, default=SEND_BUFFER, help="SO_SNDBUF of the server socket in bytes")
+    parser.add_argument('--rcvbuf', type=int, default=RECV_BUFFER, help="SO_RCVBUF of the server socket in bytes")
+    parser.add_argument('--workers', type=int, default=1, help="processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BUDGET // MB,
+                        help="memory for hot file blocks, 0 reads every chunk from the file")
+    parser.add_argument('--max-rate', type=float, default=0, help="MB/s the server sends at most, shared fairly between clients")
+    parser.add_argument('--client-rate', type=float, default=0, help="MB/s at most to one client address")
+    parser.add_argument('--connection-rate', type=float, default=0, help="MB/s at most in one session")
+    parser.add_argument('--client-weight', action='append', default=[], metavar='HOST=WEIGHT',
+                        help="share of the --max-rate a client gets next to the others (1 by default), repeatable")
+    parser.add_argument('--limits', default=None,
+                        help="JSON file with the limits, followed while the server runs: "
+                             "{\"total\": MB/s, \"client\": MB/s, \"connection\": MB/s, \"weights\": {host: weight}}")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="serve /metrics and /metrics.json on this local port (plus the worker number with --workers)")
+    parser.add_argument('--stats-socket', default=None,
+                        help="serve the same on this Unix socket path (plus .worker with --workers)")
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help="seconds between summary lines, 0 prints none")
+    parser.add_argument('--stats-sample', type=float, default=stats.sample_rate,
+                        help="fraction of packets timed for the disk/send split and of requests for the latency")
+    args = parser.parse_args()
+    HOST = args.host
+    PORT = args.port
+    STATS_PORT = args.stats_port
+    STATS_SOCKET = args.stats_socket
+    STATS_INTERVAL = args.stats_interval
+    stats.sample_rate = args.stats_sample
+    SEND_BUFFER = args.sndbuf
+    RECV_BUFFER = args.rcvbuf
+    served_files.budget = args.cache_mb * MB
+    limiter.path = args.limits
+    limiter.configure(args.max_rate * MB, args.client_rate * MB, args.connection_rate * MB, parse_weights(args.client_weight))
+    return args
+
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    start_server(args.workers)
@@ -0,0 +1,50 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import integrity
+
+GB = 1024 * 1024 * 1024
+
+def legacy_sum(data):
+    return sum(data) % (2**32)
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def run(function, packets, total):
+    cpu_start = time.process_time()
+    done = 0
+    while done < total:
+        for packet in packets:
+            function(packet)
+            done += len(packet)
+    return time.process_time() - cpu_start, done
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU cost per GB of the packet and block checksums")
+    parser.add_argument('--size-mb', type=int, default=256,
+                        help="bytes hashed per measurement (the legacy sum only does a tenth of it)")
+    args = parser.parse_args()
+
+    total = args.size_mb * 1024 * 1024
+    sizes = [("UDP packet", 60 * 1024), ("manifest block", integrity.BLOCK_SIZE)]
+    functions = [
+        ("sum % 2**32 (legacy)", legacy_sum, 10),
+        ("zlib.crc32", zlib.crc32, 1),
+        ("sha256-128 (block digest)", integrity.block_digest, 1),
+        ("blake2b-128", blake2b, 1),
+    ]
+    for label, size in sizes:
+        packets = [os.urandom(size) for _ in range(16)]
+        print(f"{label}s of {size // 1024} KB")
+        for name, function, divisor in functions:
+            cpu, done = run(function, packets, total // divisor)
+            print(f"  {name:<28} {cpu / done * GB:8.3f} CPU s/GB   {done / cpu / (1024 * 1024) if cpu else 0:10.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TCP'))
+import server
+import protocol
+from common.blockcache import BlockCache
+
+def make_file(folder, name, size):
+    with open(os.path.join(folder, name), 'wb') as file:
+        file.write(os.urandom(size))
+
+def accept_loop(listener, stop):
+    listener.settimeout(0.2)
+    threads = []
+    while not stop.is_set():
+        try:
+            client_socket, address = listener.accept()
+        except socket.timeout:
+            continue
+        thread = threading.Thread(target=server.handle_client, args=(client_socket, address))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+def fetch(address, name, size, request_size):
+    # One client: binary protocol, the whole file in request_size GETs
+    sock = socket.create_connection(address)
+    sock.sendall(protocol.pack_hello())
+    reader = protocol.FrameReader(sock)
+    protocol.unpack_hello(reader.read_exact(protocol.HELLO.size))
+    buffer = bytearray(protocol.FRAME_SIZE)
+    view = memoryview(buffer)
+    request_id = 0
+    for offset in range(0, size, request_size):
+        request_id += 1
+        sock.sendall(protocol.pack_request(protocol.GET, request_id, name, offset, min(request_size, size - offset)))
+        while True:
+            _, status, flags, _, length = reader.read_response()
+            reader.read_into(view[:length])
+            if status != protocol.OK or flags & protocol.FLAG_LAST:
+                break
+    sock.sendall(protocol.pack_request(protocol.BYE, 0))
+    sock.close()
+
+def run(name, size, clients, request_size, use_sendfile, cache_budget):
+    server.USE_SENDFILE = use_sendfile
+    server.block_cache = BlockCache(server.SERVER_FILES, cache_budget) if cache_budget else None
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(clients)
+    stop = threading.Event()
+    acceptor = threading.Thread(target=accept_loop, args=(listener, stop))
+    acceptor.start()
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    processes = [multiprocessing.Process(target=fetch, args=(listener.getsockname(), name, size, request_size))
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    wall = time.perf_counter() - wall_start
+    stop.set()
+    acceptor.join()
+    cpu = time.process_time() - cpu_start
+    listener.close()
+    cache = server.block_cache.snapshot() if server.block_cache else None
+    return wall, cpu, cache
+
+def main():
+    parser = argparse.ArgumentParser(description="Many TCP clients pulling the same file, with and without the block cache")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--cache-mb', type=int, default=256)
+    parser.add_argument('--request-kb', type=int, default=1024)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    total = size * args.clients
+    modes = [
+        ("read per request", False, 0),
+        ("block cache", False, args.cache_mb * 1024 * 1024),
+        ("sendfile", True, 0),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        server.SERVER_FILES = folder
+        make_file(folder, 'hot.bin', size)
+        server.files = {'hot.bin': size}
+        print(f"{args.clients} clients each fetching the same {args.size_mb} MB file")
+        for label, use_sendfile, budget in modes:
+            if use_sendfile and not hasattr(os, 'sendfile'):
+                print(f"{label:<18} unavailable on this platform")
+                continue
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                wall, cpu, cache = run('hot.bin', size, args.clients, args.request_kb * 1024, use_sendfile, budget)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            line = f"{label:<18} {total / wall / (1024 * 1024):8.1f} MB/s   {cpu / total * 1024 ** 3:6.3f} server CPU s/GB"
+            if cache:
+                line += f"   hits {cache['hits']} misses {cache['misses']} coalesced {cache['coalesced']}"
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+import argparse
+import filecmp
+import heapq
+import math
+import os
+import queue
+import random
+import re
+import select
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from common.integrity import ManifestCache
+
+# End to end runs of the real servers and clients on loopback.
+#
+# Synthetic files sized after files.txt are served from a scratch folder, the
+# clients run headless in folders of their own and every download is compared
+# with the original. Optionally a proxy in between delays, jitters, drops and
+# reorders traffic. Throughput, completion times, CPU per GB and peak memory
+# come from the processes themselves (wait4), not from what they print.
+# TCP clients can download from several servers at once, each with a copy of
+# the files; one of them can be frozen mid-run to see the others take over.
+
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+MSS = 1448
+# IPv4 and UDP headers, in front of every datagram's payload
+IP_HEADER = 20
+UDP_HEADER = 8
+# Least time a lost segment holds a TCP stream back, even without delay
+MIN_RECOVERY = 0.005
+READY_TIMEOUT = 30
+
+def parse_size(text):
+    match = re.fullmatch(r'([\d.]+)\s*([KMG]B)?', text.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"bad size {text!r}")
+    return int(float(match.group(1)) * UNITS.get((match.group(2) or '').upper(), 1))
+
+def load_sizes(path):
+    sizes = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                sizes.append((fields[0], parse_size(fields[1])))
+    return sizes
+
+def make_files(folder, sizes, seed):
+    # Same seed, same bytes: runs stay comparable
+    rng = random.Random(seed)
+    block = rng.randbytes(1024 * 1024)
+    for name, size in sizes:
+        with open(os.path.join(folder, name), 'wb') as file:
+            written = 0
+            while written < size:
+                # A different block each time so no two blocks of a file are the same
+                offset = rng.randrange(len(block))
+                piece = (block[offset:] + block[:offset])[:size - written]
+                file.write(piece)
+                written += len(piece)
+    with open(os.path.join(os.path.dirname(folder), 'files.txt'), 'w') as f:
+        for name, size in sizes:
+            f.write(f"{name} {size}\n")
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Impairment:
+    # Delay, jitter, loss and reordering, decided per packet (UDP) or per segment (TCP).
+    # With an mtu a datagram is lost when any of its IP fragments is
+    def __init__(self, delay, jitter, loss, reorder, seed, mtu=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.mtu = mtu
+        self.rng = random.Random(seed)
+
+    def latency(self):
+        return max(0.0, self.delay + self.rng.uniform(-self.jitter, self.jitter))
+
+    def held_back(self):
+        # Extra delay of a reordered packet, long enough for the ones behind it to overtake it; 0 for the rest
+        if self.reorder and self.rng.random() < self.reorder:
+            return max(2 * self.delay, 0.001)
+        return 0
+
+    def fragments(self, size):
+        # Fragments carry a multiple of 8 bytes each, the UDP header rides in the first
+        if self.mtu is None:
+            return 1
+        return max(1, -(-(size + UDP_HEADER) // ((self.mtu - IP_HEADER) // 8 * 8)))
+
+    def too_big(self, data):
+        # Payload probes are sent with fragmentation off: a router drops the ones over the MTU
+        return self.mtu is not None and data.startswith(b'PMTU') and len(data) + IP_HEADER + UDP_HEADER > self.mtu
+
+    def lost(self, segments=1):
+        # Each of the segments (or fragments) the data takes may be lost
+        return self.loss > 0 and self.rng.random() < 1 - (1 - self.loss) ** segments
+
+class UDPProxy:
+    # One socket facing the clients, one upstream socket per client so the server tells them apart
+    def __init__(self, upstream, impairment):
+        self.upstream = upstream
+        self.impairment = impairment
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.address = self.listener.getsockname()
+        self.clients = {}
+        self.peers = {}
+        self.pending = []
+        # Jitter alone keeps the order of each flow, like a real queue; only --reorder reorders
+        self.last_due = {}
+        self.sequence = 0
+        self.dropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, sock, data, address):
+        if self.impairment.too_big(data):
+            return
+        if self.impairment.lost(self.impairment.fragments(len(data))):
+            self.dropped += 1
+            return
+        due = time.monotonic() + self.impairment.latency()
+        held_back = self.impairment.held_back()
+        if held_back:
+            due += held_back
+        else:
+            due = self.last_due[sock, address] = max(due, self.last_due.get((sock, address), 0))
+        self.sequence += 1
+        heapq.heappush(self.pending, (due, self.sequence, sock, data, address))
+
+    def run(self):
+        while not self.stopped:
+            timeout = 0.1
+            if self.pending:
+                timeout = max(0.0, min(timeout, self.pending[0][0] - time.monotonic()))
+            readable, _, _ = select.select([self.listener] + list(self.peers), [], [], timeout)
+            for sock in readable:
+                try:
+                    data, address = sock.recvfrom(65536)
+                except OSError:
+                    continue
+                if sock is self.listener:
+                    peer = self.clients.get(address)
+                    if peer is None:
+                        peer = self.clients[address] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        peer.bind(('127.0.0.1', 0))
+                        self.peers[peer] = address
+                    self.schedule(peer, data, self.upstream)
+                else:
+                    self.schedule(self.listener, data, self.peers[sock])
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(data, address)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        for sock in [self.listener] + list(self.peers):
+            sock.close()
+
+class TCPProxy:
+    # Bytes keep their order: a loss shows up as the stream stalling for a retransmission, reordering doesn't apply
+    def __init__(self, upstream, impairment):
+        self.upstream = upstream
+        self.impairment = impairment
+        self.lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.address = self.listener.getsockname()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(self.upstream)
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pump(client, server)
+            self.pump(server, client)
+
+    def pump(self, source, target):
+        # Bounded like a socket buffer, so a slow reader pushes back on the sender
+        chunks = queue.Queue(maxsize=64)
+
+        def read():
+            last = 0
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    chunks.put((0, b''))
+                    return
+                with self.lock:
+                    # Never ahead of what was read before it
+                    last = max(last, time.monotonic() + self.impairment.latency())
+                    if self.impairment.lost(max(1, -(-len(data) // MSS))):
+                        # Retransmitted a round trip later, everything behind it waits too
+                        self.dropped += 1
+                        last += max(2 * self.impairment.delay, MIN_RECOVERY)
+                chunks.put((last, data))
+
+        def write():
+            while True:
+                due, data = chunks.get()
+                if not data:
+                    try:
+                        target.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    target.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+def reap(process, block=False):
+    # wait4 instead of Popen.wait, which would throw the resource usage away; None while it runs
+    pid, status, usage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if not pid:
+        return None
+    process.returncode = status
+    return usage
+
+def wait_ready(process, log_path):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        with open(log_path, 'r', errors='replace') as f:
+            if 'ready' in f.read():
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"server did not start, see {log_path}")
+
+def stop(process, timeout=10):
+    # SIGINT like a user would, then whatever it takes; returns the resource usage of the process
+    usage = reap(process)
+    if usage is not None:
+        return usage
+    process.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        usage = reap(process)
+        if usage is not None:
+            return usage
+        time.sleep(0.05)
+    process.kill()
+    return reap(process, block=True)
+
+def percentile(values, q):
+    values = sorted(values)
+    # Nearest rank
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def copy_files(source_folder, folder):
+    # Another server with the same files; hard links where the file system allows
+    os.makedirs(os.path.join(folder, 'server_files'))
+    for name in os.listdir(os.path.join(source_folder, 'server_files')):
+        source = os.path.join(source_folder, 'server_files', name)
+        if not os.path.isfile(source):
+            continue
+        try:
+            os.link(source, os.path.join(folder, 'server_files', name))
+        except OSError:
+            shutil.copy2(source, os.path.join(folder, 'server_files', name))
+    shutil.copy(os.path.join(source_folder, 'files.txt'), folder)
+
+def run(protocol, args, sizes, workdir):
+    folder = os.path.join(workdir, protocol)
+    # Only the TCP client downloads from several servers
+    count = args.servers if protocol == 'tcp' else 1
+    server_folders = [os.path.join(folder, 'server' if count == 1 else f'server{i}') for i in range(count)]
+    os.makedirs(os.path.join(server_folders[0], 'server_files'))
+    make_files(os.path.join(server_folders[0], 'server_files'), sizes, args.seed)
+    for server_folder in server_folders[1:]:
+        copy_files(server_folders[0], server_folder)
+    for server_folder in server_folders:
+        # Digests are built once and kept on disk: the server's CPU is then all serving
+        ManifestCache(os.path.join(server_folder, 'server_files')).precompute([name for name, _ in sizes]).join()
+
+    kind = socket.SOCK_STREAM if protocol == 'tcp' else socket.SOCK_DGRAM
+    server_args = args.server_args or ['']
+    servers = []
+    targets = []
+    proxies = []
+    paused = None
+    try:
+        for i, server_folder in enumerate(server_folders):
+            port = free_port(kind)
+            server_log = os.path.join(folder, 'server.log' if count == 1 else f'server{i}.log')
+            # The last --server-args given is used for the servers after it
+            command = [sys.executable, os.path.join(ROOT, protocol.upper(), 'server.py'),
+                       '--host', '127.0.0.1', '--port', str(port), '--stats-interval', '0'] + \
+                      shlex.split(server_args[min(i, len(server_args) - 1)])
+            with open(server_log, 'w') as log:
+                servers.append(subprocess.Popen(command, cwd=server_folder, stdin=subprocess.DEVNULL,
+                                                stdout=log, stderr=subprocess.STDOUT))
+            wait_ready(servers[-1], server_log)
+            target = ('127.0.0.1', port)
+            if args.delay or args.jitter or args.loss or args.reorder or (args.mtu and protocol == 'udp'):
+                impairment = Impairment(args.delay / 1000, args.jitter / 1000, args.loss, args.reorder, args.seed + i, args.mtu)
+                proxies.append((TCPProxy if protocol == 'tcp' else UDPProxy)(target, impairment))
+                target = proxies[-1].address
+            targets.append(target)
+
+        clients = []
+        for i in range(args.clients):
+            client_folder = os.path.join(folder, f'client{i}')
+            os.makedirs(os.path.join(client_folder, protocol.upper()))
+            with open(os.path.join(client_folder, protocol.upper(), 'input.txt'), 'w') as f:
+                f.write(''.join(f"{name}\n" for name, _ in sizes))
+            if count == 1:
+                address = ['--server', target[0], '--port', str(target[1])]
+            else:
+                address = ['--server', ','.join(f"{host}:{port}" for host, port in targets)]
+            command = [sys.executable, os.path.join(ROOT, protocol.upper(), 'client.py')] + address + \
+                      ['--exit-when-done'] + shlex.split(args.client_args)
+            with open(os.path.join(client_folder, 'client.log'), 'w') as log:
+                process = subprocess.Popen(command, cwd=client_folder, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+            clients.append((client_folder, process, time.monotonic()))
+
+        started = clients[0][2]
+        results = {}
+        while len(results) < len(clients) and time.monotonic() < started + args.timeout:
+            if args.pause_server is not None and paused is None and time.monotonic() >= started + args.pause_server:
+                # SIGSTOP: connections stay open but nothing more comes, the way a hung server looks
+                paused = servers[-1]
+                paused.send_signal(signal.SIGSTOP)
+                print(f"     server {len(servers) - 1} paused after {args.pause_server:g} s")
+            for client_folder, process, client_started in clients:
+                if client_folder not in results:
+                    usage = reap(process)
+                    if usage is not None:
+                        results[client_folder] = (time.monotonic() - client_started, usage)
+            time.sleep(0.05)
+        for client_folder, process, client_started in clients:
+            if client_folder not in results:
+                print(f"     {os.path.basename(client_folder)} did not finish in {args.timeout:.0f} s")
+                results[client_folder] = (time.monotonic() - client_started, stop(process))
+        wall = max(elapsed for elapsed, _ in results.values())
+        results = [(client_folder, elapsed, usage) for client_folder, (elapsed, usage) in results.items()]
+    finally:
+        for proxy in proxies:
+            proxy.close()
+        if paused is not None:
+            paused.send_signal(signal.SIGCONT)
+        server_usages = [stop(server) for server in servers]
+
+    failed = []
+    for client_folder, _, _ in results:
+        for name, _ in sizes:
+            downloaded = os.path.join(client_folder, protocol.upper(), 'downloads', name)
+            if not os.path.exists(downloaded) or not filecmp.cmp(os.path.join(server_folders[0], 'server_files', name), downloaded, shallow=False):
+                failed.append(os.path.relpath(downloaded, folder))
+
+    total = sum(size for _, size in sizes) * args.clients
+    gigabytes = total / 1024 ** 3
+    times = [elapsed for _, elapsed, _ in results]
+    client_cpu = sum(usage.ru_utime + usage.ru_stime for _, _, usage in results)
+    server_cpu = sum(usage.ru_utime + usage.ru_stime for usage in server_usages)
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    client_rss = max(usage.ru_maxrss for _, _, usage in results) * rss_unit
+    line = (f"{protocol.upper():<4} {total / wall / (1024 * 1024):8.1f} MB/s   "
+            f"completion p50 {percentile(times, 0.5):6.2f} s p99 {percentile(times, 0.99):6.2f} s   "
+            f"CPU client {client_cpu / gigabytes:6.2f} s/GB server {server_cpu / gigabytes:6.2f} s/GB   "
+            f"peak RSS client {client_rss / 1024 ** 2:.0f} MB server {max(usage.ru_maxrss for usage in server_usages) * rss_unit / 1024 ** 2:.0f} MB")
+    if proxies:
+        line += f"   {sum(proxy.dropped for proxy in proxies)} dropped"
+    print(line)
+    if failed:
+        print(f"     {len(failed)} downloads missing or different: {', '.join(failed[:5])}  (logs in {folder})")
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description="The TCP and UDP servers and clients end to end on loopback")
+    parser.add_argument('--protocol', choices=['tcp', 'udp', 'both'], default='both')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--files', type=int, default=2, help="the first N entries of files.txt")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every size in files.txt")
+    parser.add_argument('--size-mb', type=float, default=None, help="one size for every file instead")
+    parser.add_argument('--delay', type=float, default=0, help="one way delay in ms, through a proxy")
+    parser.add_argument('--jitter', type=float, default=0, help="delay varies by up to this many ms either way")
+    parser.add_argument('--loss', type=float, default=0, help="packet loss probability, 0 to 1")
+    parser.add_argument('--reorder', type=float, default=0, help="probability a packet is held back behind later ones (UDP)")
+    parser.add_argument('--mtu', type=int, default=None,
+                        help="path MTU for UDP: bigger datagrams are fragmented, and lost if any fragment is")
+    parser.add_argument('--seed', type=int, default=1, help="file contents and impairments are reproducible per seed")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds before unfinished clients are stopped")
+    parser.add_argument('--servers', type=int, default=1,
+                        help="TCP servers with the same files, every client downloads from all of them")
+    parser.add_argument('--pause-server', type=float, default=None, metavar='SECONDS',
+                        help="freeze the last server this long into the run, to see the clients fail over")
+    parser.add_argument('--server-args', action='append', default=None,
+                        help="passed on to the server, e.g. \"--mode async\"; given again, to the next servers")
+    parser.add_argument('--client-args', default='', help="passed on to every client")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch folder with the logs")
+    args = parser.parse_args()
+
+    sizes = load_sizes(os.path.join(ROOT, 'files.txt'))[:args.files]
+    if args.size_mb is not None:
+        sizes = [(name, int(args.size_mb * 1024 * 1024)) for name, _ in sizes]
+    else:
+        sizes = [(name, max(1, int(size * args.scale))) for name, size in sizes]
+    total = sum(size for _, size in sizes)
+    impairments = ", ".join(f"{label} {value}" for label, value in
+                            (('delay ms', args.delay), ('jitter ms', args.jitter), ('loss', args.loss), ('reorder', args.reorder),
+                             ('mtu', args.mtu)) if value)
+    print(f"{args.clients} clients each downloading {len(sizes)} files, {total / (1024 * 1024):.1f} MB, seed {args.seed}"
+          + (f", {impairments}" if impairments else ""))
+
+    workdir = tempfile.mkdtemp(prefix='loopback-')
+    ok = True
+    try:
+        for protocol in (['tcp', 'udp'] if args.protocol == 'both' else [args.protocol]):
+            ok = run(protocol, args, sizes, workdir) and ok
+    finally:
+        if args.keep or not ok:
+            print(f"Scratch folder kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
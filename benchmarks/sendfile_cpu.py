@@ -0,0 +1,90 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TCP'))
+import server
+
+GB = 1024 * 1024 * 1024
+
+def make_file(folder, name, size):
+    path = os.path.join(folder, name)
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            file.write(block[:min(len(block), size - written)])
+            written += len(block)
+    return path
+
+def drain(sock, total):
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    received = 0
+    while received < total:
+        n = sock.recv_into(view)
+        if not n:
+            break
+        received += n
+
+def run(name, size, use_sendfile, reuse_fds):
+    server.USE_SENDFILE = use_sendfile
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+    sender.settimeout(60)
+
+    reader = threading.Thread(target=drain, args=(receiver, size))
+    reader.start()
+
+    open_files = {} if reuse_fds else None
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    offset = 0
+    while offset < size:
+        sent = server.send_file_chunk(sender, name, offset, server.CHUNK_SIZE, open_files)
+        if sent <= 0:
+            break
+        offset += sent
+    cpu = time.thread_time() - cpu_start
+    reader.join()
+    wall = time.perf_counter() - wall_start
+    if open_files is not None:
+        server.close_served_files(open_files)
+    sender.close()
+    receiver.close()
+    return cpu, wall
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU cost per GB of the TCP chunk serving paths")
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    modes = [
+        ("reopen + read (legacy)", False, False),
+        ("cached fd + read", False, True),
+        ("cached fd + sendfile", True, True),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        server.SERVER_FILES = folder
+        make_file(folder, 'bench.bin', size)
+        print(f"Serving {args.size_mb} MB over loopback, best of {args.rounds} rounds")
+        for label, use_sendfile, reuse_fds in modes:
+            if use_sendfile and not hasattr(os, 'sendfile'):
+                print(f"{label:<26} unavailable on this platform")
+                continue
+            best = min(run('bench.bin', size, use_sendfile, reuse_fds) for _ in range(args.rounds))
+            cpu, wall = best
+            print(f"{label:<26} {cpu / size * GB:6.3f} CPU s/GB   {size / wall / (1024 * 1024):8.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
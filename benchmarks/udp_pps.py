@@ -0,0 +1,129 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'UDP'))
+import server
+
+CHUNK_SIZE = server.CHUNK_SIZE
+HEADER = server.HEADER
+
+def make_file(folder, size):
+    path = os.path.join(folder, 'bench.bin')
+    with open(path, 'wb') as file:
+        file.write(os.urandom(size))
+    return path
+
+def sink():
+    # Nobody reads it, the kernel drops what doesn't fit: only the sender's cost is measured
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+def legacy_send(sock, path, address, seconds):
+    # What the server did before: reopen, seek, read, concatenate, sendto
+    size = os.path.getsize(path)
+    total = -(-size // CHUNK_SIZE)
+    packets = 0
+    cpu_start = time.process_time()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sequence_number = packets % total
+        with open(path, 'rb') as file:
+            file.seek(sequence_number * CHUNK_SIZE)
+            data = file.read(CHUNK_SIZE)
+        packet = HEADER.pack(1, sequence_number, zlib.crc32(data)) + data
+        sock.sendto(packet, address)
+        packets += 1
+    return packets, time.process_time() - cpu_start, seconds
+
+def session_send(sock, path, address, seconds, use_sendmsg, budget=0):
+    server.USE_SENDMSG = use_sendmsg
+    size = os.path.getsize(path)
+    server.served_files = server.BlockCache(os.path.dirname(path), budget)
+    file, _ = server.served_files.open_file('bench.bin')
+    session = server.Session(address, 1, 'bench.bin', file, 0, size, 64)
+    packets = 0
+    cpu_start = time.process_time()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        server.send_file_chunk(sock, session, packets % session.total)
+        session.in_flight.clear()
+        packets += 1
+    cpu = time.process_time() - cpu_start
+    session.close()
+    return packets, cpu, seconds
+
+def blast(address, seconds):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packet = bytes(CHUNK_SIZE + HEADER.size)
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sock.sendto(packet, address)
+
+def receive(seconds, use_into):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(1)
+    sender = multiprocessing.Process(target=blast, args=(sock.getsockname(), seconds + 0.5))
+    sender.start()
+    buffer = bytearray(CHUNK_SIZE + HEADER.size)
+    view = memoryview(buffer)
+    packets = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < seconds:
+            if use_into:
+                sock.recvfrom_into(view)
+                HEADER.unpack_from(view)
+            else:
+                packet, _ = sock.recvfrom(CHUNK_SIZE + HEADER.size)
+                HEADER.unpack(packet[:HEADER.size])
+                # The legacy client copied the payload out of every packet
+                packet[HEADER.size:]
+            packets += 1
+    except socket.timeout:
+        pass
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    sender.join()
+    sock.close()
+    return packets, cpu, elapsed
+
+def report(label, result):
+    packets, cpu, elapsed = result
+    print(f"{label:<34} {packets / elapsed:10.0f} packets/s   {cpu / packets * 1e6:7.2f} CPU us/packet")
+
+def main():
+    parser = argparse.ArgumentParser(description="Packets per second of the UDP send and receive paths")
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--size-mb', type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = make_file(folder, args.size_mb * 1024 * 1024)
+        target = sink()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = target.getsockname()
+        print(f"Sending {CHUNK_SIZE // 1024} KB datagrams for {args.seconds}s each")
+        report("reopen + read + concat (legacy)", legacy_send(sock, path, address, args.seconds))
+        report("pread into slot + concat", session_send(sock, path, address, args.seconds, False))
+        if hasattr(socket.socket, 'sendmsg'):
+            report("pread into slot + sendmsg", session_send(sock, path, address, args.seconds, True))
+            report("block cache + sendmsg", session_send(sock, path, address, args.seconds, True, args.size_mb * 1024 * 1024))
+        sock.close()
+        target.close()
+
+    print("Receiving")
+    report("recvfrom + slice (legacy)", receive(args.seconds, False))
+    report("recvfrom_into + memoryview", receive(args.seconds, True))
+
+if __name__ == "__main__":
+    main()
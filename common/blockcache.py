@@ -0,0 +1,111 @@
+import collections
+import os
+import threading
+
+from common.fileio import read_at
+
+# Server-wide cache of the served files.
+#
+# Every file is opened once and the descriptor is shared by all the connections
+# sending it; they read it with pread, never through a map, so a file truncated
+# or rewritten while it is served only reads short instead of raising SIGBUS and
+# killing the process. On top sits an LRU of aligned blocks read from the files,
+# bounded by a memory budget, so the popular parts of popular files stay in
+# memory. When several connections miss on the same block at once, one of them
+# reads it and the others wait for that read.
+
+BLOCK_SIZE = 1024 * 1024
+
+class BlockCache:
+    def __init__(self, folder, budget, block_size=BLOCK_SIZE):
+        self.folder = folder
+        self.budget = budget
+        self.block_size = block_size
+        self.files = {}
+        self.blocks = collections.OrderedDict()
+        self.loading = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+    def open_file(self, name):
+        # Returns (file, version); a file that changed on disk is opened again and its old blocks stop matching
+        path = os.path.join(self.folder, name)
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.files.get(name)
+            if entry is not None and entry[1] == version:
+                return entry
+        # Senders still holding the old file object keep its descriptor open until they are done
+        entry = (open(path, 'rb', buffering=0), version)
+        with self.lock:
+            self.files[name] = entry
+        return entry
+
+    def block(self, name, index):
+        # The bytes of one aligned block, shared by every caller
+        file, version = self.open_file(name)
+        key = (name, version, index)
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+                self.stats['hits'] += 1
+                return data
+            event = self.loading.get(key)
+            if event is None:
+                event = self.loading[key] = threading.Event()
+                owner = True
+                self.stats['misses'] += 1
+            else:
+                owner = False
+                self.stats['coalesced'] += 1
+        if not owner:
+            event.wait()
+            with self.lock:
+                data = self.blocks.get(key)
+            if data is not None:
+                return data
+            # Evicted again right away (or the read failed), read it without the cache
+            return read_at(file.fileno(), index * self.block_size, self.block_size)
+        try:
+            data = read_at(file.fileno(), index * self.block_size, self.block_size)
+            with self.lock:
+                if len(data) <= self.budget:
+                    self.blocks[key] = data
+                    self.size += len(data)
+                    self._evict()
+            return data
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def _evict(self):
+        while self.size > self.budget and self.blocks:
+            _, data = self.blocks.popitem(last=False)
+            self.size -= len(data)
+            self.stats['evictions'] += 1
+            self.stats['evicted_bytes'] += len(data)
+
+    def pieces(self, name, offset, size):
+        # Yields memoryviews covering [offset, offset + size), at most one block each, without joining them
+        end = offset + size
+        while offset < end:
+            index = offset // self.block_size
+            data = self.block(name, index)
+            start = offset - index * self.block_size
+            piece = memoryview(data)[start:start + end - offset]
+            if not piece:
+                return
+            yield piece
+            offset += len(piece)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['cached_bytes'] = self.size
+            stats['cached_blocks'] = len(self.blocks)
+            stats['open_files'] = len(self.files)
+            return stats
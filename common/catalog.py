@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+
+# The served files, as found on disk.
+#
+# Every entry records the exact size, mtime, ctime and, once known, the
+# whole-file digest of its manifest. The catalog is persisted next to the
+# files, so a restart only stats every file again instead of rebuilding
+# anything, and is refreshed by polling the folder in the background.
+#
+# Each entry carries a stamp: the time of the refresh that found it new or
+# changed, later than any stamp given out before. Removed files leave a stamped
+# tombstone. A client that remembers the highest stamp it has seen can ask for
+# just what changed since then.
+
+INDEX_VERSION = 2
+MAX_TOMBSTONES = 4096
+
+class Catalog:
+    def __init__(self, folder, names_source=None, index_path=None, digest_source=None):
+        # names_source() returns the published file names, None publishes every visible file in folder
+        self.folder = folder
+        self.names_source = names_source
+        self.index_path = index_path or os.path.join(folder, '.catalog.json')
+        self.digest_source = digest_source
+        self.entries = {}
+        self.removed = {}
+        # Deltas from before this stamp can't be answered, some tombstones were dropped
+        self.horizon = 0
+        self.names = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # True if the persisted index could be used
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if index.get('version') != INDEX_VERSION:
+            return False
+        with self.lock:
+            self.entries = {entry['name']: entry for entry in index['entries']}
+            self.removed = index.get('removed', {})
+            self.horizon = index.get('horizon', 0)
+            names = index.get('published')
+            self.names = set(names) if names is not None else None
+        return True
+
+    def save(self):
+        with self.lock:
+            index = {
+                'version': INDEX_VERSION,
+                'published': sorted(self.names) if self.names is not None else None,
+                'horizon': self.horizon,
+                'entries': sorted(self.entries.values(), key=lambda entry: entry['name']),
+                'removed': self.removed,
+            }
+        # Worker processes may save at the same time
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save the catalog index: {e}")
+
+    def published(self):
+        names = self.names_source() if self.names_source is not None else None
+        return set(names) if names is not None else None
+
+    def open(self):
+        # Startup: entries of the saved index that still match their file keep their stamp and digest
+        self.load()
+        return self.refresh()
+
+    def refresh(self):
+        # Stat every file once; returns True if any entry changed
+        names = self.published()
+        found = {}
+        with os.scandir(self.folder) as it:
+            for item in it:
+                if item.name.startswith('.') or (names is not None and item.name not in names):
+                    continue
+                try:
+                    if not item.is_file():
+                        continue
+                    stat = item.stat()
+                except OSError:
+                    continue
+                found[item.name] = stat
+
+        changed = False
+        with self.lock:
+            # A file published just now may be older than the last listing a client got
+            now = max(time.time_ns(), self._generation() + 1)
+            for name, stat in found.items():
+                entry = self.entries.get(name)
+                if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns \
+                        and entry['ctime_ns'] == stat.st_ctime_ns:
+                    continue
+                self.entries[name] = {
+                    'name': name,
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'ctime_ns': stat.st_ctime_ns,
+                    'stamp': now,
+                    'digest': None,
+                }
+                self.removed.pop(name, None)
+                changed = True
+            for name in [name for name in self.entries if name not in found]:
+                del self.entries[name]
+                self.removed[name] = now
+                changed = True
+            if len(self.removed) > MAX_TOMBSTONES:
+                oldest = sorted(self.removed.items(), key=lambda item: item[1])
+                for name, stamp in oldest[:len(self.removed) - MAX_TOMBSTONES]:
+                    del self.removed[name]
+                    self.horizon = max(self.horizon, stamp)
+            if names != self.names:
+                self.names = names
+                changed = True
+        filled = self.fill_digests()
+        if changed or filled:
+            self.save()
+        return changed
+
+    def fill_digests(self):
+        # Digests come from manifests that are already built, nothing is hashed here
+        if self.digest_source is None:
+            return False
+        filled = False
+        with self.lock:
+            missing = [entry for entry in self.entries.values() if entry['digest'] is None]
+        for entry in missing:
+            digest = self.digest_source(entry['name'])
+            if digest is not None:
+                with self.lock:
+                    entry['digest'] = digest
+                filled = True
+        return filled
+
+    def sizes(self):
+        with self.lock:
+            return {name: entry['size'] for name, entry in sorted(self.entries.items())}
+
+    def _generation(self):
+        return max([entry['stamp'] for entry in self.entries.values()] + list(self.removed.values()) + [0])
+
+    def listing(self, since=0, cursor='', limit=100):
+        # One page of entries changed after since, in name order, starting after cursor.
+        # The first page also lists what was removed since then.
+        with self.lock:
+            generation = self._generation()
+            full = since == 0 or since < self.horizon
+            names = sorted(name for name, entry in self.entries.items()
+                           if name > cursor and (full or entry['stamp'] > since))
+            page = [dict(self.entries[name]) for name in names[:limit]]
+            removed = [] if full or cursor else sorted(name for name, stamp in self.removed.items() if stamp > since)
+        return {
+            'generation': generation,
+            'full': full,
+            'entries': page,
+            'removed': removed,
+            'next': page[-1]['name'] if len(names) > limit else None,
+        }
+
+    def watch(self, interval, on_change=None):
+        # Background polling; on_change() runs after every refresh that found something
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    changed = self.refresh()
+                except OSError as e:
+                    print(f"Could not refresh the catalog: {e}")
+                    continue
+                if changed and on_change is not None:
+                    on_change()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+def read_file_list(path):
+    # The names published in a list like files.txt, one per line; None if there is no list
+    try:
+        with open(path, "r") as f:
+            return [line.split()[0] for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+def open_server_catalog(folder, file_list, manifests):
+    # A server's catalog of folder: the names in file_list, read again on every refresh,
+    # with the digests of whatever manifests are already built
+    def digest(filename):
+        manifest = manifests.peek(filename)
+        return manifest['digest'] if manifest is not None else None
+
+    catalog = Catalog(folder, lambda: read_file_list(file_list), digest_source=digest)
+    catalog.open()
+    sizes = catalog.sizes()
+    names = read_file_list(file_list)
+    if names is None:
+        print(f"No {file_list}, publishing every file in {folder}")
+    for name in names or []:
+        if name not in sizes:
+            print(f"{name} is listed in {file_list} but missing from {folder}")
+    return catalog
+
+def catalog_changed(catalog, manifests):
+    # The sizes after a refresh that found changes; the manifests of new files are built in the background
+    sizes = catalog.sizes()
+    print(f"Catalog changed, serving {len(sizes)} files")
+    manifests.precompute(list(sizes))
+    return sizes
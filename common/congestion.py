@@ -0,0 +1,60 @@
+# Retransmission timer (RFC 6298) and a Reno-style congestion window for the UDP transfers
+
+CLOCK_GRANULARITY = 0.001
+
+class RttEstimator:
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=10.0):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = initial_rto
+        self.samples = 0
+
+    def sample(self, rtt):
+        # Only feed RTTs of packets that were sent once (Karn's algorithm)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        self.settle()
+
+    def settle(self):
+        # Drop any backoff once the path answers again
+        if self.srtt is not None:
+            rto = self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar)
+            self.rto = min(self.max_rto, max(self.min_rto, rto))
+
+    def backoff(self):
+        self.rto = min(self.max_rto, self.rto * 2)
+
+class CongestionWindow:
+    # Slow start up to ssthresh, then one packet per window (AIMD); halves on loss, restarts on timeout
+    def __init__(self, initial=4, ssthresh=float('inf')):
+        self.cwnd = float(initial)
+        self.ssthresh = ssthresh
+        self.losses = 0
+        self.timeouts = 0
+
+    def on_ack(self, count=1):
+        for _ in range(count):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+
+    def on_loss(self):
+        self.losses += 1
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1.0
+
+    def window(self):
+        return max(1, int(self.cwnd))
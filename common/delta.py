@@ -0,0 +1,141 @@
+import mmap
+import os
+
+from common import integrity
+from common.fileio import read_at, write_at
+
+# Delta sync: reuse the blocks of an older local copy of a file.
+#
+# The client walks its copy against the server's manifest. Where the block at the
+# current position has a known digest it is taken and the walk jumps a whole block;
+# where it doesn't, the Adler-32 of the window is rolled one byte at a time until its
+# weak checksum is one of the manifest's and the digest agrees, which finds data that
+# only moved (bytes inserted or removed before it). Only the blocks nothing matched
+# are downloaded; the others are copied from the old file.
+
+ADLER_MOD = 65521
+# Bytes rolled one at a time per file at most; rolling runs in Python, about half a second per MB
+ROLL_BUDGET = 8 * 1024 * 1024
+COPY_SIZE = 1024 * 1024
+
+def find_matches(path, manifest):
+    # Block index of the manifest -> offset of the same data in the local file
+    block_size = manifest['block_size']
+    blocks = manifest['blocks']
+    weak = manifest.get('weak') or []
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return {}
+    if not size or not blocks:
+        return {}
+    # A short last block can't be found by a full-size window
+    tail = manifest['size'] - (len(blocks) - 1) * block_size
+    full = len(blocks) if tail == block_size else len(blocks) - 1
+    by_digest = {}
+    for index in range(full):
+        by_digest.setdefault(blocks[index], []).append(index)
+    by_weak = {}
+    if len(weak) == len(blocks):
+        for index in range(full):
+            by_weak.setdefault(weak[index], []).append(index)
+
+    matches = {}
+
+    def take(indices, offset):
+        for index in indices:
+            matches.setdefault(index, offset)
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            budget = ROLL_BUDGET
+            position = 0
+            while position + block_size <= size:
+                indices = by_digest.get(integrity.block_digest(view[position:position + block_size]))
+                if indices:
+                    take(indices, position)
+                    position += block_size
+                    continue
+                if not by_weak or budget <= 0:
+                    position += block_size
+                    continue
+                found = roll(data, view, position, block_size, size, by_weak, by_digest)
+                if found is None:
+                    budget -= block_size
+                    position += block_size
+                else:
+                    offset, indices = found
+                    budget -= offset - position
+                    take(indices, offset)
+                    position = offset + block_size
+            if full < len(blocks):
+                # The last block where the walk stopped, or at the very end of the file
+                last = len(blocks) - 1
+                for offset in (position, size - tail):
+                    if 0 <= offset and offset + tail <= size and integrity.verify_block(manifest, last, view[offset:offset + tail]):
+                        matches[last] = offset
+                        break
+        finally:
+            view.release()
+    return matches
+
+def roll(data, view, position, block_size, size, by_weak, by_digest):
+    # First offset after position whose window has a known weak checksum and digest,
+    # with the blocks it matches; None if there is none within a block
+    checksum = integrity.weak_checksum(view[position:position + block_size])
+    a = checksum & 0xFFFF
+    b = checksum >> 16
+    last = min(position + block_size, size - block_size + 1)
+    for offset in range(position + 1, last):
+        out = data[offset - 1]
+        a = (a - out + data[offset + block_size - 1]) % ADLER_MOD
+        b = (b - block_size * out + a - 1) % ADLER_MOD
+        if (b << 16) | a in by_weak:
+            indices = by_digest.get(integrity.block_digest(view[offset:offset + block_size]))
+            if indices:
+                return offset, indices
+    return None
+
+def copy_blocks(source_path, fd, manifest, matches):
+    # Copies the matched blocks of the old file into their places in fd; returns the bytes copied
+    copied = 0
+    source = os.open(source_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        for index, offset in sorted(matches.items()):
+            start, end = integrity.block_range(manifest, index)
+            copied += copy_range(source, fd, offset, start, end - start)
+    finally:
+        os.close(source)
+    return copied
+
+def copy_range(source, fd, source_offset, offset, length):
+    done = 0
+    while done < length:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                n = os.copy_file_range(source, fd, length - done, source_offset + done, offset + done)
+            except OSError:
+                n = 0
+            if n:
+                done += n
+                continue
+        data = read_at(source, source_offset + done, min(COPY_SIZE, length - done))
+        if not data:
+            break
+        write_at(fd, data, offset + done)
+        done += len(data)
+    return done
+
+def missing_ranges(manifest, matched):
+    # Merged (start, end) ranges of the blocks not in matched
+    ranges = []
+    for index in range(integrity.block_count(manifest)):
+        if index in matched:
+            continue
+        start, end = integrity.block_range(manifest, index)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
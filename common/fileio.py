@@ -0,0 +1,43 @@
+import os
+import threading
+
+# Positioned reads and writes on a descriptor several threads share.
+#
+# pread and pwrite don't move the file offset, so any number of threads can use
+# them at once. Where they are missing (Windows) the seek and the read or write
+# that follows it have to happen together, under one lock.
+
+seek_lock = threading.Lock()
+
+def read_at(fd, offset, size):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+def read_into_at(fd, buffer, offset):
+    # Fills the writable memoryview buffer from offset; returns the bytes read, fewer at the end of the file
+    if not hasattr(os, 'preadv'):
+        data = read_at(fd, offset, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    done = 0
+    while done < len(buffer):
+        n = os.preadv(fd, [buffer[done:]], offset + done)
+        if not n:
+            break
+        done += n
+    return done
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            with seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
@@ -0,0 +1,118 @@
+import os
+import select
+import struct
+import time
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    inotify_init1 = libc.inotify_init1
+    inotify_add_watch = libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    # Not Linux: the file is polled
+    inotify_init1 = None
+
+# Follows input.txt as it grows.
+#
+# Only the bytes appended since the last look are read, and every name comes
+# out once however often it is repeated. On Linux the watcher sleeps on an
+# inotify watch of the file's folder, elsewhere it stats the file every
+# interval. A file replaced or truncated (an editor saving it) is read again
+# from the start, the names already seen are skipped.
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")
+
+class InputWatcher:
+    def __init__(self, path, interval=1):
+        self.path = path
+        self.interval = interval
+        self.offset = 0
+        self.inode = None
+        # Bytes after the last newline, taken as a name once they stop changing
+        self.tail = b''
+        self.seen = set()
+        self.fd = None
+        if inotify_init1 is not None:
+            self.fd = self._watch()
+
+    def _watch(self):
+        fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        folder = os.path.dirname(os.path.abspath(self.path))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if inotify_add_watch(fd, folder.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def new_names(self):
+        # Names appended since the last call, in file order, never one that came out before
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode = stat.st_ino
+            self.offset = 0
+            self.tail = b''
+        if stat.st_size == self.offset:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        lines = data.split(b'\n')
+        tail = lines.pop()
+        if tail and tail == self.tail:
+            # Nothing was added to it since the last look: a last line without a newline
+            lines.append(tail)
+            tail = b''
+        self.tail = tail
+        self.offset += len(data) - len(tail)
+
+        names = []
+        for line in lines:
+            name = line.decode('utf-8', 'replace').strip()
+            if name and name not in self.seen:
+                self.seen.add(name)
+                names.append(name)
+        return names
+
+    def wait(self, timeout=None):
+        # Returns once the file may have changed, or after timeout (default: the polling interval)
+        timeout = self.interval if timeout is None else timeout
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        name = os.path.basename(self.path).encode()
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], max(0, deadline - time.monotonic()))
+            if not readable:
+                return
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            position = 0
+            while position + EVENT.size <= len(data):
+                _, _, _, length = EVENT.unpack_from(data, position)
+                position += EVENT.size
+                if data[position:position + length].rstrip(b'\x00') == name:
+                    return
+                position += length
+            # Only other files in the folder changed, keep sleeping
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
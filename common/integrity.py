@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+# Integrity checks shared by the TCP and UDP paths.
+#
+# Packets carry a CRC32, computed in C by zlib. Files are described by a manifest:
+# the SHA-256 digest (cut to 128 bits) of every BLOCK_SIZE block plus a whole-file
+# digest, which is the SHA-256 of the block digests in order. A client can therefore check
+# each block as soon as it lands, in any order, and the whole file at the end.
+# Every block also has a weak Adler-32 checksum, which can be rolled along a local copy
+# to find blocks at any offset (delta sync); it is only ever a hint for the digests.
+
+BLOCK_SIZE = 1024 * 1024
+BLOCK_DIGEST_SIZE = 16
+MANIFEST_VERSION = 2
+
+def packet_checksum(data):
+    return zlib.crc32(data)
+
+def block_digest(data):
+    # SHA-256 has hardware support on current x86 and ARM CPUs, unlike BLAKE2
+    return hashlib.sha256(data).digest()[:BLOCK_DIGEST_SIZE].hex()
+
+def weak_checksum(data):
+    return zlib.adler32(data)
+
+def root_digest(blocks):
+    digest = hashlib.sha256()
+    for block in blocks:
+        digest.update(bytes.fromhex(block))
+    return digest.hexdigest()
+
+def build_manifest(path, block_size=BLOCK_SIZE):
+    blocks = []
+    weak = []
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        buffer = bytearray(block_size)
+        view = memoryview(buffer)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            blocks.append(block_digest(view[:n]))
+            weak.append(weak_checksum(view[:n]))
+    return {
+        'version': MANIFEST_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'block_size': block_size,
+        'blocks': blocks,
+        'weak': weak,
+        'digest': root_digest(blocks),
+    }
+
+def block_count(manifest):
+    return len(manifest['blocks'])
+
+def block_range(manifest, index):
+    start = index * manifest['block_size']
+    return start, min(start + manifest['block_size'], manifest['size'])
+
+def blocks_covering(manifest, start, end):
+    block_size = manifest['block_size']
+    return range(start // block_size, min(-(-end // block_size), block_count(manifest)))
+
+def verify_block(manifest, index, data):
+    return block_digest(data) == manifest['blocks'][index]
+
+def check_manifest(manifest):
+    # A manifest is only trusted if its block list hashes to its whole-file digest
+    return root_digest(manifest['blocks']) == manifest['digest']
+
+class ManifestCache:
+    # Manifests of the served files, kept in memory and in a hidden folder next to them.
+    # A cached manifest is reused as long as the file's size and mtime didn't change.
+
+    def __init__(self, folder, cache_folder=None):
+        self.folder = folder
+        self.cache_folder = cache_folder or os.path.join(folder, '.manifests')
+        self.manifests = {}
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def _fresh(self, name, manifest):
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return False
+        return manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.cache_folder, name + '.json'), 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and self._fresh(name, manifest):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _store(self, name, manifest):
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            path = os.path.join(self.cache_folder, name + '.json')
+            # Worker processes may store the same manifest at the same time
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not cache manifest of {name}: {e}")
+
+    def peek(self, name):
+        # The manifest if it is already built and still matches the file, never builds one
+        with self.lock:
+            manifest = self.manifests.get(name)
+        if manifest is not None and self._fresh(name, manifest):
+            return manifest
+        return None
+
+    def get(self, name, wait=True):
+        # Returns the manifest; with wait False, None while it is being built in the background
+        with self.lock:
+            manifest = self.manifests.get(name)
+            if manifest is not None and self._fresh(name, manifest):
+                return manifest
+            event = self.building.get(name)
+            owner = event is None
+            if owner:
+                event = self.building[name] = threading.Event()
+        if not owner:
+            if not wait:
+                return None
+            event.wait()
+            with self.lock:
+                return self.manifests.get(name)
+        if not wait:
+            threading.Thread(target=self._build_quietly, args=(name, event), daemon=True).start()
+            return None
+        return self._build(name, event)
+
+    def _build(self, name, event):
+        try:
+            manifest = self._load(name)
+            if manifest is None:
+                manifest = build_manifest(os.path.join(self.folder, name))
+                self._store(name, manifest)
+            with self.lock:
+                self.manifests[name] = manifest
+            return manifest
+        finally:
+            with self.lock:
+                del self.building[name]
+            event.set()
+
+    def _build_quietly(self, name, event):
+        try:
+            self._build(name, event)
+        except OSError as e:
+            print(f"Could not build manifest of {name}: {e}")
+
+    def precompute(self, names):
+        # Build missing manifests in the background so the first client doesn't wait
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except OSError:
+                    pass
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,120 @@
+import os
+import struct
+import threading
+import time
+
+# Sidecar journal of the byte ranges of a download that are already on disk.
+# Layout: magic, file size, range count, then (start, end) pairs, all big endian.
+MAGIC = b'SKRJ'
+HEADER = struct.Struct("!4sQI")
+RANGE = struct.Struct("!QQ")
+CHECKPOINT_INTERVAL = 1.0
+
+class RangeJournal:
+    def __init__(self, path, data_path, file_size, ranges=None):
+        self.path = path
+        self.data_path = data_path
+        self.file_size = file_size
+        self.ranges = ranges or []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.last_checkpoint = time.monotonic()
+
+    @classmethod
+    def load(cls, path, data_path, file_size):
+        # A journal only counts if it belongs to the same file size and the data is still there
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            magic, size, count = HEADER.unpack_from(data)
+            if magic != MAGIC or size != file_size or not os.path.exists(data_path):
+                raise ValueError("stale journal")
+            ranges = [list(RANGE.unpack_from(data, HEADER.size + i * RANGE.size)) for i in range(count)]
+            return cls(path, data_path, file_size, ranges)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        with self.lock:
+            merged = []
+            for r in self.ranges:
+                if r[1] < start or r[0] > end:
+                    merged.append(r)
+                else:
+                    start = min(start, r[0])
+                    end = max(end, r[1])
+            merged.append([start, end])
+            merged.sort()
+            self.ranges = merged
+            self.dirty = True
+            due = time.monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL
+        if due:
+            self.save()
+
+    def covers(self, start, end):
+        with self.lock:
+            return any(r[0] <= start and end <= r[1] for r in self.ranges)
+
+    def discard(self, start, end):
+        # Forget a range whose data turned out to be bad so it is fetched again
+        with self.lock:
+            kept = []
+            for r in self.ranges:
+                if r[1] <= start or r[0] >= end:
+                    kept.append(r)
+                    continue
+                if r[0] < start:
+                    kept.append([r[0], start])
+                if r[1] > end:
+                    kept.append([end, r[1]])
+            self.ranges = kept
+            self.dirty = True
+
+    def missing(self):
+        with self.lock:
+            gaps = []
+            position = 0
+            for start, end in self.ranges:
+                if start > position:
+                    gaps.append((position, start))
+                position = max(position, end)
+            if position < self.file_size:
+                gaps.append((position, self.file_size))
+            return gaps
+
+    def completed_bytes(self):
+        with self.lock:
+            return sum(end - start for start, end in self.ranges)
+
+    def is_complete(self):
+        return not self.missing()
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                ranges = [tuple(r) for r in self.ranges]
+                self.dirty = False
+                self.last_checkpoint = time.monotonic()
+            # The data has to be on disk before the journal claims it is
+            fd = os.open(self.data_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            data = HEADER.pack(MAGIC, self.file_size, len(ranges)) + b''.join(RANGE.pack(*r) for r in ranges)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+
+    def remove(self):
+        for path in (self.path, self.path + '.tmp'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,327 @@
+import bisect
+import http.server
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# Metrics of the clients and the servers.
+#
+# The threads moving data only ever add to counters, observe into histograms
+# and set gauges, without taking a lock: every thread adds into a cell of its
+# own and readers sum the cells. Everything derived (throughput, ETA,
+# percentiles) is computed by whoever reads, the progress view, the periodic
+# summary or the exporter, never on the data path.
+
+EWMA_WEIGHT = 0.3
+
+class Cells:
+    # One list of numbers per writing thread
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []
+        self.retired = [0] * size
+        self.lock = threading.Lock()
+
+    def cell(self):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            # Once per thread; after that only this thread ever writes its cell
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self.cells.append((cell, threading.current_thread()))
+        return cell
+
+    def totals(self):
+        with self.lock:
+            # Servers start a thread per connection: cells of finished threads are folded in and dropped
+            live = []
+            for cell, thread in self.cells:
+                if thread.is_alive():
+                    live.append((cell, thread))
+                else:
+                    for i in range(self.size):
+                        self.retired[i] += cell[i]
+            self.cells = live
+            totals = list(self.retired)
+        for cell, _ in live:
+            for i in range(self.size):
+                totals[i] += cell[i]
+        return totals
+
+class Counter(Cells):
+    # Exported as a Prometheus counter when its name ends in _total, as a gauge otherwise (add(-1) works)
+    def __init__(self):
+        super().__init__(1)
+
+    def add(self, amount=1):
+        self.cell()[0] += amount
+
+    @property
+    def value(self):
+        return self.totals()[0]
+
+class Histogram(Cells):
+    # Counts per bucket (upper bounds, ascending, plus one for larger values) and the sum
+    def __init__(self, bounds):
+        super().__init__(len(bounds) + 2)
+        self.bounds = bounds
+
+    def observe(self, value):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def quantile(self, q, totals=None):
+        # Upper bound of the bucket the q-th observation falls in, None without observations
+        counts = (totals or self.totals())[:-1]
+        count = sum(counts)
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+    @property
+    def value(self):
+        totals = self.totals()
+        return {
+            'count': sum(totals[:-1]),
+            'sum': round(totals[-1], 6),
+            'p50': self.quantile(0.5, totals),
+            'p90': self.quantile(0.9, totals),
+            'p99': self.quantile(0.99, totals),
+        }
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+class Transfer:
+    # One file: bytes received per part, how much of the file is complete, speed and ETA
+    def __init__(self, registry, name, size):
+        self.registry = registry
+        self.name = name
+        self.size = size
+        self.parts = {}
+        self.completed = 0
+        self.state = 'queued'
+        self.started = None
+        self.finished = None
+        self.rate = 0.0
+        self.last_sample = None
+
+    def part(self, part):
+        # Callers keep the counter, lookups stay off the per-chunk path
+        counter = self.parts.get(part)
+        if counter is None:
+            counter = self.parts[part] = self.registry.counter('bytes_received_total', file=self.name, part=str(part))
+        return counter
+
+    def start(self, size=None, completed=0):
+        if size is not None:
+            self.size = size
+        self.completed = completed
+        self.state = 'downloading'
+        self.started = time.monotonic()
+
+    def finish(self, ok=True):
+        self.state = 'done' if ok else 'failed'
+        if ok:
+            self.completed = self.size
+        self.finished = time.monotonic()
+
+    def received(self):
+        return sum(counter.value for counter in list(self.parts.values()))
+
+    def sample(self, now):
+        # Instantaneous rate, smoothed; called by one reader at a fixed interval
+        received = self.received()
+        if self.last_sample is not None and now > self.last_sample[0]:
+            rate = (received - self.last_sample[1]) / (now - self.last_sample[0])
+            self.rate = rate if self.rate == 0 else EWMA_WEIGHT * rate + (1 - EWMA_WEIGHT) * self.rate
+        self.last_sample = (now, received)
+        if self.state != 'downloading':
+            self.rate = 0.0
+
+    def average(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.received() / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        if self.state != 'downloading' or self.rate <= 0:
+            return None
+        return max(0, self.size - self.completed) / self.rate
+
+    def percent(self):
+        return int(self.completed / self.size * 100) if self.size else 100
+
+    def snapshot(self):
+        return {
+            'size': self.size,
+            'completed': self.completed,
+            'percent': self.percent(),
+            'state': self.state,
+            'received': self.received(),
+            'rate': round(self.rate, 1),
+            'average': round(self.average(), 1),
+            'eta': round(self.eta(), 1) if self.eta() is not None else None,
+            'parts': {part: counter.value for part, counter in sorted(self.parts.items())},
+        }
+
+class Registry:
+    def __init__(self, prefix='client'):
+        self.prefix = prefix
+        self.series = {}
+        self.transfers = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def _get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.series.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.series.get(key)
+                if metric is None:
+                    metric = self.series[key] = kind()
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, bounds, **labels):
+        return self._get(lambda: Histogram(bounds), name, labels)
+
+    def transfer(self, name, size=0):
+        # The same Transfer for every caller asking about name
+        transfer = self.transfers.get(name)
+        if transfer is None:
+            with self.lock:
+                transfer = self.transfers.get(name)
+                if transfer is None:
+                    transfer = self.transfers[name] = Transfer(self, name, size)
+        return transfer
+
+    def sample(self):
+        now = time.monotonic()
+        for transfer in list(self.transfers.values()):
+            transfer.sample(now)
+
+    def snapshot(self):
+        return {
+            'uptime': round(time.monotonic() - self.started, 1),
+            'metrics': [
+                {'name': name, 'labels': dict(labels), 'value': metric.value}
+                for (name, labels), metric in sorted(list(self.series.items()), key=lambda item: item[0])
+            ],
+            'transfers': {name: transfer.snapshot() for name, transfer in sorted(list(self.transfers.items()))},
+        }
+
+    def derived(self):
+        # (name, labels, value) gauges computed at read time
+        gauges = []
+        keys = [('transfer_size_bytes', 'size'), ('transfer_completed_bytes', 'completed'),
+                ('transfer_rate_bytes_per_second', 'rate'), ('transfer_average_rate_bytes_per_second', 'average'),
+                ('transfer_eta_seconds', 'eta')]
+        transfers = [(name, transfer.snapshot()) for name, transfer in sorted(list(self.transfers.items()))]
+        for metric_name, key in keys:
+            for name, snapshot in transfers:
+                if snapshot[key] is not None:
+                    gauges.append((metric_name, {'file': name}, snapshot[key]))
+        return gauges
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+
+        def declare(full_name, kind):
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f"# TYPE {full_name} {kind}")
+
+        for (name, labels), metric in sorted(list(self.series.items()), key=lambda item: item[0]):
+            full_name = f"{self.prefix}_{name}"
+            labels = dict(labels)
+            if isinstance(metric, Histogram):
+                declare(full_name, 'histogram')
+                totals = metric.totals()
+                cumulative = 0
+                for bound, count in zip(list(metric.bounds) + ['+Inf'], totals[:-1]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {totals[-1]}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {cumulative}")
+                continue
+            declare(full_name, 'counter' if isinstance(metric, Counter) and name.endswith('_total') else 'gauge')
+            lines.append(f"{full_name}{format_labels(labels)} {metric.value}")
+        for name, labels, value in self.derived():
+            full_name = f"{self.prefix}_{name}"
+            declare(full_name, 'gauge')
+            lines.append(f"{full_name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=None, path=None, host='127.0.0.1'):
+        # /metrics in Prometheus text format, /metrics.json as JSON; on a local TCP port or a Unix socket
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path in ('/', '/metrics.json'):
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            server = UnixHTTPServer(path, Handler)
+        else:
+            server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        def get_request(self):
+            # The handler expects a (host, port) client address
+            request, _ = super().get_request()
+            return request, ('local', 0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in sorted(labels.items())) + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
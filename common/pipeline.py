@@ -0,0 +1,165 @@
+import queue
+import threading
+
+# Ordered queue of files shared by a fixed pool of download connections.
+#
+# Files are started in the order they were queued. A connection that finds
+# nothing left to claim in the current file moves on to the next one, so the
+# next file's first ranges are already flowing while the last ranges of the
+# current file are still in flight. With several servers, a connection only
+# claims from the files its server has.
+
+class FileDownload:
+    def __init__(self, name, size, journal, scheduler, fd):
+        self.name = name
+        self.size = size
+        self.journal = journal
+        self.scheduler = scheduler
+        self.fd = fd
+        self.outstanding = 0
+        self.abandoned = False
+        self.manifest = None
+        # Indices of the servers this file comes from, None: any
+        self.sources = None
+        self.verified = set()
+        self.verify_lock = threading.Lock()
+        # Times each block, by its start, failed its digest
+        self.refetches = {}
+
+class DownloadPipeline:
+    def __init__(self, prepare, finish, max_queued=64, lookahead=1):
+        # prepare(name) -> FileDownload or None, finish(download) runs once all its bytes landed
+        self.prepare = prepare
+        self.finish = finish
+        self.names = queue.Queue(max_queued)
+        self.active = []
+        self.lookahead = lookahead
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.closed = False
+        self.preparing = False
+
+    def put(self, name, timeout=None):
+        # Blocks while max_queued names are already waiting, False if that outlasted timeout
+        try:
+            self.names.put(name, timeout=timeout)
+        except queue.Full:
+            return False
+        with self.work:
+            self.work.notify_all()
+        return True
+
+    def claim(self, worker, size, timeout=None, source=None, lease_size=None):
+        # Returns (download, start, end), or None after timeout with nothing to do
+        with self.work:
+            while not self.closed:
+                claimed = self._claim(worker, size, source, lease_size)
+                if claimed is not None:
+                    return claimed
+                if not self.work.wait(timeout) and timeout is not None:
+                    return None
+            return None
+
+    def _claim(self, worker, size, source=None, lease_size=None):
+        for download in self.active:
+            if not serves(download, source):
+                continue
+            claimed = download.scheduler.claim(worker, size, lease_size)
+            if claimed is not None:
+                download.outstanding += 1
+                return download, claimed[0], claimed[1]
+        while len(self.active) <= self.lookahead and not self.preparing:
+            try:
+                name = self.names.get_nowait()
+            except queue.Empty:
+                return None
+            # prepare talks to the server and the disk, the other connections keep claiming meanwhile
+            self.preparing = True
+            self.lock.release()
+            try:
+                download = self.prepare(name)
+            finally:
+                self.lock.acquire()
+                self.preparing = False
+                self.work.notify_all()
+            if download is None:
+                continue
+            self.active.append(download)
+            if download.journal.is_complete():
+                self._retire(download)
+                continue
+            if not serves(download, source):
+                continue
+            claimed = download.scheduler.claim(worker, size, lease_size)
+            if claimed is not None:
+                download.outstanding += 1
+                return download, claimed[0], claimed[1]
+        return None
+
+    def complete(self, download):
+        # One claimed range has fully landed
+        with self.work:
+            download.outstanding -= 1
+            if download.outstanding == 0 and not download.abandoned and download.journal.is_complete():
+                self._retire(download)
+            self.work.notify_all()
+
+    def give_back(self, worker, download, ranges):
+        with self.work:
+            download.scheduler.give_back(worker, ranges)
+            download.outstanding -= len(ranges)
+            self.work.notify_all()
+
+    def requeue(self, download, ranges):
+        # Ranges that landed but failed verification are handed out again
+        with self.work:
+            download.scheduler.give_back(None, ranges)
+            self.work.notify_all()
+
+    def exclude(self, download, source, workers, ranges=()):
+        # Stops a server from serving download: the leases of its workers and the given ranges
+        # go back to the others. False, changing nothing, if it is the only server left
+        with self.work:
+            if download.sources is None or download.sources <= {source}:
+                return False
+            download.sources.discard(source)
+            for worker in workers:
+                download.scheduler.give_back(worker, [])
+            download.scheduler.give_back(None, ranges)
+            download.outstanding -= len(ranges)
+            self.work.notify_all()
+            return True
+
+    def abandon(self, download):
+        # The server can't serve this file; stop handing out its ranges
+        # Returns True for the one caller that should clean it up
+        with self.work:
+            removed = download in self.active
+            if removed:
+                self.active.remove(download)
+                download.abandoned = True
+            self.work.notify_all()
+        return removed
+
+    def settle(self, download):
+        # Waits until no connection is still landing data of download, e.g. before its fd is closed
+        with self.work:
+            while download.outstanding > 0:
+                self.work.wait()
+
+    def _retire(self, download):
+        self.active.remove(download)
+        # finish does disk I/O, run it without holding up the other connections
+        threading.Thread(target=self.finish, args=(download,)).start()
+
+    def pending(self):
+        with self.lock:
+            return list(self.active)
+
+    def close(self):
+        with self.work:
+            self.closed = True
+            self.work.notify_all()
+
+def serves(download, source):
+    return source is None or download.sources is None or source in download.sources
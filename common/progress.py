@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+import time
+
+# Terminal view of the client's downloads.
+#
+# A thread of its own redraws the frame in place with ANSI escapes (cursor
+# home, overwrite every line, clear what is left) instead of clearing the
+# screen through a subprocess, and only reads the metrics. When stdout is not
+# a terminal it prints a one-line summary now and then instead.
+
+MAX_LISTED_FILES = 20
+LOG_INTERVAL = 10
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+    return f"{seconds // 60:02}:{seconds % 60:02}"
+
+class ProgressView:
+    def __init__(self, registry, catalog, interval=1, stream=None):
+        # catalog() returns the server's {name: size}
+        self.registry = registry
+        self.catalog = catalog
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.interactive = self.stream.isatty()
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.interactive and os.name == 'nt':
+            # Turns on escape sequence processing in the Windows console
+            os.system('')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.draw()
+
+    def run(self):
+        last_log = 0
+        while not self.stopped.wait(self.interval):
+            self.registry.sample()
+            if self.interactive:
+                self.draw()
+            elif time.monotonic() - last_log >= LOG_INTERVAL:
+                last_log = time.monotonic()
+                self.log()
+
+    def frame(self):
+        files = self.catalog()
+        lines = [f"Available files: {len(files)}", "__________________"]
+        for filename, size in list(files.items())[:MAX_LISTED_FILES]:
+            lines.append(f"{filename}: {size / (1024 * 1024):.2f} MB")
+        if len(files) > MAX_LISTED_FILES:
+            lines.append(f"... and {len(files) - MAX_LISTED_FILES} more")
+        lines += ["__________________", "", "Download Status: "]
+        # Only the transfers in progress get lines of their own, the others are counted
+        transfers = list(self.registry.transfers.values())
+        done = [transfer for transfer in transfers if transfer.state == 'done']
+        failed = sum(1 for transfer in transfers if transfer.state == 'failed')
+        queued = sum(1 for transfer in transfers if transfer.state == 'queued')
+        lines.append(f"{len(done)} downloaded ({format_size(sum(transfer.size for transfer in done))}), "
+                     f"{failed} failed, {queued} queued")
+        for transfer in transfers:
+            if transfer.state != 'downloading':
+                continue
+            lines.append(f"Downloading {transfer.name} .... {transfer.percent()}%  {format_size(transfer.rate)}/s  "
+                         f"ETA {format_eta(transfer.eta())}")
+            parts = sorted(list(transfer.parts.items()))
+            if len(parts) > 1:
+                lines.append("    " + "  ".join(f"part {part}: {format_size(counter.value)}" for part, counter in parts))
+        return lines
+
+    def draw(self):
+        if not self.interactive:
+            return
+        # One write per frame: home, every line cleared to its end, then everything below
+        text = '\x1b[H' + ''.join(f"{line}\x1b[K\n" for line in self.frame()) + '\x1b[J'
+        self.stream.write(text)
+        self.stream.flush()
+
+    def log(self):
+        transfers = list(self.registry.transfers.values())
+        active = [transfer for transfer in transfers if transfer.state == 'downloading']
+        done = sum(1 for transfer in transfers if transfer.state == 'done')
+        rate = sum(transfer.rate for transfer in active)
+        self.stream.write(f"{done}/{len(transfers)} files done, {len(active)} downloading at {format_size(rate)}/s\n")
+        self.stream.flush()
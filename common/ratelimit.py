@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import time
+
+# Egress limits of a server.
+#
+# Three caps, each optional: everything the server sends, each client (by
+# address) and each connection or session. Every cap is a token bucket kept
+# as a virtual time (GCRA): the time by which what was charged to it would
+# have gone out at its rate. A sender only ever asks how long to wait, so the
+# same limiter serves blocking threads, asyncio tasks and the UDP event loop.
+#
+# The total cap is enforced through the clients' buckets: every REBALANCE
+# seconds it is split by weight, max-min fair, over the clients with open
+# connections. Those that used less than their share keep what they used
+# (plus room to grow) and the rest is divided among the ones that were held
+# back; a client held back in between gets a new split right away. One client
+# with many connections then gets no more than one with a single connection,
+# and a small download started next to a large one gets its share at once.
+#
+# Limits come from the command line and, if given, a JSON file that is read
+# again whenever it changes: {"total": 50, "client": 10, "connection": 5,
+# "weights": {"192.168.1.7": 2}}, rates in MB/s, null or 0 for no limit.
+#
+# Worker processes (--workers) keep buckets of their own. Each one enforces its
+# part of the total and per-client caps, so together they never send more than
+# the caps; a client whose connections all land on one worker gets only that
+# worker's part of its cap.
+
+MB = 1024 * 1024
+# Credit a bucket may build up, in seconds of its rate
+BURST = 0.05
+REBALANCE = 0.1
+# Least time between two splits, when a client held back asks for one early
+MIN_REBALANCE = 0.01
+# Clients without connections are forgotten after this long
+IDLE = 1.0
+# A client that wasn't held back may grow this much by the next split
+HEADROOM = 1.25
+# Least part of the total cap any client is left with
+MIN_SHARE = 0.01
+# Bytes each wait is asked for at most; large sends are paced in slices this big
+SLICE = 64 * 1024
+WATCH_INTERVAL = 2
+
+class Bucket:
+    def __init__(self, rate=None):
+        # bytes per second, None: no limit
+        self.rate = rate
+        self.due = 0.0
+
+    def wait(self, now):
+        if not self.rate:
+            return 0.0
+        return max(0.0, self.due - BURST - now)
+
+    def charge(self, nbytes, now):
+        if self.rate:
+            self.due = max(self.due, now) + nbytes / self.rate
+
+    def set_rate(self, rate, now):
+        # What is still owed is paid off at the new rate
+        if self.rate and rate and self.due > now:
+            self.due = now + (self.due - now) * self.rate / rate
+        elif not rate:
+            self.due = now
+        self.rate = rate
+
+class Client:
+    def __init__(self, weight):
+        self.bucket = Bucket()
+        self.weight = weight
+        self.flows = 0
+        self.used = 0
+        self.last = time.monotonic()
+        # Unknown demand to start with: it gets a full share until it shows it needs less
+        self.held_back = True
+
+class Flow:
+    # One connection (TCP) or session (UDP); charged to its own bucket, its client's and the total
+    def __init__(self, limiter, host):
+        self.limiter = limiter
+        self.host = host
+        self.bucket = Bucket(limiter.connection_rate)
+        self.closed = False
+
+    def wait(self, nbytes=SLICE):
+        # Seconds until nbytes may go, without charging them
+        return self.limiter.wait(self, nbytes, charge=False)
+
+    def reserve(self, nbytes):
+        # Charges nbytes and returns how long to wait before sending them
+        return self.limiter.wait(self, nbytes, charge=True)
+
+    def charge(self, nbytes):
+        self.limiter.wait(self, nbytes, charge=True)
+
+    def close(self):
+        self.limiter.release(self)
+
+class RateLimiter:
+    def __init__(self, total=None, client=None, connection=None, weights=None, path=None):
+        # Rates in bytes per second
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.flows = []
+        self.path = path
+        self.mtime = None
+        self.balanced = time.monotonic()
+        self.workers = 1
+        self.configure(total, client, connection, weights)
+
+    def configure(self, total=None, client=None, connection=None, weights=None):
+        with self.lock:
+            # As given, for the whole server
+            self.limits = (total or None, client or None, connection or None)
+            self.total_rate = total / self.workers if total else None
+            self.client_rate = client / self.workers if client else None
+            self.connection_rate = connection or None
+            self.weights = dict(weights or {})
+            now = time.monotonic()
+            for host, state in self.clients.items():
+                state.weight = self.weights.get(host, 1)
+                state.held_back = True
+            for flow in self.flows:
+                flow.bucket.set_rate(self.connection_rate, now)
+            self.rebalance(now)
+
+    def split(self, workers):
+        # Called before the workers fork: from then on this process enforces its part of the caps
+        self.workers = max(1, workers)
+        self.configure(*self.limits, self.weights)
+
+    def enabled(self):
+        # Without any limit and without a file to get them from, the servers skip the limiter altogether
+        return bool(self.total_rate or self.client_rate or self.connection_rate or self.path)
+
+    def flow(self, host):
+        # A Flow for a new connection or session, None when nothing is limited
+        if not self.enabled():
+            return None
+        flow = Flow(self, host)
+        with self.lock:
+            state = self.clients.get(host)
+            if state is None:
+                state = self.clients[host] = Client(self.weights.get(host, 1))
+            state.flows += 1
+            self.flows.append(flow)
+            if state.flows == 1:
+                # A client starting to download gets its share from the first byte
+                self.rebalance(time.monotonic())
+        return flow
+
+    def release(self, flow):
+        with self.lock:
+            if flow.closed:
+                return
+            flow.closed = True
+            self.flows.remove(flow)
+            state = self.clients.get(flow.host)
+            if state is not None:
+                state.flows -= 1
+
+    def wait(self, flow, nbytes, charge):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.balanced >= REBALANCE:
+                self.rebalance(now)
+            state = self.clients[flow.host]
+            own = state.bucket.wait(now)
+            if own > 0 and not state.held_back:
+                # Wants more than it was left with: a full share, now rather than at the next split
+                state.held_back = True
+                if now - self.balanced >= MIN_REBALANCE:
+                    self.rebalance(now)
+                    own = state.bucket.wait(now)
+            delay = max(own, flow.bucket.wait(now))
+            if charge:
+                # Charged as of when the bytes will go, the next caller waits behind them
+                start = now + delay
+                state.bucket.charge(nbytes, start)
+                flow.bucket.charge(nbytes, start)
+                state.used += nbytes
+                state.last = now
+            return delay
+
+    def rebalance(self, now):
+        # Max-min fair split of the total cap by weight; called with the lock held
+        elapsed = max(now - self.balanced, 1e-3)
+        self.balanced = now
+        for host in [host for host, state in self.clients.items() if not state.flows and now - state.last > IDLE]:
+            del self.clients[host]
+        active = [state for state in self.clients.values() if state.flows]
+        rates = {state: self.client_rate for state in self.clients.values()}
+        if self.total_rate:
+            least = self.total_rate * MIN_SHARE
+            left = self.total_rate
+            pending = active
+            while pending:
+                fair = max(left / sum(state.weight for state in pending), least)
+                content = [state for state in pending if not state.held_back
+                           and state.used / elapsed * HEADROOM < fair * state.weight]
+                if not content:
+                    for state in pending:
+                        rates[state] = min(fair * state.weight, self.client_rate or fair * state.weight)
+                    break
+                for state in content:
+                    share = max(state.used / elapsed * HEADROOM, least)
+                    rates[state] = min(share, self.client_rate or share)
+                    left = max(left - share, 0)
+                pending = [state for state in pending if state not in content]
+        for state, rate in rates.items():
+            state.bucket.set_rate(rate, now)
+            state.used = 0
+            # Held back again if it still wants more
+            state.held_back = state.bucket.wait(now) > 0
+
+    def describe(self):
+        def rate(value):
+            return f"{value / MB:g} MB/s" if value else "none"
+        total, client, connection = self.limits
+        line = f"total {rate(total)}, per client {rate(client)}, per connection {rate(connection)}"
+        if self.weights:
+            line += ", weights " + ", ".join(f"{host} x{weight:g}" for host, weight in sorted(self.weights.items()))
+        if self.workers > 1 and (total or client):
+            line += f", total and per client split over {self.workers} workers"
+        return line
+
+    def load(self):
+        # True if the file changed and its limits are now in effect
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            with open(self.path, 'r') as f:
+                limits = json.load(f)
+            self.configure(*(float(limits.get(key) or 0) * MB for key in ('total', 'client', 'connection')),
+                           {host: float(weight) for host, weight in (limits.get('weights') or {}).items()})
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            print(f"Could not read the rate limits in {self.path}: {e}")
+            return False
+        return True
+
+    def watch(self, interval=WATCH_INTERVAL, label=''):
+        # Limits follow the file while the server runs
+        if self.path is None:
+            return None
+        if self.load():
+            print(f"{label}Rate limits from {self.path}: {self.describe()}")
+
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.load():
+                    print(f"{label}Rate limits changed: {self.describe()}")
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+def parse_weights(items):
+    # HOST=WEIGHT strings from the command line
+    weights = {}
+    for item in items:
+        host, _, weight = item.partition('=')
+        weights[host] = float(weight or 1)
+    return weights
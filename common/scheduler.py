@@ -0,0 +1,100 @@
+import threading
+import time
+
+# Hands out byte ranges of one file to the connections downloading it.
+#
+# The missing ranges are cut into small pieces kept in a shared queue. Each
+# connection leases one piece at a time and claims requests from it. When the
+# queue runs dry, an idle connection takes the back half of whichever lease
+# has the most bytes left, so a slow connection doesn't hold up the file.
+# A connection can ask for smaller leases than the pieces, e.g. one to a slower
+# server, and then only cuts off what it asked for; what it holds beyond that
+# goes back to the queue. Requests can be capped too, so that a connection
+# pipelining several of them stays within its piece of a small file.
+
+class RangeScheduler:
+    def __init__(self, ranges, piece_size, min_split, max_request=None):
+        self.queue = []
+        for start, end in ranges:
+            while start < end:
+                self.queue.append([start, min(start + piece_size, end)])
+                start += piece_size
+        self.min_split = min_split
+        self.max_request = max_request
+        self.leases = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def claim(self, worker, size, lease_size=None):
+        # Returns the next (start, end) for worker to request, or None when nothing is left
+        with self.lock:
+            if worker not in self.stats:
+                now = time.monotonic()
+                self.stats[worker] = {'bytes': 0, 'start': now, 'end': now}
+            lease = self.leases.get(worker)
+            if lease is None or lease[0] >= lease[1]:
+                lease = self._next_lease(worker, lease_size)
+                if lease is None:
+                    return None
+            elif lease_size and lease[1] - lease[0] > lease_size:
+                # The connection turned out slower than when it took the lease
+                self.queue.insert(0, [lease[0] + lease_size, lease[1]])
+                lease[1] = lease[0] + lease_size
+            if self.max_request:
+                size = min(size, self.max_request)
+            start = lease[0]
+            end = min(start + size, lease[1])
+            lease[0] = end
+            return start, end
+
+    def _next_lease(self, worker, lease_size=None):
+        if self.queue:
+            lease = self.queue.pop(0)
+        else:
+            lease = self._steal(worker)
+        if lease is None:
+            self.leases.pop(worker, None)
+            return None
+        if lease_size and lease[1] - lease[0] > lease_size:
+            self.queue.insert(0, [lease[0] + lease_size, lease[1]])
+            lease[1] = lease[0] + lease_size
+        self.leases[worker] = lease
+        return lease
+
+    def _steal(self, worker):
+        victim = None
+        for other, lease in self.leases.items():
+            if other != worker and (victim is None or lease[1] - lease[0] > victim[1] - victim[0]):
+                victim = lease
+        if victim is None or victim[1] - victim[0] < 2 * self.min_split:
+            return None
+        middle = victim[0] + (victim[1] - victim[0]) // 2
+        middle -= (middle - victim[0]) % self.min_split
+        stolen = [middle, victim[1]]
+        victim[1] = middle
+        return stolen
+
+    def give_back(self, worker, ranges):
+        # A connection that failed returns what it claimed but never received
+        with self.lock:
+            lease = self.leases.pop(worker, None)
+            if lease is not None and lease[0] < lease[1]:
+                self.queue.insert(0, lease)
+            for start, end in ranges:
+                if start < end:
+                    self.queue.insert(0, [start, end])
+
+    def record(self, worker, nbytes):
+        with self.lock:
+            stats = self.stats[worker]
+            stats['bytes'] += nbytes
+            stats['end'] = time.monotonic()
+
+    def throughput(self):
+        # worker -> (bytes received, bytes per second)
+        with self.lock:
+            result = {}
+            for worker, stats in self.stats.items():
+                elapsed = stats['end'] - stats['start']
+                result[worker] = (stats['bytes'], stats['bytes'] / elapsed if elapsed > 0 else 0)
+            return result
@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+
+from common.metrics import Registry
+
+# What a server is doing, for the periodic summary line and the stats endpoint.
+#
+# Counting bytes and requests is cheap and always on. Timing is not: only a
+# sampled fraction of requests (or packets) measure how long the first byte
+# took and how the time splits between reading the file and sending it.
+# Rates per client and per file, and the hottest files, come from the
+# difference between two reads of the counters.
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SAMPLE_RATE = 0.05
+SUMMARY_INTERVAL = 10
+TOP_FILES = 5
+# Clients past this many share one "other" series
+MAX_CLIENTS = 1024
+
+class ServerStats(Registry):
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        super().__init__('server')
+        self.sample_rate = sample_rate
+        self.connections = self.counter('connections_total')
+        self.active = self.counter('active_sessions')
+        self.requests = self.counter('requests_total')
+        self.bytes_sent = self.counter('bytes_sent_total')
+        self.retransmissions = self.counter('retransmissions_total')
+        self.disk_time = self.counter('disk_seconds_total')
+        self.send_time = self.counter('send_seconds_total')
+        self.first_byte = self.histogram('first_byte_seconds', LATENCY_BUCKETS)
+        self.request_time = self.histogram('request_seconds', LATENCY_BUCKETS)
+        self.clients = {}
+        self.files = {}
+        self.client_rates = {}
+        self.file_rates = {}
+        # Per second over the last interval, and the first byte histogram of that interval alone
+        self.interval = None
+        self.interval_first_byte = None
+        self.last_read = None
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def sent_to(self, host, filename):
+        # (client counter, file counter) for callers to keep; bytes added to them also count in bytes_sent
+        client = self.clients.get(host)
+        if client is None:
+            if len(self.clients) >= MAX_CLIENTS:
+                host = 'other'
+            client = self.clients[host] = self.counter('client_bytes_sent_total', client=host)
+        file = self.files.get(filename)
+        if file is None:
+            file = self.files[filename] = self.counter('file_bytes_sent_total', file=filename)
+        return client, file
+
+    def sent(self, host, filename, amount):
+        client, file = self.sent_to(host, filename)
+        client.add(amount)
+        file.add(amount)
+        self.bytes_sent.add(amount)
+
+    def update_rates(self):
+        # Bytes/s per client and per file since the last call; one reader calls this
+        now = time.monotonic()
+        clients = {host: counter.value for host, counter in list(self.clients.items())}
+        files = {name: counter.value for name, counter in list(self.files.items())}
+        totals = {'requests': self.requests.value, 'bytes': self.bytes_sent.value,
+                  'disk': self.disk_time.value, 'send': self.send_time.value}
+        first_byte = self.first_byte.totals()
+        if self.last_read is not None:
+            then, last_clients, last_files, last_totals, last_first_byte = self.last_read
+            elapsed = max(now - then, 1e-9)
+            self.client_rates = {host: (value - last_clients.get(host, 0)) / elapsed for host, value in clients.items()}
+            self.file_rates = {name: (value - last_files.get(name, 0)) / elapsed for name, value in files.items()}
+            self.interval = {key: (value - last_totals[key]) / elapsed for key, value in totals.items()}
+            self.interval_first_byte = [value - last for value, last in zip(first_byte, last_first_byte)]
+        self.last_read = (now, clients, files, totals, first_byte)
+
+    def top_files(self, count=TOP_FILES):
+        rates = sorted(self.file_rates.items(), key=lambda item: item[1], reverse=True)
+        return [(name, rate) for name, rate in rates[:count] if rate > 0]
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        del snapshot['transfers']
+        snapshot['client_rates'] = {host: round(rate, 1) for host, rate in self.client_rates.items() if rate > 0}
+        snapshot['top_files'] = [{'file': name, 'rate': round(rate, 1)} for name, rate in self.top_files()]
+        return snapshot
+
+    def derived(self):
+        gauges = [('client_bytes_per_second', {'client': host}, round(rate, 1)) for host, rate in sorted(self.client_rates.items())]
+        gauges += [('file_bytes_per_second', {'file': name}, round(rate, 1)) for name, rate in sorted(self.file_rates.items())]
+        return gauges
+
+    def summary(self):
+        interval = self.interval
+        if interval is None or not (interval['requests'] or interval['bytes']):
+            # Nothing to say about an idle interval
+            return None
+        first_byte = self.interval_first_byte
+        split = interval['disk'] + interval['send']
+        line = (f"{self.active.value} active, {interval['requests']:.0f} req/s, "
+                f"{interval['bytes'] / (1024 * 1024):.1f} MB/s")
+        if sum(first_byte[:-1]):
+            line += (f", first byte p50 {format_seconds(self.first_byte.quantile(0.5, first_byte))} "
+                     f"p99 {format_seconds(self.first_byte.quantile(0.99, first_byte))}")
+        if split > 0:
+            line += f", disk {interval['disk'] / split:.0%} send {interval['send'] / split:.0%}"
+        retransmissions = self.retransmissions.value
+        if retransmissions:
+            line += f", {retransmissions} retransmissions"
+        top = self.top_files(3)
+        if top:
+            line += ", top: " + ", ".join(f"{name} {rate / (1024 * 1024):.1f} MB/s" for name, rate in top)
+        return line
+
+    def start(self, interval=SUMMARY_INTERVAL, port=None, path=None, label=''):
+        # Summary line every interval seconds (0: none), endpoint on port or Unix socket path if given
+        if port is not None or path is not None:
+            self.serve(port, path)
+            print(f"{label}Stats on {path if path is not None else f'http://127.0.0.1:{port}/metrics'}")
+
+        self.update_rates()
+
+        def run():
+            while True:
+                time.sleep(interval or SUMMARY_INTERVAL)
+                self.update_rates()
+                line = self.summary() if interval else None
+                if line:
+                    print(f"{label}{line}")
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def counts(self):
+        # Plain numbers for --workers to add up at exit
+        return {
+            'connections': self.connections.value,
+            'requests': self.requests.value,
+            'bytes_sent': self.bytes_sent.value,
+            'retransmissions': self.retransmissions.value,
+        }
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return f">{LATENCY_BUCKETS[-1]} s"
+    return f"{seconds * 1000:.2f} ms" if seconds < 1 else f"{seconds:.1f} s"
@@ -0,0 +1,85 @@
+import threading
+import time
+
+# The servers a client downloads from.
+#
+# Every server has its own catalog. A file is fetched from each server whose
+# catalog lists it with the same size and, where the catalog knows it, the
+# same digest. Sources are measured as their data lands: a smoothed throughput,
+# and from it a share, the source's rate over the fastest one's with room to
+# grow. Connections to a source claim and lease in proportion to its share, so
+# a slow mirror only ever holds what it can deliver soon and the fast ones take
+# the rest. Until measured, every source gets an equal part. A source that
+# errors or stalls drops to the smallest share until it delivers again.
+
+RATE_INTERVAL = 0.5
+RATE_SMOOTHING = 0.3
+# Least share a source is given, as a part of the fastest one's
+MIN_SHARE = 1 / 16
+# A source may have in flight what it would take to go this much faster, so one
+# held back by a small share can still show it is faster than that
+HEADROOM = 2
+
+class Source:
+    def __init__(self, index, host, port):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.label = f"{host}:{port}"
+        self.binary = False
+        # name -> {'size': ..., 'digest': ...} as this server lists it
+        self.files = {}
+        self.generation = 0
+        self.last_refresh = 0
+        self.control_socket = None
+        self.control_lock = threading.Lock()
+        # Bytes per second, None until measured
+        self.rate = None
+        self.window = 0
+        self.window_start = None
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def has(self, name, size, digest=None):
+        entry = self.files.get(name)
+        if entry is None or entry['size'] != size:
+            return False
+        return digest is None or entry.get('digest') is None or entry['digest'] == digest
+
+    def record(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            if self.window_start is None:
+                self.window_start = now
+            self.window += nbytes
+            self.failures = 0
+            elapsed = now - self.window_start
+            if elapsed >= RATE_INTERVAL:
+                sample = self.window / elapsed
+                self.rate = sample if not self.rate else self.rate + RATE_SMOOTHING * (sample - self.rate)
+                self.window = 0
+                self.window_start = now
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.rate = 0.0
+            self.window = 0
+            self.window_start = None
+
+def share(source, sources):
+    # Part of a full claim, lease and pipeline this source's connections get, 1 for the fastest
+    if source.rate is None:
+        return 1.0 / len(sources)
+    rates = [other.rate for other in sources if other.rate]
+    if not rates:
+        return 1.0
+    return max(MIN_SHARE, min(1.0, HEADROOM * source.rate / max(rates)))
+
+def parse_servers(text, default_port):
+    # "host[:port]" entries separated by commas or spaces
+    servers = []
+    for item in text.replace(',', ' ').split():
+        host, separator, port = item.partition(':')
+        servers.append((host, int(port) if separator else default_port))
+    return servers
@@ -0,0 +1,100 @@
+import json
+import os
+import signal
+import sys
+import threading
+
+# Pre-fork worker processes for the servers.
+#
+# Every worker binds the same port with SO_REUSEPORT and the kernel spreads
+# connections (TCP) or client addresses (UDP) across them. The parent only
+# forwards SIGINT/SIGTERM to the workers, waits for them to drain, and adds
+# up the stats each one reports through a pipe when it exits.
+
+def can_fork():
+    return hasattr(os, 'fork') and hasattr(os, 'pipe')
+
+def run_workers(count, serve, collect):
+    # serve(worker) runs one worker until it is told to stop, collect() then returns its numeric stats
+    if count <= 1 or not can_fork():
+        if count > 1:
+            print("This platform can't fork, serving from a single process")
+        try:
+            serve(0)
+        except SystemExit:
+            pass
+        return collect()
+
+    # Anything still buffered would be printed again by every child
+    sys.stdout.flush()
+    children = {}
+    for worker in range(count):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            run_child(worker, serve, collect, write_end)
+        os.close(write_end)
+        children[pid] = (worker, read_end)
+
+    def forward(sig, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+
+    totals = {}
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in children:
+            continue
+        worker, read_end = children.pop(pid)
+        data = b''
+        while True:
+            chunk = os.read(read_end, 65536)
+            if not chunk:
+                break
+            data += chunk
+        os.close(read_end)
+        try:
+            stats = json.loads(data.decode()) if data else {}
+        except ValueError:
+            stats = {}
+        if status != 0 and not stats:
+            print(f"Worker {worker} exited with status {status}")
+        merge_stats(totals, stats)
+    return totals
+
+def run_child(worker, serve, collect, write_end):
+    # Never returns: the child must not fall back into the parent's code
+    try:
+        serve(worker)
+    except SystemExit:
+        pass
+    except BaseException as e:
+        print(f"Worker {worker} failed: {e}")
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # Connections still being served finish before the worker reports
+        for thread in threading.enumerate():
+            if thread is not threading.main_thread() and not thread.daemon:
+                thread.join()
+        os.write(write_end, json.dumps(collect()).encode())
+    finally:
+        os.close(write_end)
+        sys.stdout.flush()
+        os._exit(0)
+
+def merge_stats(totals, stats):
+    for key, value in stats.items():
+        if isinstance(value, (int, float)):
+            totals[key] = totals.get(key, 0) + value
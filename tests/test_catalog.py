@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.catalog import Catalog
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.folder = self.temp.name
+        self.names = ['a.bin']
+        # b.bin is older than the file already published
+        for name, size in (('b.bin', 20), ('a.bin', 10)):
+            self.write(name, size)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def write(self, name, size):
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(bytes(size))
+
+    def catalog(self, digest_source=None):
+        return Catalog(self.folder, lambda: self.names, digest_source=digest_source)
+
+    def test_full_listing(self):
+        catalog = self.catalog()
+        catalog.open()
+        listing = catalog.listing()
+        self.assertTrue(listing['full'])
+        self.assertEqual([entry['name'] for entry in listing['entries']], ['a.bin'])
+
+    def test_file_published_after_it_was_written(self):
+        catalog = self.catalog()
+        catalog.open()
+        generation = catalog.listing()['generation']
+        self.names.append('b.bin')
+        self.assertTrue(catalog.refresh())
+        listing = catalog.listing(since=generation)
+        self.assertFalse(listing['full'])
+        self.assertEqual([entry['name'] for entry in listing['entries']], ['b.bin'])
+        self.assertGreater(listing['generation'], generation)
+
+    def test_removed_and_rewritten_files(self):
+        catalog = self.catalog()
+        self.names.append('b.bin')
+        catalog.open()
+        generation = catalog.listing()['generation']
+        os.remove(os.path.join(self.folder, 'b.bin'))
+        self.write('a.bin', 11)
+        self.assertTrue(catalog.refresh())
+        listing = catalog.listing(since=generation)
+        self.assertEqual([entry['name'] for entry in listing['entries']], ['a.bin'])
+        self.assertEqual(listing['entries'][0]['size'], 11)
+        self.assertEqual(listing['removed'], ['b.bin'])
+        self.assertEqual(catalog.listing(since=listing['generation'])['entries'], [])
+
+    def test_saved_index_is_used_on_the_next_start(self):
+        catalog = self.catalog(lambda name: 'digest of ' + name)
+        catalog.open()
+        generation = catalog.listing()['generation']
+        index_mtime = os.stat(catalog.index_path).st_mtime_ns
+        for _ in range(3):
+            catalog = self.catalog()
+            self.assertFalse(catalog.open())
+            listing = catalog.listing()
+            self.assertEqual(listing['generation'], generation)
+            self.assertEqual(listing['entries'][0]['digest'], 'digest of a.bin')
+        self.assertEqual(os.stat(catalog.index_path).st_mtime_ns, index_mtime)
+
+    def test_file_rewritten_while_the_server_was_down(self):
+        catalog = self.catalog()
+        catalog.open()
+        generation = catalog.listing()['generation']
+        self.write('a.bin', 12)
+        catalog = self.catalog()
+        self.assertTrue(catalog.open())
+        listing = catalog.listing(since=generation)
+        self.assertEqual([(entry['name'], entry['size']) for entry in listing['entries']], [('a.bin', 12)])
+
+    def test_pages(self):
+        self.names = None
+        for i in range(5):
+            self.write(f"c{i}.bin", i)
+        catalog = self.catalog()
+        catalog.open()
+        names = []
+        cursor = ''
+        while cursor is not None:
+            listing = catalog.listing(cursor=cursor, limit=3)
+            names += [entry['name'] for entry in listing['entries']]
+            cursor = listing['next']
+        self.assertEqual(names, sorted(['a.bin', 'b.bin'] + [f"c{i}.bin" for i in range(5)]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import delta, integrity
+from common.fileio import read_at, write_at
+
+BLOCK = 4096
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.old_path = os.path.join(self.temp.name, 'old.bin')
+        self.new_path = os.path.join(self.temp.name, 'new.bin')
+        rng = random.Random(1)
+        self.old = bytes(rng.getrandbits(8) for _ in range(8 * BLOCK + 123))
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def manifest(self, old, new):
+        for path, data in ((self.old_path, old), (self.new_path, new)):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return integrity.build_manifest(self.new_path, BLOCK)
+
+    def sync(self, manifest, matches):
+        # What a client does: copy the matched blocks, fetch the rest, return the file it ends up with
+        result_path = os.path.join(self.temp.name, 'result.bin')
+        fd = os.open(result_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, manifest['size'])
+            delta.copy_blocks(self.old_path, fd, manifest, matches)
+            source = os.open(self.new_path, os.O_RDONLY)
+            try:
+                for start, end in delta.missing_ranges(manifest, matches):
+                    write_at(fd, read_at(source, start, end - start), start)
+            finally:
+                os.close(source)
+            return read_at(fd, 0, manifest['size'])
+        finally:
+            os.close(fd)
+
+    def test_same_file(self):
+        manifest = self.manifest(self.old, self.old)
+        matches = delta.find_matches(self.old_path, manifest)
+        self.assertEqual(matches, {index: index * BLOCK for index in range(9)})
+        self.assertEqual(delta.missing_ranges(manifest, matches), [])
+
+    def test_changed_block(self):
+        new = bytearray(self.old)
+        new[3 * BLOCK + 5] ^= 0xFF
+        manifest = self.manifest(self.old, bytes(new))
+        matches = delta.find_matches(self.old_path, manifest)
+        self.assertNotIn(3, matches)
+        self.assertEqual(len(matches), 8)
+        self.assertEqual(delta.missing_ranges(manifest, matches), [[3 * BLOCK, 4 * BLOCK]])
+        self.assertEqual(self.sync(manifest, matches), bytes(new))
+
+    def test_inserted_bytes_are_rolled_past(self):
+        # Everything after the insertion moved by 7 bytes and is found at its new offset
+        new = self.old[:2 * BLOCK + 100] + b'inserts' + self.old[2 * BLOCK + 100:]
+        manifest = self.manifest(self.old, new)
+        matches = delta.find_matches(self.old_path, manifest)
+        self.assertEqual(matches[0], 0)
+        self.assertEqual(matches[1], BLOCK)
+        self.assertNotIn(2, matches)
+        for index in range(3, 8):
+            self.assertEqual(matches[index], index * BLOCK - 7)
+        self.assertEqual(self.sync(manifest, matches), new)
+
+    def test_grown_file(self):
+        new = self.old + b'appended'
+        manifest = self.manifest(self.old, new)
+        matches = delta.find_matches(self.old_path, manifest)
+        self.assertEqual(sorted(matches), list(range(8)))
+        self.assertEqual(self.sync(manifest, matches), new)
+
+    def test_no_local_copy(self):
+        manifest = self.manifest(self.old, self.old)
+        self.assertEqual(delta.find_matches(os.path.join(self.temp.name, 'missing.bin'), manifest), {})
+
+if __name__ == "__main__":
+    unittest.main()
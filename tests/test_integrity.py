@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import integrity
+from common.integrity import ManifestCache
+
+BLOCK = 4096
+
+class IntegrityTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.folder = self.temp.name
+        self.data = os.urandom(3 * BLOCK + 100)
+        self.path = os.path.join(self.folder, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_manifest(self):
+        manifest = integrity.build_manifest(self.path, BLOCK)
+        self.assertEqual(manifest['size'], len(self.data))
+        self.assertEqual(integrity.block_count(manifest), 4)
+        self.assertEqual(integrity.block_range(manifest, 3), (3 * BLOCK, 3 * BLOCK + 100))
+        self.assertEqual(list(integrity.blocks_covering(manifest, BLOCK - 1, BLOCK + 1)), [0, 1])
+        self.assertEqual(list(integrity.blocks_covering(manifest, 3 * BLOCK, len(self.data))), [3])
+        self.assertTrue(integrity.check_manifest(manifest))
+        for index in range(4):
+            start, end = integrity.block_range(manifest, index)
+            self.assertTrue(integrity.verify_block(manifest, index, self.data[start:end]))
+        self.assertEqual(manifest['weak'][0], integrity.weak_checksum(self.data[:BLOCK]))
+
+    def test_corruption_is_caught(self):
+        manifest = integrity.build_manifest(self.path, BLOCK)
+        block = bytearray(self.data[BLOCK:2 * BLOCK])
+        block[10] ^= 1
+        self.assertFalse(integrity.verify_block(manifest, 1, block))
+        # A manifest whose block list was tampered with no longer matches its digest
+        manifest['blocks'][2] = manifest['blocks'][1]
+        self.assertFalse(integrity.check_manifest(manifest))
+
+    def test_packet_checksum(self):
+        packet = bytearray(b'x' * 1400)
+        checksum = integrity.packet_checksum(packet)
+        packet[700] ^= 0x80
+        self.assertNotEqual(integrity.packet_checksum(packet), checksum)
+
+    def test_manifest_cache(self):
+        cache = ManifestCache(self.folder)
+        manifest = cache.get('file.bin')
+        self.assertEqual(manifest['digest'], integrity.build_manifest(self.path)['digest'])
+        self.assertIs(cache.peek('file.bin'), manifest)
+        # Stored next to the files, a new cache reuses it
+        self.assertEqual(ManifestCache(self.folder).get('file.bin'), manifest)
+        with open(self.path, 'ab') as f:
+            f.write(b'more')
+        self.assertIsNone(cache.peek('file.bin'))
+        self.assertEqual(cache.get('file.bin')['size'], len(self.data) + 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.journal import RangeJournal
+
+class RangeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.temp.name, 'file.download')
+        self.path = os.path.join(self.temp.name, 'file.journal')
+        with open(self.data_path, 'wb') as f:
+            f.write(bytes(1000))
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_ranges_merge(self):
+        journal = RangeJournal(self.path, self.data_path, 1000)
+        for start, end in ((100, 200), (300, 400), (200, 300), (350, 500), (600, 700)):
+            journal.add(start, end)
+        self.assertEqual(journal.ranges, [[100, 500], [600, 700]])
+        self.assertEqual(journal.missing(), [(0, 100), (500, 600), (700, 1000)])
+        self.assertEqual(journal.completed_bytes(), 500)
+        self.assertTrue(journal.covers(150, 450))
+        self.assertFalse(journal.covers(450, 650))
+        self.assertFalse(journal.is_complete())
+        journal.add(0, 1000)
+        self.assertTrue(journal.is_complete())
+
+    def test_discard(self):
+        journal = RangeJournal(self.path, self.data_path, 1000)
+        journal.add(0, 1000)
+        journal.discard(200, 300)
+        self.assertEqual(journal.ranges, [[0, 200], [300, 1000]])
+        self.assertEqual(journal.missing(), [(200, 300)])
+
+    def test_saved_journal_is_loaded(self):
+        journal = RangeJournal(self.path, self.data_path, 1000)
+        journal.add(0, 100)
+        journal.add(500, 800)
+        journal.save()
+        loaded = RangeJournal.load(self.path, self.data_path, 1000)
+        self.assertEqual(loaded.ranges, [[0, 100], [500, 800]])
+
+    def test_stale_journals_are_ignored(self):
+        journal = RangeJournal(self.path, self.data_path, 1000)
+        journal.add(0, 100)
+        journal.save()
+        # Another size on the server, or the data it describes is gone
+        self.assertIsNone(RangeJournal.load(self.path, self.data_path, 2000))
+        os.remove(self.data_path)
+        self.assertIsNone(RangeJournal.load(self.path, self.data_path, 1000))
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_corrupt_journal_is_ignored(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'SKRJ\x00')
+        self.assertIsNone(RangeJournal.load(self.path, self.data_path, 1000))
+
+if __name__ == "__main__":
+    unittest.main()
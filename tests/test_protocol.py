@@ -0,0 +1,38 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TCP'))
+import protocol
+
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.server.settimeout(0.05)
+        self.reader = protocol.FrameReader(self.server)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_pipelined_requests(self):
+        self.client.sendall(protocol.pack_request(protocol.GET, 1, 'a.bin', 0, 10)
+                            + protocol.pack_request(protocol.GET, 2, 'b.bin', 10, 20))
+        self.assertEqual(self.reader.read_request(), (protocol.GET, 1, 'a.bin', 0, 10))
+        self.assertEqual(self.reader.read_request(), (protocol.GET, 2, 'b.bin', 10, 20))
+        self.assertEqual(self.reader.pending, b'')
+
+    def test_timeout_in_the_middle_of_a_request_loses_nothing(self):
+        request = protocol.pack_request(protocol.GET, 7, 'some_file.bin', 1024, 4096)
+        for cut in (3, protocol.REQUEST.size, protocol.REQUEST.size + 4):
+            self.client.sendall(request[:cut])
+            with self.assertRaises(socket.timeout):
+                self.reader.read_request()
+            self.assertEqual(self.reader.pending, request[:cut])
+            self.client.sendall(request[cut:])
+            self.assertEqual(self.reader.read_request(), (protocol.GET, 7, 'some_file.bin', 1024, 4096))
+            self.assertEqual(self.reader.pending, b'')
+
+if __name__ == "__main__":
+    unittest.main()
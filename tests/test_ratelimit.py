@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import ratelimit
+from common.ratelimit import RateLimiter, MB, SLICE
+
+class Clock:
+    # Stands in for the time module: the simulation moves it forward itself
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+def simulate(limiter, clock, senders, seconds=3, warmup=1):
+    # Every sender is (host, start, own rate or None) and sends SLICE after SLICE as soon as the
+    # limiter lets it; returns the MB/s each host got once the shares have settled
+    flows = [{'host': host, 'next': clock.now + start, 'rate': rate, 'flow': None} for host, start, rate in senders]
+    sent = {host: 0 for host, _, _ in senders}
+    measured = clock.now + warmup
+    end = clock.now + seconds
+    while True:
+        sender = min(flows, key=lambda sender: sender['next'])
+        if sender['next'] >= end:
+            break
+        clock.now = sender['next']
+        if sender['flow'] is None:
+            sender['flow'] = limiter.flow(sender['host'])
+        delay = sender['flow'].reserve(SLICE)
+        if clock.now + delay >= measured:
+            sent[sender['host']] += SLICE
+        sender['next'] = clock.now + delay + (SLICE / sender['rate'] if sender['rate'] else 0)
+    return {host: nbytes / MB / (seconds - warmup) for host, nbytes in sent.items()}
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.time = ratelimit.time
+        ratelimit.time = self.clock
+
+    def tearDown(self):
+        ratelimit.time = self.time
+
+    def assertRate(self, rate, expected):
+        self.assertAlmostEqual(rate, expected, delta=expected * 0.1)
+
+    def test_clients_share_the_total_not_their_connections(self):
+        limiter = RateLimiter(total=20 * MB)
+        rates = simulate(limiter, self.clock, [('A', 0, None)] * 4 + [('B', 0, None)])
+        self.assertRate(rates['A'], 10)
+        self.assertRate(rates['B'], 10)
+
+    def test_weights(self):
+        limiter = RateLimiter(total=20 * MB, weights={'B': 3})
+        rates = simulate(limiter, self.clock, [('A', 0, None)] * 4 + [('B', 0, None)])
+        self.assertRate(rates['A'], 5)
+        self.assertRate(rates['B'], 15)
+
+    def test_slow_client_leaves_the_rest_to_the_others(self):
+        limiter = RateLimiter(total=20 * MB)
+        rates = simulate(limiter, self.clock, [('A', 0, None)] * 4 + [('B', 0, None), ('C', 0.5, 2 * MB)])
+        self.assertRate(rates['C'], 2)
+        self.assertRate(rates['A'], 9)
+        self.assertRate(rates['B'], 9)
+        self.assertLessEqual(sum(rates.values()), 20 * 1.02)
+
+    def test_per_client_and_connection_caps(self):
+        limiter = RateLimiter(total=20 * MB, client=4 * MB, connection=3 * MB)
+        rates = simulate(limiter, self.clock, [('A', 0, None)] * 4 + [('B', 0, None)])
+        self.assertRate(rates['A'], 4)
+        self.assertRate(rates['B'], 3)
+
+    def test_workers_split_the_caps(self):
+        limiter = RateLimiter(total=20 * MB, client=8 * MB, connection=3 * MB)
+        limiter.split(4)
+        self.assertEqual(limiter.total_rate, 5 * MB)
+        self.assertEqual(limiter.client_rate, 2 * MB)
+        self.assertEqual(limiter.connection_rate, 3 * MB)
+        self.assertIn("split over 4 workers", limiter.describe())
+        rates = simulate(limiter, self.clock, [('A', 0, None)] * 4)
+        self.assertRate(rates['A'], 2)
+
+    def test_limits_read_later_are_split_too(self):
+        limiter = RateLimiter()
+        limiter.split(2)
+        limiter.configure(total=20 * MB)
+        self.assertEqual(limiter.total_rate, 10 * MB)
+        self.assertIn("total 20 MB/s", limiter.describe())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.scheduler import RangeScheduler
+
+KB = 1024
+
+def drain(scheduler, worker, size):
+    claimed = []
+    while True:
+        claim = scheduler.claim(worker, size)
+        if claim is None:
+            return claimed
+        claimed.append(claim)
+
+class RangeSchedulerTest(unittest.TestCase):
+    def assertCovers(self, claims, ranges):
+        # Every byte exactly once
+        merged = []
+        for start, end in sorted(claims):
+            if merged and merged[-1][1] == start:
+                merged[-1][1] = end
+            else:
+                self.assertTrue(not merged or merged[-1][1] < start, "overlapping claims")
+                merged.append([start, end])
+        self.assertEqual([tuple(r) for r in merged], [tuple(r) for r in ranges])
+
+    def test_workers_in_turn_cover_every_range(self):
+        ranges = [(0, 1000 * KB), (1500 * KB, 1700 * KB)]
+        scheduler = RangeScheduler(ranges, 256 * KB, 64 * KB)
+        claims = []
+        done = set()
+        while len(done) < 3:
+            for worker in range(3):
+                claim = scheduler.claim(worker, 64 * KB)
+                if claim is None:
+                    done.add(worker)
+                else:
+                    claims.append(claim)
+        self.assertCovers(claims, ranges)
+
+    def test_idle_worker_steals_the_back_half(self):
+        scheduler = RangeScheduler([(0, 1024 * KB)], 1024 * KB, 64 * KB)
+        self.assertEqual(scheduler.claim(0, 64 * KB), (0, 64 * KB))
+        # Nothing queued: worker 1 takes the back half of what worker 0 has left, aligned to min_split
+        start, end = scheduler.claim(1, 64 * KB)
+        self.assertEqual(start % (64 * KB), 0)
+        self.assertEqual(start, 512 * KB)
+        self.assertCovers([(0, 64 * KB), (start, end)] + drain(scheduler, 0, 64 * KB) + drain(scheduler, 1, 64 * KB),
+                          [(0, 1024 * KB)])
+
+    def test_small_leases_are_not_split(self):
+        scheduler = RangeScheduler([(0, 100 * KB)], 100 * KB, 64 * KB)
+        scheduler.claim(0, 10 * KB)
+        self.assertIsNone(scheduler.claim(1, 10 * KB))
+
+    def test_give_back(self):
+        scheduler = RangeScheduler([(0, 512 * KB)], 256 * KB, 64 * KB)
+        lost = scheduler.claim(0, 64 * KB)
+        scheduler.give_back(0, [lost])
+        self.assertCovers(drain(scheduler, 1, 64 * KB), [(0, 512 * KB)])
+
+    def test_lease_size_and_max_request(self):
+        scheduler = RangeScheduler([(0, 1024 * KB)], 1024 * KB, 64 * KB, max_request=128 * KB)
+        self.assertEqual(scheduler.claim(0, 512 * KB, lease_size=256 * KB), (0, 128 * KB))
+        # The rest of the piece went back to the queue for the others
+        self.assertEqual(scheduler.claim(1, 512 * KB), (256 * KB, 384 * KB))
+        self.assertEqual(scheduler.claim(0, 512 * KB, lease_size=256 * KB), (128 * KB, 256 * KB))
+
+if __name__ == "__main__":
+    unittest.main()